@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Asyncio ingest engine, part of evtx2splunk
+    Uses aiohttp, an optional dependency (pip install aiohttp)
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import asyncio
+import logging as log
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, List
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from hec_sender import THROTTLING_STATUS, AdaptiveController, EndpointBalancer, HECEndpoint, backoff_delay, \
+    parse_retry_after
+from journal import FileCheckpoint
+from metrics import Metrics
+from scheduler import WorkItem
+
+# Size of the blocks of records read at once and handed to the CPU stage
+BLOCK_BYTES = 4 * 1024 * 1024
+
+# Blocks of a work item being encoded at the same time
+BLOCKS_IN_FLIGHT = 2
+
+
+def is_available():
+    """
+    Return whether aiohttp is installed
+    :return: True if available
+    """
+    return aiohttp is not None
+
+
+def read_block(records, block_bytes: int = BLOCK_BYTES):
+    """
+    Read records until a block is full. Runs in a thread, off the event loop
+    :param records: Iterator of records as bytes, one JSON document per line
+    :param block_bytes: Size of the block
+    :return: Bytes of the block, empty at the end of the records
+    """
+    lines = []
+    size = 0
+    for line in records:
+        lines.append(line)
+        size += len(line)
+        if size >= block_bytes:
+            break
+
+    return b"".join(lines)
+
+
+class AsyncEngine(object):
+    """
+    Ingest pipeline running on an event loop. Work items are read by async readers, the records
+    being pulled by threads so the loop never blocks on the disk or on the converter. Blocks of
+    records are encoded into HEC batches by a process executor, and the batches are posted by
+    concurrent senders sharing a single aiohttp connection pool.
+    Stages are connected by bounded queues, so memory stays flat whatever the speed of each
+    stage, and the senders keep posting while the next blocks are encoded.
+    As with HECSender, the concurrent requests and the size of the batches follow an
+    AdaptiveController, the endpoints are picked by an EndpointBalancer which ejects the
+    failing ones, and failed or throttled batches are retried after a backoff.
+    """
+
+    def __init__(self, executor: Executor, encode: Callable, open_records: Callable, checkpoint: Callable,
+                 urls: List[str], token: str, metrics: Metrics, readers: int = 4, senders: int = 16,
+                 ssl_verify: bool = False, compress: bool = True, timeout: int = 60, dry_run: bool = False,
+                 progress=None, batch_bytes: int = 512000, max_batch_bytes: int = None, adaptive: bool = True,
+                 max_retries: int = 8, balancing: str = "round_robin", max_failures: int = 3, eject_time: int = 30):
+        """
+        Init method of the AsyncEngine
+        :param executor: Executor of the CPU stage
+        :param encode: Picklable callable (block, offset, source, batch size) returning a tuple
+                       (list of (payload, offset following its last record), counters of the metrics)
+        :param open_records: Callable (item, offset) returning a tuple (records iterator, name of the JSON file)
+        :param checkpoint: Callable (item) returning a tuple (FileCheckpoint or None, True if already sent)
+        :param urls: Base URLs of the HEC endpoints, for instance https://splunk:8088
+        :param token: HEC token
+        :param metrics: Metrics counting the requests and merging the counters of the CPU stage
+        :param readers: Number of work items read at the same time
+        :param senders: Max number of batches posted at the same time
+        :param ssl_verify: True to check ssl certificate
+        :param compress: True if the payloads returned by encode are gzipped
+        :param timeout: Timeout of the requests in seconds
+        :param dry_run: True to build the batches without posting them
+        :param progress: If set, tqdm progress bar updated for each work item
+        :param batch_bytes: Initial size of the batches
+        :param max_batch_bytes: Max size of the batches when adaptive
+        :param adaptive: True to adapt the concurrent requests and the size of the batches to the HEC feedback
+        :param max_retries: Number of retries of a batch after it failed on every endpoint
+        :param balancing: Distribution of the batches between the endpoints, round_robin or least_outstanding
+        :param max_failures: Number of consecutive failures after which an endpoint is ejected
+        :param eject_time: Time in seconds an endpoint stays ejected
+        """
+        self._executor = executor
+        self._encode = encode
+        self._open_records = open_records
+        self._checkpoint = checkpoint
+        self._balancer = EndpointBalancer([HECEndpoint(url) for url in urls], balancing, max_failures, eject_time)
+        self._token = token
+        self._metrics = metrics
+        self._readers = readers
+        self._senders = senders
+        self._ssl_verify = ssl_verify
+        self._compress = compress
+        self._timeout = timeout
+        self._dry_run = dry_run
+        self._progress = progress
+        self._max_retries = max_retries
+        self._control = AdaptiveController(senders, batch_bytes, max_batch_bytes, adaptive=adaptive)
+        self._session = None
+        self._window = None
+        self._in_flight = 0
+
+    def run(self, items: List[WorkItem]):
+        """
+        Ingest the work items
+        :param items: Work items, largest first
+        :return: List of tuples (1 if the item was successfully indexed else 0, 1)
+        """
+        return asyncio.run(self._run(items))
+
+    async def _run(self, items: List[WorkItem]):
+        """
+        Start the readers and the senders and wait for all the work items
+        :param items: Work items, largest first
+        :return: List of tuples (1 if the item was successfully indexed else 0, 1)
+        """
+        item_queue = asyncio.Queue()
+        for item in items:
+            item_queue.put_nowait(item)
+
+        batch_queue = asyncio.Queue(maxsize=self._senders * 2)
+        results = []
+        self._window = asyncio.Condition()
+
+        connector = aiohttp.TCPConnector(limit=self._senders, ssl=None if self._ssl_verify else False)
+        async with aiohttp.ClientSession(connector=connector,
+                                         headers={"Authorization": "Splunk {token}".format(token=self._token)},
+                                         timeout=aiohttp.ClientTimeout(total=self._timeout)) as self._session:
+
+            senders = [asyncio.create_task(self._sender(batch_queue)) for _ in range(self._senders)]
+            try:
+                await asyncio.gather(*[self._reader(item_queue, batch_queue, results)
+                                       for _ in range(min(self._readers, len(items)) or 1)])
+                await batch_queue.join()
+            finally:
+                for sender in senders:
+                    sender.cancel()
+                await asyncio.gather(*senders, return_exceptions=True)
+
+        return results
+
+    async def _reader(self, item_queue: asyncio.Queue, batch_queue: asyncio.Queue, results: list):
+        """
+        Read work items until there is none left
+        :param item_queue: Work items shared by the readers
+        :param batch_queue: Batches to post
+        :param results: List receiving the result of each item
+        :return: Nothing
+        """
+        while not item_queue.empty():
+            item = item_queue.get_nowait()
+            try:
+                success = await self._ingest_item(item, batch_queue)
+            except Exception as e:
+                log.warning("{file} : {error}".format(file=item.path.name, error=e))
+                success = False
+
+            results.append((1 if success else 0, 1))
+            if self._progress is not None:
+                self._progress.update(1)
+
+    async def _ingest_item(self, item: WorkItem, batch_queue: asyncio.Queue):
+        """
+        Read a work item by blocks, encode them in the executor and queue their batches. Blocks
+        are encoded concurrently but their batches are queued in order, so the checkpoint
+        registers them in the order of the file
+        :param item: WorkItem to index
+        :param batch_queue: Batches to post
+        :return: True if the item was successfully indexed else False
+        """
+        loop = asyncio.get_running_loop()
+
+        checkpoint, done = self._checkpoint(item)
+        if done:
+            return True
+
+        offset = checkpoint.offset if checkpoint else item.start
+        records, json_name = await loop.run_in_executor(None, self._open_records, item, offset)
+        source = "event_" + json_name
+
+        sent = []
+        encoding = deque()
+        try:
+            while True:
+                block = await loop.run_in_executor(None, read_block, records)
+                if block:
+                    encoding.append(loop.run_in_executor(self._executor, self._encode, block, offset, source,
+                                                         self._control.batch_bytes))
+                    offset += len(block)
+
+                if encoding and (not block or len(encoding) >= BLOCKS_IN_FLIGHT):
+                    await self._queue_batches(await encoding.popleft(), checkpoint, batch_queue, sent)
+
+                if not block and not encoding:
+                    break
+
+        finally:
+            await loop.run_in_executor(None, getattr(records, "close", lambda: None))
+
+        start = time.perf_counter()
+        success = all(await asyncio.gather(*sent))
+        self._metrics.inc("send_seconds", time.perf_counter() - start, file=source)
+
+        if checkpoint:
+            checkpoint.complete(success, offset)
+
+        return success
+
+    async def _queue_batches(self, encoded: tuple, checkpoint: FileCheckpoint, batch_queue: asyncio.Queue,
+                             sent: list):
+        """
+        Queue the batches of an encoded block. Blocks while the senders are behind
+        :param encoded: Tuple returned by encode
+        :param checkpoint: FileCheckpoint of the item, or None
+        :param batch_queue: Batches to post
+        :param sent: List receiving a future of the result of each batch
+        :return: Nothing
+        """
+        payloads, counters = encoded
+        self._metrics.merge(counters)
+
+        for payload, payload_offset in payloads:
+            seq = checkpoint.register(payload_offset) if checkpoint and payload_offset is not None else None
+            future = asyncio.get_running_loop().create_future()
+            sent.append(future)
+            await batch_queue.put((payload, checkpoint, seq, future))
+
+    async def _sender(self, batch_queue: asyncio.Queue):
+        """
+        Post batches until cancelled
+        :param batch_queue: Batches to post
+        :return: Nothing
+        """
+        while True:
+            payload, checkpoint, seq, future = await batch_queue.get()
+            try:
+                success = True if self._dry_run else await self._post(payload)
+            except Exception as e:
+                log.warning(e)
+                success = False
+
+            if seq is not None:
+                checkpoint.ack(seq, success)
+            future.set_result(success)
+            batch_queue.task_done()
+
+    async def _post(self, payload: bytes):
+        """
+        Post a batch to the HEC endpoints. Connection and server errors are retried
+        on each other endpoint. Once all of them failed, or if the HEC is throttling,
+        the batch is retried after a backoff
+        :param payload: Bytes of the batch
+        :return: True if successfully posted, else False
+        """
+        tried = []
+        attempt = 0
+        retry_after = None
+        while True:
+            endpoint = self._balancer.pick(tried) if retry_after is None else None
+            if endpoint is None:
+                attempt += 1
+                if attempt > self._max_retries:
+                    return False
+
+                self._metrics.inc("hec_retries")
+                await asyncio.sleep(backoff_delay(attempt, retry_after))
+                tried = []
+                retry_after = None
+                continue
+
+            tried.append(endpoint)
+            status, retry_after = await self._post_once(endpoint.url, payload)
+
+            if status in THROTTLING_STATUS:
+                # The HEC is busy, not broken, keep the endpoint and retry after a backoff
+                self._balancer.release(endpoint, success=True)
+                retry_after = retry_after or 0
+                continue
+
+            retry_after = None
+            if status is None or status >= 500:
+                self._balancer.release(endpoint, success=False)
+                continue
+
+            self._balancer.release(endpoint, success=True)
+            return status == 200
+
+    async def _post_once(self, url: str, payload: bytes):
+        """
+        Post a batch to an endpoint within the window of concurrent requests
+        :param url: Base URL of the endpoint
+        :param payload: Bytes of the batch
+        :return: Tuple (HTTP status or None if the request failed, Retry-After delay or None)
+        """
+        async with self._window:
+            await self._window.wait_for(lambda: self._in_flight < self._control.limit)
+            self._in_flight += 1
+
+        headers = {"Content-Encoding": "gzip"} if self._compress else {}
+        status = None
+        retry_after = None
+        text = ""
+        start = time.perf_counter()
+        try:
+            async with self._session.post(url + "/services/collector/event", data=payload,
+                                          headers=headers) as response:
+                status = response.status
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning("{url} : {error}".format(url=url, error=e or type(e).__name__))
+
+        latency = time.perf_counter() - start
+        async with self._window:
+            self._in_flight -= 1
+            if status in THROTTLING_STATUS:
+                self._control.on_congestion()
+            elif status == 200:
+                self._control.on_success(latency, len(payload))
+            self._window.notify_all()
+
+        self._observe(start, len(payload), error=status != 200)
+        if status is not None and status != 200 and status not in THROTTLING_STATUS:
+            log.warning("HEC error on {url}. Status {status} : {message}".format(url=url, status=status,
+                                                                                 message=text))
+
+        return status, retry_after
+
+    def _observe(self, start: float, size: int, error: bool):
+        """
+        Count a request in the metrics
+        :param start: perf_counter value when the request was started
+        :param size: Size of the posted data
+        :param error: True if the request failed
+        :return: Nothing
+        """
+        self._metrics.add({"hec_requests": 1,
+                           "hec_request_seconds": time.perf_counter() - start,
+                           "hec_bytes": size,
+                           "hec_errors": 1 if error else 0})
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    End-to-end benchmark of the ingest, part of evtx2splunk
+    Generates a synthetic corpus of evtx_dump JSONL files and indexes it with Evtx2Splunk
+    against the local Splunk stand-in of mock_splunk.py, as done with --use_cache.
+    Reports the events/s, the peak RSS and the time of each stage.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import cpu_count
+from pathlib import Path
+from urllib.request import urlopen
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import json_codec
+from evtx2splunk import Evtx2Splunk
+
+# Providers and event IDs of each channel, with the EventData names of their records
+CHANNELS = {
+    "Security": ("Microsoft-Windows-Security-Auditing",
+                 [4624, 4625, 4634, 4672, 4688],
+                 ["SubjectUserSid", "SubjectUserName", "TargetUserName", "LogonType", "IpAddress", "ProcessName"]),
+    "System": ("Service Control Manager",
+               [7036, 7040, 7045],
+               ["param1", "param2", "param3"]),
+    "Application": ("Application Error",
+                    [1000, 1001],
+                    ["AppName", "AppVersion", "ModuleName", "ExceptionCode"]),
+    "Microsoft-Windows-PowerShell/Operational": ("Microsoft-Windows-PowerShell",
+                                                 [4103, 4104],
+                                                 ["MessageNumber", "MessageTotal", "ScriptBlockText", "Path"]),
+    "Microsoft-Windows-Sysmon/Operational": ("Microsoft-Windows-Sysmon",
+                                             [1, 3, 11],
+                                             ["UtcTime", "ProcessGuid", "Image", "CommandLine", "User", "Hashes"]),
+}
+
+DEFAULT_MIX = "Security:60,System:20,Application:10,Microsoft-Windows-Sysmon/Operational:10"
+
+
+def parse_mix(mix: str):
+    """
+    Parse a channel mix, comma separated channel:weight
+    :param mix: Channel mix, for instance Security:70,System:30
+    :return: Dict of channel to weight
+    """
+    weights = {}
+    for item in mix.split(","):
+        channel, _, weight = item.strip().rpartition(":")
+        if channel not in CHANNELS:
+            raise ValueError("Unknown channel {channel}, choose from {channels}".format(channel=channel,
+                                                                                    channels=", ".join(CHANNELS)))
+        weights[channel] = float(weight)
+
+    return weights
+
+
+def generate_record(rand: random.Random, channel: str, record_id: int, epoch: float, padding: int):
+    """
+    Generate a record as output by evtx_dump
+    :param rand: Random generator
+    :param channel: Channel of the record
+    :param record_id: EventRecordID of the record
+    :param epoch: Time of the record
+    :param padding: Average size in bytes of the EventData values
+    :return: Dict of the record
+    """
+    provider, event_ids, names = CHANNELS[channel]
+    event_id = rand.choice(event_ids)
+    size = max(1, padding // len(names))
+    event_data = {name: "".join(rand.choice("abcdefghijklmnopqrstuvwxyz0123456789\\-. ")
+                                for _ in range(rand.randint(1, size * 2)))
+                  for name in names}
+    system_time = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(epoch)) + ".{:06d}Z".format(
+        int(epoch % 1 * 1000000))
+
+    return {"Event": {"#attributes": {"xmlns": "http://schemas.microsoft.com/win/2004/08/events/event"},
+                      "System": {"Provider": {"#attributes": {"Name": provider}},
+                                 # evtx_dump outputs the qualifiers as attributes of the EventID when set
+                                 "EventID": event_id if event_id % 2 else {"#attributes": {"Qualifiers": 16384},
+                                                                           "#text": event_id},
+                                 "Version": 0,
+                                 "Level": rand.choice([0, 2, 3, 4]),
+                                 "Task": 0,
+                                 "Keywords": "0x8020000000000000",
+                                 "TimeCreated": {"#attributes": {"SystemTime": system_time}},
+                                 "EventRecordID": record_id,
+                                 "Correlation": None,
+                                 "Execution": {"#attributes": {"ProcessID": rand.randint(4, 9999),
+                                                               "ThreadID": rand.randint(4, 9999)}},
+                                 "Channel": channel,
+                                 "Computer": "WKS-{:03d}.corp.local".format(rand.randint(0, 20)),
+                                 "Security": None},
+                      "EventData": event_data}}
+
+
+def generate_corpus(folder: Path, events: int, files: int, mix: dict, padding: int = 200, seed: int = 0,
+                    overlap: float = 0):
+    """
+    Write a corpus of JSONL files as converted by evtx_dump. Files are spread over the channels
+    of the mix, each file holding the records of one channel. With overlap, the first records of
+    each file are copied to a file of the same name in the vss sub-folder, as a log collected live
+    and from a VSS snapshot
+    :param folder: Folder of the JSONL files
+    :param events: Total number of records
+    :param files: Number of files
+    :param mix: Dict of channel to weight
+    :param padding: Average size in bytes of the EventData values of a record
+    :param seed: Seed of the generator
+    :param overlap: Share of the records of each file copied to another file
+    :return: Total size of the files in bytes
+    """
+    rand = random.Random(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    total_weight = sum(mix.values())
+    channels = list(mix)
+
+    size = 0
+    for index in range(files):
+        channel = channels[index % len(channels)]
+        # Share the records of the channel between its files
+        channel_files = len(range(index % len(channels), files, len(channels)))
+        count = int(events * mix[channel] / total_weight / channel_files)
+        epoch = 1592300000 + rand.random() * 86400 * 30
+
+        path = folder / "{channel}_{index}.json".format(channel=channel.replace("/", "%4"), index=index)
+        with open(path, "w") as fjson:
+            for record_id in range(1, count + 1):
+                epoch += rand.random()
+                fjson.write(json.dumps(generate_record(rand, channel, record_id, epoch, padding),
+                                       separators=(",", ":")))
+                fjson.write("\n")
+        size += path.stat().st_size
+
+        if overlap:
+            copy_path = folder / "vss" / path.name
+            copy_path.parent.mkdir(exist_ok=True)
+            with open(path, "r") as fjson, open(copy_path, "w") as fcopy:
+                fcopy.writelines(line for _, line in zip(range(int(count * overlap)), fjson))
+            size += copy_path.stat().st_size
+
+    return size
+
+
+def start_mock(fail_every: int = 0):
+    """
+    Start mock_splunk.py on a free port in its own process, so it does not share the GIL of the ingest
+    :param fail_every: If set, every nth HEC request is answered with a 503
+    :return: Tuple (process, port)
+    """
+    process = subprocess.Popen([sys.executable, str(Path(__file__).with_name("mock_splunk.py")), "--port", "0",
+                                "--fail_every", str(fail_every)],
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    port = int(process.stdout.readline().rsplit(":", 1)[1])
+
+    return process, port
+
+
+def peak_rss():
+    """
+    Return the peak RSS of the benchmark and of its terminated children, in MB
+    :return: Tuple (self, children), None if not available on the platform
+    """
+    if resource is None:
+        return None, None
+
+    # Linux reports KB, macOS bytes
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', default=None,
+                        help="Folder of the corpus. Generated if empty, reused otherwise. Default to a temporary folder")
+    parser.add_argument('-n', '--events', type=int, default=200000, help="Number of records of the corpus")
+    parser.add_argument('--files', type=int, default=8, help="Number of files of the corpus")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="Channels of the corpus with their weight. Available : " + ", ".join(CHANNELS))
+    parser.add_argument('--padding', type=int, default=200, help="Average size in bytes of the EventData of a record")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the generator")
+    parser.add_argument('--overlap', type=float, default=0,
+                        help="Share of the records of each file copied to another file, to benchmark --dedup")
+    parser.add_argument('--engine', choices=["thread", "process", "async"], default="thread", help="Ingestion engine")
+    parser.add_argument('--nb_process', type=int, default=cpu_count(), help="Number of ingest workers")
+    parser.add_argument('--batch_bytes', type=int, default=512000, help="Size of the HEC batches")
+    parser.add_argument('--hec_in_flight', type=int, default=4, help="Batches posted at the same time per process")
+    parser.add_argument('--no_adaptive', action="store_true", help="Keep the batch size and the concurrent requests")
+    parser.add_argument('--chunk_size', type=int, default=128, help="Size in MB above which a file is split")
+    parser.add_argument('--json_backend', choices=["auto"] + list(json_codec.BACKENDS), default="auto",
+                        help="JSON library decoding the records")
+    parser.add_argument('--resolve', action="store_true",
+                        help="Resolve the messages, needs evtx_data.db in the current folder")
+    parser.add_argument('--dedup', action="store_true", help="Drop the records already sent from another file")
+    parser.add_argument('--fail_every', type=int, default=0, help="Answer every nth HEC request with a 503")
+    parser.add_argument('--json', action="store_true", help="Print the results as JSON, to compare runs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        case_folder = Path(args.corpus) if args.corpus else Path(temp_folder)
+        json_folder = case_folder / "json_evtx"
+
+        start = time.perf_counter()
+        if not json_folder.exists() or not any(json_folder.rglob("*.json")):
+            generate_corpus(json_folder, args.events, args.files, parse_mix(args.mix), args.padding, args.seed,
+                            args.overlap)
+        generate_duration = time.perf_counter() - start
+        corpus_bytes = sum(path.stat().st_size for path in json_folder.rglob("*.json"))
+        # Records of the vss copies, all of them are dropped by the deduplication
+        copied = 0
+        for path in (json_folder / "vss").glob("*.json"):
+            with open(path, "rb") as fjson:
+                copied += sum(1 for _ in fjson)
+
+        mock, port = start_mock(args.fail_every)
+        try:
+            os.environ.update({"SPLUNK_URL": "127.0.0.1", "SPLUNK_SCHEME": "http", "SPLUNK_MPORT": str(port),
+                               "SPLUNK_HEC_PORT": str(port), "SPLUNK_USER": "admin", "SPLUNK_PASS": "changeme"})
+            os.environ.pop("SPLUNK_HEC_URLS", None)
+
+            e2s = Evtx2Splunk()
+            if not e2s.configure(index="evtx2splunk_bench", nb_ingestors=args.nb_process, testing=False,
+                                 no_resolve=not args.resolve, engine=args.engine, batch_bytes=args.batch_bytes,
+                                 hec_in_flight=args.hec_in_flight, chunk_size=args.chunk_size * 1024 * 1024,
+                                 json_backend=args.json_backend, hec_adaptive=not args.no_adaptive,
+                                 dedup=args.dedup, setup_cache=str(Path(temp_folder) / "setup.json")):
+                print("Unable to configure evtx2splunk against the mock server")
+                return 1
+
+            start = time.perf_counter()
+            e2s.ingest(input_files=str(case_folder), keep_cache=True, use_cache=True)
+            ingest_duration = time.perf_counter() - start
+
+            with urlopen("http://127.0.0.1:{port}/mock/stats".format(port=port)) as response:
+                received = json.load(response)
+
+            rss, children_rss = peak_rss()
+
+        finally:
+            mock.terminate()
+            mock.wait()
+
+    totals = e2s.metrics.totals()
+    results = {
+        "engine": args.engine,
+        "workers": args.nb_process,
+        "json_backend": json_codec.codec.name,
+        "corpus_mb": corpus_bytes / 1024 / 1024,
+        "generate_seconds": generate_duration,
+        "ingest_seconds": ingest_duration,
+        "events_sent": totals.get("events", 0),
+        "events_received": received["events"],
+        "events_per_second": totals.get("events", 0) / ingest_duration,
+        "mb_per_second": corpus_bytes / 1024 / 1024 / ingest_duration,
+        "peak_rss_mb": rss,
+        "peak_rss_workers_mb": children_rss if args.engine != "thread" else None,
+        "process_seconds": totals.get("process_seconds", 0),
+        "send_seconds": totals.get("send_seconds", 0),
+        "hec_request_seconds": totals.get("hec_request_seconds", 0),
+        "hec_requests": totals.get("hec_requests", 0),
+        "hec_rejected": received["rejected"],
+        "parse_errors": totals.get("parse_errors", 0),
+        "duplicates": totals.get("duplicates", 0),
+        "copied": copied,
+    }
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print("{events_sent} events ({corpus_mb:.1f}MB) with the {engine} engine, {workers} workers, "
+              "{json_backend}".format(**results))
+        print("Ingest    : {ingest_seconds:.3f}s, {events_per_second:,.0f} events/s, "
+              "{mb_per_second:.1f}MB/s".format(**results))
+        print("Stages    : read and decode {process_seconds:.3f}s, send {send_seconds:.3f}s, "
+              "HEC requests {hec_request_seconds:.3f}s over {hec_requests} requests "
+              "(cumulated over the workers)".format(**results))
+        if rss is not None:
+            print("Peak RSS  : {rss:.0f}MB{children}".format(
+                rss=rss, children=", workers {:.0f}MB".format(children_rss) if args.engine != "thread" else ""))
+        print("Received  : {events_received} events by the mock server, {hec_rejected} requests "
+              "rejected".format(**results))
+        if args.dedup:
+            print("Dedup     : {duplicates} duplicate events dropped out of {copied} copied".format(**results))
+
+    if args.dedup and results["duplicates"] != copied:
+        return 1
+
+    return 0 if results["events_received"] == results["events_sent"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(run())
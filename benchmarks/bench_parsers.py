@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Benchmark of the EVTX parsers, part of evtx2splunk
+    Compares the evtx_dump subprocess path, converting to a JSON file read back afterwards,
+    against the in-process evtx binding yielding the records directly
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from multiprocessing import cpu_count
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from evtxdump import pyevtx
+from evtxdump.cache import iter_lines
+from evtxdump.evtxdump import EvtxDump
+
+
+def bench_evtx_dump(evtx_files: list, evtx_dump: Path, jobs: int):
+    """
+    Convert the files with evtx_dump then read the JSON files, as done without --stream
+    :param evtx_files: List of EVTX files
+    :param evtx_dump: Path of the evtx_dump binary
+    :param jobs: Number of evtx_dump processes
+    :return: Tuple (number of records, conversion time, read time)
+    """
+    with tempfile.TemporaryDirectory() as output_folder:
+        dumper = EvtxDump(Path(output_folder), evtx_dump, jobs=jobs)
+
+        start = time.perf_counter()
+        dumper.convert(evtx_files)
+        convert_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        count = sum(1 for json_file in Path(output_folder).iterdir() for _ in iter_lines(json_file))
+        read_duration = time.perf_counter() - start
+
+    return count, convert_duration, read_duration
+
+
+def bench_pyevtx(evtx_files: list, jobs: int, chunks_per_job: int):
+    """
+    Parse the files in-process, as done by --parser pyevtx --stream
+    :param evtx_files: List of EVTX files
+    :param jobs: Number of parsing processes
+    :param chunks_per_job: Number of chunks parsed at once by a process
+    :return: Tuple (number of records, parse time)
+    """
+    parser = pyevtx.PyEvtxDump(jobs=jobs, chunks_per_job=chunks_per_job)
+    try:
+        start = time.perf_counter()
+        count = sum(1 for evtx_file in evtx_files for _ in parser.stream(evtx_file))
+        duration = time.perf_counter() - start
+    finally:
+        parser.close()
+
+    return count, duration
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', required=True, help="EVTX file or folder of EVTX files")
+    parser.add_argument('--evtx_dump', default="evtxdump/linux/x64/evtx_dump", help="Path of the evtx_dump binary")
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(), help="Number of processes of each parser")
+    parser.add_argument('--chunks_per_job', type=int, default=16, help="Number of chunks parsed at once by pyevtx")
+    args = parser.parse_args()
+
+    input_path = Path(args.input)
+    evtx_files = [input_path] if input_path.is_file() else [evtx for evtx in input_path.rglob("*.evtx*")
+                                                           if evtx.is_file()]
+    total_bytes = sum(evtx.stat().st_size for evtx in evtx_files)
+    print("{count} EVTX files, {size:.1f}MB".format(count=len(evtx_files), size=total_bytes / 1024 / 1024))
+
+    results = []
+    if Path(args.evtx_dump).exists():
+        count, convert_duration, read_duration = bench_evtx_dump(evtx_files, Path(args.evtx_dump), args.jobs)
+        duration = convert_duration + read_duration
+        results.append(duration)
+        print("evtx_dump : {count} records in {duration:.3f}s ({rate:,.0f}/s), "
+              "convert {convert:.3f}s + read {read:.3f}s".format(count=count, duration=duration,
+                                                                  rate=count / duration, convert=convert_duration,
+                                                                  read=read_duration))
+    else:
+        print("evtx_dump : {path} not found, skipped".format(path=args.evtx_dump))
+
+    if pyevtx.is_available():
+        count, duration = bench_pyevtx(evtx_files, args.jobs, args.chunks_per_job)
+        results.append(duration)
+        print("pyevtx    : {count} records in {duration:.3f}s ({rate:,.0f}/s)".format(count=count, duration=duration,
+                                                                                     rate=count / duration))
+    else:
+        print("pyevtx    : evtx python binding not installed, skipped")
+
+    if len(results) == 2:
+        print("Speedup   : x{speedup:.1f}".format(speedup=results[0] / results[1]))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Micro-benchmark of the SystemTime to epoch conversion, part of evtx2splunk
+    Compares the SystemTimeParser against the former strptime path
+"""
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from systemtime import SystemTimeParser
+
+
+def strptime_to_epoch(system_time: str):
+    """
+    Former conversion of evtx2splunk, kept as reference
+    :param system_time: SystemTime as output by evtx_dump
+    :return: Float epoch
+    """
+    try:
+        dt_obj = datetime.strptime(system_time, '%Y-%m-%dT%H:%M:%S.%fZ')
+    except ValueError:
+        dt_obj = datetime.strptime(system_time, '%Y-%m-%dT%H:%M:%SZ')
+
+    return dt_obj.replace(tzinfo=timezone.utc).timestamp()
+
+
+def generate_timestamps(count: int, seed: int = 0):
+    """
+    Generate SystemTimes as found in a log, increasing by a few milliseconds
+    with some of them without fractional part
+    :param count: Number of SystemTimes to generate
+    :param seed: Seed of the generator
+    :return: List of SystemTimes
+    """
+    rand = random.Random(seed)
+    current = datetime(2020, 6, 16, 12, 54, 38, tzinfo=timezone.utc).timestamp()
+    timestamps = []
+    for _ in range(count):
+        current += rand.random() / 50
+        dt_obj = datetime.fromtimestamp(current, tz=timezone.utc)
+        if rand.random() < 0.01:
+            timestamps.append(dt_obj.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        else:
+            timestamps.append(dt_obj.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+
+    return timestamps
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=2000000, help="Number of timestamps to convert")
+    args = parser.parse_args()
+
+    timestamps = generate_timestamps(args.count)
+
+    start = time.perf_counter()
+    reference = [strptime_to_epoch(system_time) for system_time in timestamps]
+    strptime_duration = time.perf_counter() - start
+
+    time_parser = SystemTimeParser()
+    start = time.perf_counter()
+    fast = [time_parser.to_epoch(system_time) for system_time in timestamps]
+    fast_duration = time.perf_counter() - start
+
+    if fast != reference:
+        print("Mismatch between the two conversions")
+        return 1
+
+    print("{count} timestamps".format(count=args.count))
+    print("strptime         : {duration:.3f}s ({rate:,.0f}/s)".format(duration=strptime_duration,
+                                                                      rate=args.count / strptime_duration))
+    print("SystemTimeParser : {duration:.3f}s ({rate:,.0f}/s)".format(duration=fast_duration,
+                                                                      rate=args.count / fast_duration))
+    print("Speedup          : x{speedup:.1f}".format(speedup=strptime_duration / fast_duration))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Local stand-in of a Splunk instance, part of evtx2splunk
+    Answers the management calls of SplunkHelper (HEC token and index creation) and the
+    HEC event and ack endpoints on the same port, without SSL. Received events are counted
+    and dropped. Point evtx2splunk to it with SPLUNK_URL=127.0.0.1 SPLUNK_SCHEME=http and
+    SPLUNK_MPORT, SPLUNK_HEC_PORT set to its port.
+"""
+
+import argparse
+import gzip
+import json
+import sys
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+TOKEN_URI = "/services/data/inputs/http/evtx2splunk"
+INDEX_URI = "/services/data/indexes"
+
+# Atom entry of the HEC token, as returned by the management port
+TOKEN_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:s="http://dev.splunk.com/ns/rest">
+  <entry>
+    <title>http://evtx2splunk</title>
+    <content type="text/xml">
+      <s:dict>
+        <s:key name="token">{token}</s:key>
+        <s:key name="indexes"><s:list>{indexes}</s:list></s:key>
+      </s:dict>
+    </content>
+  </entry>
+</feed>
+"""
+
+
+class MockSplunk(object):
+    """
+    State of the mock instance, shared by the request handlers
+    """
+
+    def __init__(self, fail_every: int = 0):
+        """
+        Init method of the MockSplunk
+        :param fail_every: If set, every nth HEC request is answered with a 503
+        """
+        self.lock = threading.Lock()
+        self.token = None
+        self.indexes = set()
+        self.token_indexes = []
+        self.fail_every = fail_every
+        self.next_ack = 0
+        self.stats = {"events": 0, "requests": 0, "bytes": 0, "rejected": 0}
+
+    def token_xml(self):
+        """
+        Return the Atom entry of the HEC token
+        :return: str
+        """
+        return TOKEN_XML.format(token=self.token,
+                                indexes="".join("<s:item>{index}</s:item>".format(index=index)
+                                                for index in self.token_indexes))
+
+
+def make_handler(splunk: MockSplunk):
+    """
+    Return the request handler class bound to a mock instance
+    :param splunk: MockSplunk state
+    :return: BaseHTTPRequestHandler subclass
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status: int, body: str = "", content_type: str = "text/xml"):
+            data = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_body(self):
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+            return data
+
+        def do_GET(self):
+            path = self.path.split("?")[0].rstrip("/")
+
+            if path == "/mock/stats":
+                with splunk.lock:
+                    self._reply(200, json.dumps(splunk.stats), "application/json")
+
+            elif path == "/services/data/inputs/http":
+                self._reply(200, "<feed/>")
+
+            elif path == TOKEN_URI:
+                with splunk.lock:
+                    if splunk.token is None:
+                        self._reply(404, "<response/>")
+                    else:
+                        self._reply(200, splunk.token_xml())
+
+            elif path.startswith(INDEX_URI + "/"):
+                with splunk.lock:
+                    known = path[len(INDEX_URI) + 1:] in splunk.indexes
+                self._reply(200 if known else 404, "<feed/>")
+
+            else:
+                self._reply(404, "<response/>")
+
+        def do_POST(self):
+            path = self.path.split("?")[0].rstrip("/")
+            body = self._read_body()
+
+            if path == "/services/collector/event":
+                self._collect(body)
+                return
+
+            if path == "/services/collector/ack":
+                acks = json.loads(body or b"{}").get("acks", [])
+                self._reply(200, json.dumps({"acks": {str(ack): True for ack in acks}}), "application/json")
+                return
+
+            form = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            with splunk.lock:
+                if path == "/services/data/inputs/http":
+                    splunk.token = splunk.token or str(uuid.uuid4())
+                    self._reply(201, splunk.token_xml())
+
+                elif path == TOKEN_URI:
+                    splunk.token_indexes = [index for index in form.get("indexes", "").split(",") if index]
+                    self._reply(200, splunk.token_xml())
+
+                elif path == INDEX_URI:
+                    splunk.indexes.add(form.get("name"))
+                    self._reply(201, "<feed/>")
+
+                else:
+                    self._reply(404, "<response/>")
+
+        def _collect(self, body: bytes):
+            # Answers of Splunk to an unknown token and to a request without events
+            if self.headers.get("Authorization") != "Splunk {token}".format(token=splunk.token):
+                self._reply(403, json.dumps({"text": "Invalid token", "code": 4}), "application/json")
+                return
+
+            if not body:
+                self._reply(400, json.dumps({"text": "No data", "code": 5}), "application/json")
+                return
+
+            with splunk.lock:
+                splunk.stats["requests"] += 1
+                if splunk.fail_every and splunk.stats["requests"] % splunk.fail_every == 0:
+                    splunk.stats["rejected"] += 1
+                    self._reply(503, json.dumps({"text": "Server is busy", "code": 9}), "application/json")
+                    return
+
+                # Events are newline separated by the batch builder
+                splunk.stats["events"] += body.count(b"\n")
+                splunk.stats["bytes"] += len(body)
+                splunk.next_ack += 1
+                ack_id = splunk.next_ack
+
+            self._reply(200, json.dumps({"text": "Success", "code": 0, "ackId": ack_id}), "application/json")
+
+    return Handler
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=8089, help="Port of the management and HEC endpoints")
+    parser.add_argument('--host', default="127.0.0.1", help="Address to listen on")
+    parser.add_argument('--fail_every', type=int, default=0, help="Answer every nth HEC request with a 503")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(MockSplunk(fail_every=args.fail_every)))
+    print("Mock Splunk listening on {host}:{port}".format(host=args.host, port=server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
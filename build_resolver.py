@@ -2,106 +2,175 @@
 # !/usr/bin/env python
 
 """
-    Prepare resolver json file for evtx2splunk
+    Prepare resolver database for evtx2splunk
         Based on Blardy work (https://github.com/blardy/evtx2elk)
 """
 
 import logging as log
 import argparse
+import os
 import sqlite3
 import re
 import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+
+QUERY_PROVIDER_DB = """
+SELECT DISTINCT database_filename, log_source FROM event_log_providers
+    INNER JOIN message_file_per_event_log_provider ON
+        message_file_per_event_log_provider.event_log_provider_key = event_log_providers.event_log_provider_key
+    INNER JOIN message_files ON
+        message_files.message_file_key = message_file_per_event_log_provider.message_file_key
+    ORDER BY database_filename, log_source
+"""
 
 
-class Resolver(object):
+def normalize_message(str_mess):
+    """ Convert a message string of winevt-kb into a template of evtx2splunk.
+    """
+    me = str_mess.replace('\n', '').replace('%n', '. ').replace('%t', ' ').replace('\r', ' ').replace(
+        '\t', ' ').rstrip()
+    return re.sub(r'%(\d+)', r'{\1}', me)
 
-    def __init__(self, database):
-        self.database = database
 
-        self.filename = database.split('/')[-1]
-        self.basename = './'
-        if len(database.split('/')[-1]) > 1:
-            self.basename = '/'.join(database.split('/')[:-1])
-            self.basename += '/'
+def read_message_tables(database_filename, lcids):
+    """ Read the message tables of a provider database for the given LCIDs.
+    Meant to run in a worker process. Rows are streamed from the cursors, not fetched at once.
+    :return: Tuple (database_filename, list of (lcid, eventid, message), duration)
+    """
+    start = time.time()
+    messages = []
 
-        self.database_conn = sqlite3.connect(database)
+    conn = sqlite3.connect('file:{}?mode=ro'.format(database_filename), uri=True)
+    try:
+        tables = [table for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
+                  if 'message_table_0x' in table]
 
-        self.database_cache_connectors = {
-            database: self.database_conn
-        }
-        self.cache = {}
+        for lcid in lcids:
+            prefix = 'message_table_0x{:08x}'.format(lcid)
 
-    def __del__(self):
-        for database, database_conn in self.database_cache_connectors.items():
-            database_conn.close()
+            for table in tables:
+                if not table.startswith(prefix):
+                    continue
 
-    def open_db(self, database):
-        """ Get a connection to the db from cache, open it otherwise.
-        """
-        conn = self.database_cache_connectors.get(database, False)
-        if not conn:
-            conn = sqlite3.connect(database)
-            self.database_cache_connectors[database] = conn
+                for str_eventid, str_mess in conn.execute(
+                        "SELECT message_identifier,message_string FROM {}".format(table)):
+                    messages.append((lcid, int(str_eventid, 0) & 0xFFFF, normalize_message(str_mess)))
+    finally:
+        conn.close()
 
-        return conn
+    return database_filename, messages, time.time() - start
 
-    def get_message_string(self, lcid=0x409):
-        try:
 
-            main_db = self.open_db(self.database)
+class Resolver(object):
 
-            QUERY_PROVIDER_DB = """
-            SELECT database_filename, log_source FROM event_log_providers  
-                INNER JOIN message_file_per_event_log_provider ON 
-                    message_file_per_event_log_provider.event_log_provider_key = event_log_providers.event_log_provider_key
-                INNER JOIN message_files ON 
-                    message_files.message_file_key = message_file_per_event_log_provider.message_file_key 
-            """
-            database_filenames = main_db.execute(QUERY_PROVIDER_DB).fetchall()
+    def __init__(self, database, jobs=None):
+        self.database = database
+        self.basename = os.path.dirname(database)
+        self.jobs = jobs or cpu_count()
+        self.timings = {}
 
+    def get_providers(self):
+        """ List the provider databases of the main database, with the log sources using each of them.
+        A database used by several log sources is only listed once.
+        """
+        main_db = sqlite3.connect(self.database)
+        try:
+            providers = {}
+            for database_filename, log_source in main_db.execute(QUERY_PROVIDER_DB):
+                database_path = os.path.join(self.basename, database_filename)
+                providers.setdefault(database_path, []).append(log_source)
+        finally:
+            main_db.close()
+
+        return providers
+
+    def get_message_string(self, lcids=(0x409,), output='evtx_data.db', output_json=False):
+        """ Extract the messages of the providers and write them into the output file.
+        By default the output is an indexed SQLite database, read on demand by evtx2splunk.
+        Provider databases are read in parallel by worker processes.
+        """
+        try:
+            start = time.time()
+            providers = self.get_providers()
+            self.timings['providers'] = time.time() - start
+            log.info('{} provider databases for {} log sources listed in {:.2f}s'.format(
+                len(providers), sum(len(log_sources) for log_sources in providers.values()),
+                self.timings['providers']))
+
+            # Distinct templates of each (lcid, log source, event id), in order of appearance
             evtx_bind = {}
-            for dfne in database_filenames:
-                log_source = dfne[1]
-
-                if log_source not in evtx_bind:
-                    evtx_bind[log_source] = {}
-
-                database_filename = self.basename + dfne[0]
-                provider_db = self.open_db(database_filename)
-                cursor = provider_db.cursor()
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-                tables = [table[0] for table in cursor.fetchall() if 'message_table_0x' in table[0]]
 
-                for table in tables:
-                    if not table.startswith('message_table_0x{:08x}'.format(lcid)):
-                        continue
-                    query_event_mess = "SELECT message_identifier,message_string FROM {}".format(table)
-                    message = provider_db.execute(query_event_mess).fetchall()
+            start = time.time()
+            read_time = 0
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                database_paths = [database_path for database_path in sorted(providers)
+                                  if os.path.exists(database_path)]
+
+                # Results are merged in the order of the databases, not as they complete, so the
+                # templates shared by several providers are always joined in the same order
+                for database_path, messages, duration in executor.map(read_message_tables, database_paths,
+                                                                      [lcids] * len(database_paths)):
+                    read_time += duration
+
+                    for log_source in providers[database_path]:
+                        for lcid, eventid, me in messages:
+                            templates = evtx_bind.setdefault((lcid, log_source, eventid), [])
+                            if me not in templates:
+                                templates.append(me)
+
+            self.timings['read'] = time.time() - start
+            log.info('{} messages read in {:.2f}s ({:.2f}s of worker time)'.format(
+                len(evtx_bind), self.timings['read'], read_time))
+
+            start = time.time()
+            if output_json:
+                self.write_json(evtx_bind, output, lcids[0])
+            else:
+                self.write_database(evtx_bind, output)
+            self.timings['write'] = time.time() - start
+            log.info('{} written in {:.2f}s'.format(output, self.timings['write']))
 
-                    for mess in message:
-                        str_mess = mess[1]
-                        str_eventid = mess[0]
-
-                        me = str_mess.replace('\n', '').replace('%n', '. ').replace('%t', ' ').encode("utf-8").decode(
-                            "utf-8").replace('\r', ' ').replace('\t', ' ').rstrip()
-                        me = re.sub(r'%(\d+)', r'{\1}', me)
-
-                        eventid = int(str_eventid, 0) & 0xFFFF
-
-                        if eventid in evtx_bind.get(log_source):
-                            if me != evtx_bind[log_source][eventid]:
-
-                                evtx_bind[log_source][eventid] = evtx_bind[log_source][eventid] + me
+        except Exception as e:
+            log.error('Unable to build {}. {}'.format(output, e))
+            return ''
 
-                        else:
-                            evtx_bind[log_source][eventid] = me
+    @staticmethod
+    def write_json(evtx_bind, output, lcid):
+        """ Write the messages of one LCID into the legacy JSON file.
+        """
+        messages = {}
+        for (message_lcid, log_source, eventid), templates in evtx_bind.items():
+            if message_lcid == lcid:
+                messages.setdefault(log_source, {})[eventid] = ''.join(templates)
 
-            with open('evtx_data.json', 'w', encoding='utf-8') as f:
-                json.dump(evtx_bind, f, ensure_ascii=False, indent=4)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(messages, f, ensure_ascii=False, indent=4)
 
-        except Exception as e:
-            print(e)
-            return ''
+    @staticmethod
+    def write_database(evtx_bind, output):
+        """ Write the messages into a SQLite database keyed by (lcid, provider, event id).
+        """
+        if os.path.exists(output):
+            os.remove(output)
+
+        conn = sqlite3.connect(output)
+        conn.execute("""
+            CREATE TABLE messages (
+                lcid INTEGER NOT NULL,
+                provider TEXT NOT NULL,
+                event_id INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                PRIMARY KEY (provider, event_id, lcid)
+            ) WITHOUT ROWID""")
+
+        conn.executemany("INSERT INTO messages (lcid, provider, event_id, message) VALUES (?, ?, ?, ?)",
+                         ((lcid, log_source, eventid, ''.join(templates))
+                          for (lcid, log_source, eventid), templates in evtx_bind.items()))
+        conn.commit()
+        conn.close()
 
 
 def run():
@@ -109,13 +178,26 @@ def run():
     argparser = argparse.ArgumentParser()
 
     argparser.add_argument('-d', '--database', required=True, help='Main winevt-kb database')
+    argparser.add_argument('-o', '--output', help='Output file. Default to evtx_data.db, or evtx_data.json with --json')
+    argparser.add_argument('--json', action='store_true', help='Write the legacy JSON file instead of the database')
+    argparser.add_argument('-l', '--lcid', action='append',
+                           help='LCID of the messages to extract, can be repeated. Default to 0x409 (en-US). '
+                                'Only the first one is written with --json')
+    argparser.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+                           help='Number of worker processes reading the provider databases')
 
     args = argparser.parse_args()
 
+    output = args.output or ('evtx_data.json' if args.json else 'evtx_data.db')
+    lcids = tuple(int(lcid, 0) for lcid in args.lcid) if args.lcid else (0x409,)
+
     # configure logging
-    resolver = Resolver(args.database)
-    resolver.get_message_string()
-    print("Done")
+    log.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=log.INFO)
+
+    start = time.time()
+    resolver = Resolver(args.database, jobs=args.jobs)
+    resolver.get_message_string(lcids=lcids, output=output, output_json=args.json)
+    print("Done in {:.2f}s".format(time.time() - start))
 
 if __name__ == '__main__':
     run()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Cross-file record deduplication, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import hashlib
+import math
+import multiprocessing
+import os
+import sqlite3
+from multiprocessing.sharedctypes import RawArray
+from pathlib import Path
+
+# Number of records the Bloom filter is sized for by default
+DEDUP_CAPACITY = 10000000
+
+# False positive rate of the Bloom filter at its capacity
+DEDUP_ERROR_RATE = 0.01
+
+# Number of records checked at once, the store being locked once per block
+DEDUP_BLOCK = 1024
+
+# Max number of bits set for each key. Each hash costs more than the few false
+# positives it saves, which only cost a lookup
+MAX_HASHES = 4
+
+# Max number of keys looked up in a single query
+_LOOKUP_SIZE = 500
+
+
+def record_key(computer: str, channel: str, record_id: int, epoch: float):
+    """
+    Return the key identifying a record whatever the file it was read from
+    :param computer: Computer of the record
+    :param channel: Channel of the record
+    :param record_id: EventRecordID of the record
+    :param epoch: Timestamp of the record, as returned by SystemTimeParser
+    :return: 16 bytes digest, None if the record has no ID or no timestamp
+    """
+    if record_id is None or epoch is None:
+        return None
+
+    return hashlib.blake2b("{}\x1f{}\x1f{}\x1f{!r}".format(computer, channel, record_id, epoch).encode(),
+                           digest_size=16).digest()
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of record keys. The bits are in shared memory, so the filter can be
+    used by worker processes started after it. It's not thread safe, the callers lock it
+    """
+
+    def __init__(self, size: int, hashes: int, bits: RawArray = None):
+        """
+        Init method of the BloomFilter
+        :param size: Number of bits
+        :param hashes: Number of bits set for each key
+        :param bits: Shared bits of an existing filter, if None the filter is empty
+        """
+        self._size = size
+        self._hashes = hashes
+        self.bits = bits if bits is not None else RawArray("B", (size + 7) // 8)
+        self._view = memoryview(self.bits).cast("B")
+
+    @classmethod
+    def from_capacity(cls, capacity: int, error_rate: float = DEDUP_ERROR_RATE):
+        """
+        Build an empty filter holding a number of keys with a false positive rate
+        :param capacity: Number of keys
+        :param error_rate: False positive rate once the filter holds capacity keys
+        :return: BloomFilter
+        """
+        size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        hashes = max(1, min(MAX_HASHES, int(round(size / capacity * math.log(2)))))
+
+        return cls(size, hashes)
+
+    @property
+    def size(self):
+        """
+        Number of bits of the filter
+        """
+        return self._size
+
+    @property
+    def hashes(self):
+        """
+        Number of bits set for each key
+        """
+        return self._hashes
+
+    def add(self, key: bytes):
+        """
+        Add a key to the filter. Its bits are picked by double hashing of its digest
+        :param key: Digest returned by record_key
+        :return: True if the key may have been added before, False if it was not
+        """
+        view = self._view
+        size = self._size
+        position = int.from_bytes(key[:8], "little") % size
+        step = (int.from_bytes(key[8:16], "little") | 1) % size
+
+        present = True
+        for _ in range(self._hashes):
+            byte = position >> 3
+            mask = 1 << (position & 7)
+            value = view[byte]
+            if not value & mask:
+                present = False
+                view[byte] = value | mask
+
+            position += step
+            if position >= size:
+                position -= size
+
+        return present
+
+
+class Deduplicator(object):
+    """
+    Drop the records already sent from another file, for instance the same log collected
+    live, from a VSS snapshot and as an archive.
+    Records are identified by record_key. A Bloom filter shared by all the workers answers
+    for most of them that they were never seen, and the keys are saved in a SQLite database
+    which is only queried when the filter says a key may have been seen. The filter stays
+    small in memory whatever the number of records, its false positives only costing a query.
+    A key seen from the same source is not a duplicate, so a file sent again after a failure
+    or with --resume is not dropped.
+    """
+
+    def __init__(self, path: Path, capacity: int = DEDUP_CAPACITY, reset: bool = False, bloom: BloomFilter = None,
+                 lock=None):
+        """
+        Init method of the Deduplicator
+        :param path: Path of the database of the keys
+        :param capacity: Number of records the Bloom filter is sized for
+        :param reset: Forget the records of the previous runs
+        :param bloom: Filter shared with the parent process, if None it's built from the database
+        :param lock: Lock shared with the parent process, if None a new one is created
+        """
+        self._path = path
+        self._pid = None
+        self._conn = None
+        self._sources = {}
+        self._lock = lock if lock is not None else multiprocessing.Lock()
+
+        if bloom is not None:
+            self._bloom = bloom
+            return
+
+        if reset:
+            self._remove()
+
+        self._bloom = BloomFilter.from_capacity(capacity)
+        for key, in self._connection().execute("SELECT key FROM records"):
+            self._bloom.add(key)
+
+    def settings(self):
+        """
+        Return the settings needed to share the deduplicator with a worker process.
+        Must be given to the process when it's started, as the filter and the lock can't be pickled after
+        :return: Dict of settings
+        """
+        return {
+            "path": self._path,
+            "size": self._bloom.size,
+            "hashes": self._bloom.hashes,
+            "bits": self._bloom.bits,
+            "lock": self._lock
+        }
+
+    @classmethod
+    def from_settings(cls, settings: dict):
+        """
+        Build a deduplicator sharing the filter and the lock of the parent process
+        :param settings: Dict of settings returned by settings
+        :return: Deduplicator
+        """
+        return cls(settings["path"], bloom=BloomFilter(settings["size"], settings["hashes"], settings["bits"]),
+                   lock=settings["lock"])
+
+    def _connection(self):
+        """
+        Return the database connection of the current process, connections can't be shared with forked processes
+        :return: sqlite3.Connection
+        """
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(str(self._path), timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # The keys are written once per block of records. Without sync, a system crash may
+            # lose or corrupt them, a new ingest without --resume starting a new database anyway
+            self._conn.execute("PRAGMA synchronous=OFF")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS records (
+                    key BLOB PRIMARY KEY,
+                    source INTEGER NOT NULL
+                ) WITHOUT ROWID""")
+            self._conn.commit()
+            self._sources = {}
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def _source_id(self, conn: sqlite3.Connection, source: str):
+        """
+        Return the ID of a source, sources are saved once rather than with each key
+        :param conn: Connection of the current process
+        :param source: Source of the records
+        :return: int
+        """
+        source_id = self._sources.get(source)
+        if source_id is None:
+            conn.execute("INSERT OR IGNORE INTO sources (name) VALUES (?)", (source,))
+            source_id, = conn.execute("SELECT id FROM sources WHERE name = ?", (source,)).fetchone()
+            self._sources[source] = source_id
+
+        return source_id
+
+    def check(self, keys: list, source: str):
+        """
+        Return which records of a block were already sent from another source, and remember the other ones
+        :param keys: Keys of the records, as returned by record_key. None keys are never duplicates
+        :param source: Source of the records
+        :return: List of bool, True if the record is a duplicate
+        """
+        with self._lock:
+            conn = self._connection()
+            source = self._source_id(conn, source)
+
+            new = {}
+            maybe_seen = []
+            for key in keys:
+                if key is None or key in new:
+                    continue
+
+                if self._bloom.add(key):
+                    maybe_seen.append(key)
+                else:
+                    new[key] = source
+
+            # Only the keys the filter may have seen are looked up
+            seen = {}
+            for start in range(0, len(maybe_seen), _LOOKUP_SIZE):
+                chunk = maybe_seen[start:start + _LOOKUP_SIZE]
+                seen.update(conn.execute("SELECT key, source FROM records WHERE key IN ({params})".format(
+                    params=",".join("?" * len(chunk))), chunk))
+
+            for key in maybe_seen:
+                if key not in seen:
+                    # False positive of the filter
+                    new[key] = source
+
+            if new:
+                conn.executemany("INSERT OR IGNORE INTO records (key, source) VALUES (?, ?)", new.items())
+            # Other processes wait for the write lock until the transaction ends
+            conn.commit()
+
+        return [key is not None and seen.get(key, source) != source for key in keys]
+
+    def close(self, remove: bool = False):
+        """
+        Close the database of the current process
+        :param remove: Remove the database, for instance when nothing else is kept on disk
+        :return: Nothing
+        """
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+        if remove:
+            self._remove()
+
+    def _remove(self):
+        """
+        Remove the database
+        :return: Nothing
+        """
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(str(self._path) + suffix)
+            except OSError:
+                pass
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Event filtering and field projection, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import fnmatch
+import json
+import re
+from pathlib import Path
+
+import json_codec
+
+# Keys of a filter file
+FILTER_KEYS = ("include", "exclude", "drop_fields", "keep_fields")
+
+# Keys of a rule, matched against the System fields
+RULE_KEYS = ("channel", "provider", "event_id")
+
+# Max number of (channel, provider, event id) decisions remembered
+DECISIONS_SIZE = 65536
+
+
+class StringMatcher(object):
+    """
+    Match a System field against a list of values, case insensitive. Values may hold
+    shell wildcards, for instance Microsoft-Windows-*
+    """
+
+    def __init__(self, values: list):
+        """
+        Init method of the StringMatcher
+        :param values: Values or patterns to match
+        """
+        self._exact = frozenset(value.lower() for value in values if not _has_wildcard(value))
+        patterns = [fnmatch.translate(value.lower()) for value in values if _has_wildcard(value)]
+        self._pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def __call__(self, value: str):
+        if value is None:
+            return False
+
+        value = value.lower()
+        return value in self._exact or (self._pattern is not None and self._pattern.match(value) is not None)
+
+
+class EventIdMatcher(object):
+    """
+    Match an event ID against a list of IDs and ranges, for instance [4624, "4660-4670"]
+    """
+
+    def __init__(self, values: list):
+        """
+        Init method of the EventIdMatcher
+        :param values: IDs as int and ranges as str
+        :raise ValueError: If a value is neither an ID nor a range
+        """
+        ids = set()
+        self._ranges = []
+        for value in values:
+            if isinstance(value, str) and "-" in value:
+                low, high = value.split("-", 1)
+                self._ranges.append((int(low), int(high)))
+            else:
+                ids.add(int(value))
+        self._ids = frozenset(ids)
+
+    def __call__(self, event_id: int):
+        if event_id is None:
+            return False
+
+        return event_id in self._ids or any(low <= event_id <= high for low, high in self._ranges)
+
+
+def _has_wildcard(value: str):
+    """
+    Return whether a value holds shell wildcards
+    :param value: Value of a rule
+    :return: True if it's a pattern
+    """
+    return any(char in value for char in "*?[")
+
+
+def compile_rule(rule: dict):
+    """
+    Compile a rule into matchers. A rule matches a record if all its keys match
+    :param rule: Dict with channel, provider and event_id keys, each one a value or a list of values
+    :return: Tuple of (index of the System field, matcher)
+    :raise ValueError: If the rule has an unknown key
+    """
+    matchers = []
+    for key, values in rule.items():
+        if key not in RULE_KEYS:
+            raise ValueError("Unknown filter rule key {key}, expected one of {keys}".format(key=key,
+                                                                                        keys=", ".join(RULE_KEYS)))
+
+        if not isinstance(values, list):
+            values = [values]
+
+        matcher = EventIdMatcher(values) if key == "event_id" else StringMatcher(values)
+        matchers.append((RULE_KEYS.index(key), matcher))
+
+    return tuple(matchers)
+
+
+class EventFilter(object):
+    """
+    Decide which records are sent, from their channel, provider and event ID, and project
+    the fields of the records sent.
+    A record is sent if it matches an include rule, or if there is none, and matches no exclude rule.
+    Decisions only depend on the System fields extracted by json_codec.system_fields, so filtered
+    records are never fully decoded. They are remembered for each (channel, provider, event ID)
+    as logs only hold a few of them.
+    Projection drops the drop_fields paths of the records, or keeps the keep_fields paths only.
+    It needs to decode and encode the records sent again, so it's slower than filtering.
+    """
+
+    def __init__(self, include: list = None, exclude: list = None, drop_fields: list = None,
+                 keep_fields: list = None):
+        """
+        Init method of the EventFilter
+        :param include: Rules of the records to send, all if empty
+        :param exclude: Rules of the records not to send
+        :param drop_fields: Dotted paths of the fields to remove from the records, for instance Event.#attributes
+        :param keep_fields: Dotted paths of the fields to keep in the records, the other ones being removed
+        :raise ValueError: If a rule is invalid or both drop_fields and keep_fields are set
+        """
+        if drop_fields and keep_fields:
+            raise ValueError("drop_fields and keep_fields can't be used together")
+
+        self._include = [compile_rule(rule) for rule in include or []]
+        self._exclude = [compile_rule(rule) for rule in exclude or []]
+        self._drop_fields = [path.split(".") for path in drop_fields or []]
+        self._keep_fields = [path.split(".") for path in keep_fields or []]
+        self._decisions = {}
+
+    @classmethod
+    def from_file(cls, path: Path):
+        """
+        Load a filter from a JSON file, for instance
+        {"include": [{"channel": "Security", "event_id": [4624, "4660-4670"]}],
+         "exclude": [{"provider": "Microsoft-Windows-Eventlog"}],
+         "drop_fields": ["Event.#attributes"]}
+        :param path: Path of the JSON file
+        :return: EventFilter
+        :raise ValueError: If the file is not a valid filter
+        """
+        with open(path, "r") as ffilter:
+            config = json.load(ffilter)
+
+        if not isinstance(config, dict):
+            raise ValueError("Filter file must hold an object")
+
+        for key in config:
+            if key not in FILTER_KEYS:
+                raise ValueError("Unknown filter key {key}, expected one of {keys}".format(key=key,
+                                                                                       keys=", ".join(FILTER_KEYS)))
+
+        return cls(**config)
+
+    @property
+    def projects(self):
+        """
+        Return whether the records are projected
+        :return: True if fields are dropped or kept
+        """
+        return bool(self._drop_fields or self._keep_fields)
+
+    def accept(self, channel: str, provider: str, event_id: int):
+        """
+        Return whether a record is sent
+        :param channel: Channel of the record
+        :param provider: Provider of the record
+        :param event_id: Event ID of the record
+        :return: True if the record is sent
+        """
+        key = (channel, provider, event_id)
+        decision = self._decisions.get(key)
+        if decision is None:
+            decision = ((not self._include or any(_matches(rule, key) for rule in self._include)) and
+                        not any(_matches(rule, key) for rule in self._exclude))
+
+            if len(self._decisions) >= DECISIONS_SIZE:
+                self._decisions.clear()
+            self._decisions[key] = decision
+
+        return decision
+
+    def project(self, record: dict):
+        """
+        Project the fields of a decoded record
+        :param record: Decoded record
+        :return: Projected record
+        """
+        if self._keep_fields:
+            projected = {}
+            for path in self._keep_fields:
+                value = record
+                for name in path:
+                    if not isinstance(value, dict) or name not in value:
+                        break
+                    value = value[name]
+                else:
+                    parent = projected
+                    for name in path[:-1]:
+                        parent = parent.setdefault(name, {})
+                    parent[path[-1]] = value
+            return projected
+
+        for path in self._drop_fields:
+            parent = record
+            for name in path[:-1]:
+                parent = parent.get(name) if isinstance(parent, dict) else None
+            if isinstance(parent, dict):
+                parent.pop(path[-1], None)
+
+        return record
+
+    def project_line(self, line: bytes):
+        """
+        Project the fields of a JSON record
+        :param line: Bytes of the JSON record
+        :return: Bytes of the projected record
+        :raise ValueError: If the record is not valid
+        """
+        return json_codec.dumps(self.project(json_codec.loads(line)))
+
+
+def _matches(rule: tuple, fields: tuple):
+    """
+    Return whether the System fields of a record match a compiled rule
+    :param rule: Matchers returned by compile_rule
+    :param fields: Tuple (channel, provider, event id)
+    :return: True if all the matchers match
+    """
+    return all(matcher(fields[index]) for index, matcher in rule)
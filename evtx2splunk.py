@@ -15,26 +15,43 @@ __author__ = "whitekernel - PAM"
 
 
 import argparse
-import json
+import gzip
+import io
 import time
 import os
 import logging as log
 import sys
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from datetime import datetime, timezone
 from functools import partial
 from glob import glob
+from itertools import islice
 from multiprocessing.dummy import Pool
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, Pool as ProcessPool
 from pathlib import Path
-from typing import TextIO
+from queue import Empty, Queue
+from typing import Iterable
 import tqdm
 
-from splunk_http_event_collector import http_event_collector
 from dotenv import load_dotenv
 
-from evtxdump.evtxdump import EvtxDump
-from splunk_helper import SplunkHelper
+from evtxdump import cache
+from evtxdump.cache import iter_lines
+from evtxdump.evtxdump import EvtxDump, find_collisions
+from evtxdump import pyevtx
+import json_codec
+from dedup import DEDUP_BLOCK, DEDUP_CAPACITY, Deduplicator, record_key
+from event_filter import EventFilter
+from hec_batch import HECBatchBuilder
+from hec_sender import HECSender
+from journal import CheckpointJournal, FileCheckpoint, hash_file
+from metrics import Metrics, MetricsServer, StatsFileWriter
+from scheduler import WorkItem, plan_work, work_queue
+from resolver import JSONResolver, MessageRenderer, RESOLVER_DB, RESOLVER_JSON, open_resolver
+from splunk_helper import SETUP_CACHE, SetupCache, SplunkHelper, check_hec_token, check_index
+from systemtime import SystemTimeParser
 
 
 LOG_FORMAT = '%(asctime)s %(levelname)s %(funcName)s: %(message)s'
@@ -47,6 +64,12 @@ LOG_VERBOSITY = {
 }
 log.basicConfig(format=LOG_FORMAT, level=log.INFO, datefmt='%Y-%m-%d %I:%M:%S')
 
+# Checkpoint journal, saved in the JSON cache folder
+JOURNAL_FILE = "evtx2splunk_journal.db"
+
+# Keys of the records sent, saved in the JSON cache folder when duplicates are dropped
+DEDUP_FILE = "evtx2splunk_dedup.db"
+
 
 class Evtx2Splunk(object):
     """
@@ -60,53 +83,190 @@ class Evtx2Splunk(object):
         """
         self._sh = None
         self._hec_server = None
+        self._hec_in_flight = 4
+        self._hec_compress = True
+        self._hec_ack = False
+        self._hec_balancing = "round_robin"
+        self._batch_bytes = 512000
+        self._batch_bytes_max = None
+        self._hec_adaptive = True
+        self._hec_retries = 8
+        self._modules = {}
         self._nb_ingestors = 1
         self._is_test = False
         self._resolve = True
-        self._resolver = {}
+        self._resolver = None
+        self._renderer = None
+        self._lcid = 0x409
+        self._evtxdump = None
+        self._stream = False
+        self._cache_folder = None
+        self._engine = "thread"
+        self._index = None
+        self._hec_token = None
+        self._journal = None
+        self._chunk_size = 128 * 1024 * 1024
+        self._convert_jobs = None
+        self._parser = "evtx_dump"
+        self._cache_compression = "none"
+        self._cache_format = "jsonl"
+        self._json_backend = "auto"
+        self._filter = None
+        self._dedup_capacity = 0
+        self._dedup = None
+        self._progress = None
+        self._time_parser = SystemTimeParser()
+        self.metrics = Metrics()
         self.myevent = []
 
-    def configure(self, index:str, nb_ingestors: int, testing: bool, no_resolve: bool):
+    def configure(self, index:str, nb_ingestors: int, testing: bool, no_resolve: bool, engine: str = "thread",
+                  batch_bytes: int = 512000, hec_in_flight: int = 4, hec_compress: bool = True, hec_ack: bool = False,
+                  hec_balancing: str = "round_robin", lcid: int = 0x409, chunk_size: int = 128 * 1024 * 1024,
+                  convert_jobs: int = None, parser: str = "evtx_dump", cache_compression: str = "none",
+                  cache_format: str = "jsonl", json_backend: str = "auto", filter_file: str = None,
+                  hec_adaptive: bool = True, batch_bytes_max: int = None, hec_retries: int = 8,
+                  refresh_setup: bool = False, setup_cache: str = SETUP_CACHE, dedup: bool = False,
+                  dedup_capacity: int = DEDUP_CAPACITY):
         """
         Configure the instance of SplunkHelper
         :param nb_ingestors: NB of ingestors to use
         :param testing: If yes, no file would be injected into splunk to preserve licenses
         :param index: Index where to push the files
         :param no_resolve: Disable Event ids resolution
+        :param engine: Ingestion engine, thread, process or async
+        :param batch_bytes: Size in bytes after which a batch of events is sent to HEC
+        :param hec_in_flight: Max number of batches posted at the same time, per ingest process
+        :param hec_compress: Gzip the batches sent to HEC
+        :param hec_ack: Wait for the indexer acknowledgement of the batches
+        :param hec_balancing: Distribution of the batches between the HEC endpoints, round_robin or least_outstanding
+        :param lcid: Language of the resolved messages
+        :param chunk_size: JSON files larger than this size are split so several workers can index them
+        :param convert_jobs: Number of evtx_dump processes running at the same time, default to the number of cores
+        :param parser: EVTX parser, evtx_dump or pyevtx for the in-process evtx binding
+        :param cache_compression: Compression of the JSON cache, none, gzip or zstd
+        :param cache_format: Format of the cache written by the conversion, jsonl or parquet
+        :param json_backend: JSON library decoding the records, auto for the fastest one installed
+        :param filter_file: JSON file of the rules selecting the events sent and of the fields projected
+        :param hec_adaptive: Adapt the size of the batches and the concurrent requests to the HEC feedback
+        :param batch_bytes_max: Max size of the batches when adaptive, default to 4 times batch_bytes
+        :param hec_retries: Number of retries after a backoff of a batch failing on every HEC endpoint
+        :param refresh_setup: Get the HEC token and register the index through the management port
+                              even if they are in the setup cache
+        :param setup_cache: Path of the file caching the HEC token and the indexes between runs
+        :param dedup: Drop the records already sent from another file
+        :param dedup_capacity: Number of records the in-memory filter of the deduplication is sized for
         :return: True if successfully configured else False
         """
         # Load the environment variables for .env
         load_dotenv()
 
         self._nb_ingestors = nb_ingestors
+        self._engine = engine
+        self._batch_bytes = batch_bytes
+        self._batch_bytes_max = batch_bytes_max or batch_bytes * 4
+        self._hec_adaptive = hec_adaptive
+        self._hec_retries = hec_retries
+        self._hec_in_flight = hec_in_flight
+        self._hec_compress = hec_compress
+        self._hec_ack = hec_ack
+        self._hec_balancing = hec_balancing
+        self._lcid = lcid
+        self._chunk_size = chunk_size
+        self._convert_jobs = convert_jobs
+        self._parser = parser
+        self._cache_compression = cache_compression
+        self._cache_format = cache_format
+        self._dedup_capacity = dedup_capacity if dedup else 0
+
+        if parser == "pyevtx" and not pyevtx.is_available():
+            log.error("The pyevtx parser needs the evtx python binding. Install it with pip install evtx")
+            return False
+
+        if cache_compression == "zstd" and cache.zstandard is None:
+            log.error("zstd compression needs the zstandard package. Install it with pip install zstandard")
+            return False
+
+        # pyarrow and aiohttp take most of the start time, they are only imported when used
+        if cache_format == "parquet":
+            from evtxdump import columnar
+            if not columnar.is_available():
+                log.error("Parquet cache needs pyarrow. Install it with pip install pyarrow")
+                return False
+
+        if engine == "async":
+            import async_engine
+            if not async_engine.is_available():
+                log.error("The async engine needs aiohttp. Install it with pip install aiohttp")
+                return False
+
+            if hec_ack or cache_format == "parquet":
+                log.error("The async engine supports neither --hec_ack nor the Parquet cache")
+                return False
+
+        try:
+            log.info("Decoding records with {name}".format(name=json_codec.use(json_backend).name))
+        except ValueError as e:
+            log.error(e)
+            return False
+        self._json_backend = json_backend
+
+        if filter_file:
+            try:
+                self._filter = EventFilter.from_file(filter_file)
+            except (OSError, ValueError, TypeError) as e:
+                log.error("Unable to load the filter file. {error}".format(error=e))
+                return False
+            log.info("Filtering events with {file}".format(file=filter_file))
 
         if no_resolve :
             log.info("Event ID resolution disabled")
             self._resolve = False
 
-        elif not Path("evtx_data.json").exists():
+        elif not Path(RESOLVER_DB).exists() and not Path(RESOLVER_JSON).exists():
             log.error("Event ID data file not found")
             log.error("Will without resolution")
             self._resolve = False
 
-        if self._resolve:
-            with open("evtx_data.json", "r") as fdata:
-                try:
-                    self._resolver = json.load(fdata)
-                except Exception as e:
-                    log.error("Unable to read event data file. Error {e}".format(e=e))
-                    return False
+        if self._resolve and not self._load_resolver():
+            return False
 
         self._is_test = testing
         if self._is_test:
             log.warning("Testing mode enabled. NO data will be injected into Splunk")
 
+        # The token and the index registered by a previous run are reused while the HEC accepts
+        # the token and the index still exists
+        setup_cache = SetupCache(setup_cache)
+        setup_key = SetupCache.key(splunk_url=os.getenv("SPLUNK_URL"),
+                                   splunk_port=os.getenv("SPLUNK_MPORT"),
+                                   username=os.getenv("SPLUNK_USER"),
+                                   scheme=os.getenv("SPLUNK_SCHEME", "https"))
+        setup = None if refresh_setup else setup_cache.get(setup_key)
+        if setup and index in setup["indexes"]:
+            ssl_verify = os.getenv("SPLUNK_SSL") == "True"
+            management_url = "{scheme}://{url}:{port}".format(scheme=os.getenv("SPLUNK_SCHEME", "https"),
+                                                              url=os.getenv("SPLUNK_URL"),
+                                                              port=os.getenv("SPLUNK_MPORT"))
+            if (check_hec_token(self.hec_endpoints()[0], setup["token"], ssl_verify=ssl_verify) and
+                    check_index(management_url, index, username=os.getenv("SPLUNK_USER"),
+                                password=os.getenv("SPLUNK_PASS"), ssl_verify=ssl_verify)):
+                log.info("HEC token and index {index} found in the setup cache".format(index=index))
+                self._index = index
+                self._hec_token = setup["token"]
+                self._init_hec_server()
+
+                return True
+
+            log.warning("HEC token or index {index} of the setup cache no longer valid".format(index=index))
+            setup_cache.forget(setup_key)
+
         log.info("Init SplunkHelper")
         self._sh = SplunkHelper(splunk_url=os.getenv("SPLUNK_URL"),
                                 splunk_port=os.getenv("SPLUNK_MPORT"),
                                 splunk_ssl_verify=os.getenv("SPLUNK_SSL") == "True",
                                 username=os.getenv("SPLUNK_USER"),
-                                password=os.getenv("SPLUNK_PASS"))
+                                password=os.getenv("SPLUNK_PASS"),
+                                scheme=os.getenv("SPLUNK_SCHEME", "https"))
 
         # The SplunkHelper instantiation holds a link_up
         # flag that indicated whether it could successfully reach
@@ -121,98 +281,182 @@ class Evtx2Splunk(object):
 
                 # Associate the index to the HEC token so the script can send
                 # the logs to it
-                self._sh.register_index_to_hec(index=index)
+                if self._sh.register_index_to_hec(index=index) and hect:
+                    setup_cache.save(setup_key, hect, self._sh.hec_indexes)
 
-                # Instantiate HEC class and configure
-                self._hec_server = http_event_collector(token=hect,
-                                                        http_event_server=os.getenv("SPLUNK_URL"))
-                self._hec_server.http_event_server_ssl = True
-                self._hec_server.index = index
-                self._hec_server.input_type = "json"
-                self._hec_server.popNullFields = True
+                self._index = index
+                self._hec_token = hect
+                self._init_hec_server()
 
                 return True
 
         return False
 
-    def send_jevtx_file_to_splunk(self, records_stream: TextIO, source: str, sourcetype: str):
+    def _load_resolver(self):
+        """
+        Load the event ID messages produced by build_resolver
+        :return: True if successfully loaded else False
+        """
+        try:
+            self._resolver = open_resolver(lcid=self._lcid)
+        except Exception as e:
+            log.error("Unable to read event data file. Error {e}".format(e=e))
+            return False
+
+        if self._resolver is None:
+            return False
+
+        if isinstance(self._resolver, JSONResolver):
+            log.warning("Using the legacy {json} file. Run build_resolver again to build the faster {db}".format(
+                json=RESOLVER_JSON, db=RESOLVER_DB))
+
+        self._renderer = MessageRenderer(self._resolver)
+        return True
+
+    def _init_hec_server(self):
+        """
+        Instantiate the HEC sender from the token retrieved during the configuration
+        :return: Nothing
+        """
+        self._hec_server = HECSender(urls=self.hec_endpoints(),
+                                     token=self._hec_token,
+                                     ssl_verify=os.getenv("SPLUNK_SSL") == "True",
+                                     max_in_flight=self._hec_in_flight,
+                                     compress=self._hec_compress,
+                                     use_ack=self._hec_ack,
+                                     balancing=self._hec_balancing,
+                                     metrics=self.metrics,
+                                     batch_bytes=self._batch_bytes,
+                                     max_batch_bytes=self._batch_bytes_max,
+                                     adaptive=self._hec_adaptive,
+                                     max_retries=self._hec_retries)
+
+    @staticmethod
+    def hec_endpoints():
+        """
+        Return the URLs of the HEC endpoints. SPLUNK_HEC_URLS lists the endpoints as
+        comma separated host:port, else the HEC of SPLUNK_URL is used. Endpoints without
+        scheme use SPLUNK_SCHEME, https by default
+        :return: List of URLs
+        """
+        scheme = os.getenv("SPLUNK_SCHEME", "https")
+        hec_urls = os.getenv("SPLUNK_HEC_URLS")
+        if not hec_urls:
+            return ["{scheme}://{url}:{port}".format(scheme=scheme,
+                                                     url=os.getenv("SPLUNK_URL"),
+                                                     port=os.getenv("SPLUNK_HEC_PORT", "8088"))]
+
+        endpoints = []
+        for hec_url in hec_urls.split(","):
+            hec_url = hec_url.strip()
+            if not hec_url:
+                continue
+            if "://" not in hec_url:
+                hec_url = scheme + "://" + hec_url
+            endpoints.append(hec_url)
+
+        return endpoints
+
+    def worker_settings(self):
+        """
+        Return the settings needed to rebuild an ingestor in another process.
+        Clients and resolver are not shared, each worker process builds its own
+        :return: Dict of settings
+        """
+        return {
+            "index": self._index,
+            "hec_token": self._hec_token,
+            "batch_bytes": self._batch_bytes,
+            "batch_bytes_max": self._batch_bytes_max,
+            "hec_adaptive": self._hec_adaptive,
+            "hec_retries": self._hec_retries,
+            "hec_in_flight": self._hec_in_flight,
+            "hec_compress": self._hec_compress,
+            "hec_ack": self._hec_ack,
+            "hec_balancing": self._hec_balancing,
+            "is_test": self._is_test,
+            "resolve": self._resolve,
+            "lcid": self._lcid,
+            "json_backend": self._json_backend,
+            "filter": self._filter,
+            "dedup": self._dedup.settings() if self._dedup else None,
+            "stream": self._stream,
+            "cache_folder": self._cache_folder,
+            "evtxdump": self._evtxdump,
+            "journal": self._journal.path if self._journal else None
+        }
+
+    @classmethod
+    def from_worker_settings(cls, settings: dict):
+        """
+        Build an ingestor from the settings of the parent process
+        :param settings: Dict of settings returned by worker_settings
+        :return: Evtx2Splunk instance ready to ingest
+        """
+        e2s = cls()
+        e2s._index = settings["index"]
+        e2s._hec_token = settings["hec_token"]
+        e2s._batch_bytes = settings["batch_bytes"]
+        e2s._batch_bytes_max = settings["batch_bytes_max"]
+        e2s._hec_adaptive = settings["hec_adaptive"]
+        e2s._hec_retries = settings["hec_retries"]
+        e2s._hec_in_flight = settings["hec_in_flight"]
+        e2s._hec_compress = settings["hec_compress"]
+        e2s._hec_ack = settings["hec_ack"]
+        e2s._hec_balancing = settings["hec_balancing"]
+        e2s._is_test = settings["is_test"]
+        e2s._resolve = settings["resolve"]
+        e2s._json_backend = settings["json_backend"]
+        json_codec.use(e2s._json_backend)
+        e2s._filter = settings["filter"]
+        e2s._dedup = Deduplicator.from_settings(settings["dedup"]) if settings["dedup"] else None
+        e2s._lcid = settings["lcid"]
+        e2s._stream = settings["stream"]
+        e2s._cache_folder = settings["cache_folder"]
+        e2s._evtxdump = settings["evtxdump"]
+        if settings["journal"]:
+            e2s._journal = CheckpointJournal(settings["journal"])
+
+        if e2s._resolve and not e2s._load_resolver():
+            e2s._resolve = False
+
+        e2s._init_hec_server()
+        return e2s
+
+    def send_jevtx_file_to_splunk(self, records_stream: Iterable, source: str, sourcetype: str,
+                                  checkpoint: FileCheckpoint = None):
         """
         From a record stream - aka file json stream - read and update the stream with enhanced data
         then push to splunk
-        :param records_stream: TextIO - Input JSON stream to index
+        :param records_stream: Iterable - Input JSON stream to index, one record per line
         :param source: Str representing the source indexed as in the Splunk sense
         :param sourcetype: Str representing the source type to index - always JSON here
-        :param source_size: Size of the input file
+        :param checkpoint: If set, the progress is saved in the checkpoint. The stream must start at its offset
         :return: True if the indexing was successfully else False
         """
 
         try:
             if records_stream is not None:
 
-                is_host_set = False
-
-                # Prepare Splunk payload to send
-                payload = {}
-                payload.update({"source": source})
-                payload.update({"sourcetype": sourcetype})
+                # Events are written around the raw record bytes then sent by
+                # batches to the Splunk HEC endpoint
+                batch = HECBatchBuilder(sink=self._send_batch, max_bytes=self._next_batch_bytes,
+                                        checkpoint=checkpoint)
+                start_offset = checkpoint.offset if checkpoint else 0
+                start = time.perf_counter()
 
-                # Send batch of events it will be handled consecutively
-                # and sent to the Splunk HEC endpoint
+                offset, parse_errors, filtered = self.add_records(records_stream, batch, source, sourcetype,
+                                                                  offset=start_offset)
 
-                for record_line in records_stream:
+                batch.flush()
+                success = batch.wait()
+                self._record_metrics(source, batch, bytes_read=offset - start_offset, parse_errors=parse_errors,
+                                     filtered=filtered, duration=time.perf_counter() - start)
 
-                    try:
-                        record = json.loads(record_line)
-                    except ValueError:
-                        continue
+                if checkpoint:
+                    checkpoint.complete(success, offset)
 
-                    if is_host_set is False:
-                        payload.update({"host": record["Event"]["System"]["Computer"]})
-                        is_host_set = True
-
-                    # Must convert the timestamp in epoch format... seconds.milliseconds
-                    # examples evtx time "2020-06-16T12:54:38.766579Z" "'%Y-%m-%dT%H:%M:%S.%fZ'
-                    # But sometimes, milliseconds are not present
-                    try:
-                        dt_obj = datetime.strptime(
-                            record["Event"]["System"]["TimeCreated"]["#attributes"]["SystemTime"],
-                            '%Y-%m-%dT%H:%M:%S.%fZ')
-                    except:
-                        dt_obj = datetime.strptime(
-                            record["Event"]["System"]["TimeCreated"]["#attributes"]["SystemTime"],
-                            '%Y-%m-%dT%H:%M:%SZ')
-
-                    try:
-
-                        # Splunk does not want microseconds but it can be sent anyway
-                        dt_obj = dt_obj.replace(tzinfo=timezone.utc)
-                        epoch = dt_obj.timestamp()
-
-                    except Exception as e:
-                        log.warning("Timestamp warning. {error}".format(error=e))
-                        log.warning("Falling back to default")
-                        # Use case for NTFS : 1601-01-01 00:00:00.000
-                        dt_obj = datetime.now()
-                        dt_obj = dt_obj.replace(tzinfo=timezone.utc)
-                        epoch = dt_obj.timestamp()
-
-                    record["module"] = record["Event"]["System"]["Channel"]
-
-                    if self._resolve:
-                        message = self.format_resolve(record)
-                        if message:
-                            record["message"] = message
-                            
-                    payload.update({"time": epoch})
-                    payload.update({"event": record})
-
-                    # Finally send the stream
-                    if not self._is_test:
-                        self._hec_server.batchEvent(payload)
-                    else:
-                        log.debug("Test mode. Would have injected : {payload}".format(payload=payload))
-
-                return True
+                return success
 
             else:
                 return False
@@ -221,36 +465,355 @@ class Evtx2Splunk(object):
             log.warning(e)
             return False
 
-    def format_resolve(self, record):
+    def add_records(self, records_stream: Iterable, batch: HECBatchBuilder, source: str, sourcetype: str,
+                    offset: int = 0):
         """
-        Return a formatted string of the record if formatting is available
-        :param record: Record to format
-        :return: Formatted string of the record
+        Add the records of a stream to a batch builder, with their timestamp, module and resolved message
+        :param records_stream: Iterable - Input JSON stream to index, one record per line
+        :param batch: HECBatchBuilder receiving the events
+        :param source: Str representing the source indexed as in the Splunk sense
+        :param sourcetype: Str representing the source type to index - always JSON here
+        :param offset: Offset of the first record in its file
+        :return: Tuple (offset following the last record, records not decoded, records filtered out)
+        """
+        parse_errors = 0
+        filtered = 0
+        # Records waiting for the duplicates check, made by blocks
+        pending = []
+
+        for record_line in records_stream:
+
+            offset += len(record_line)
+            try:
+                # Only the System fields are needed, the record itself is sent as is
+                system = json_codec.system_fields(record_line)
+            except ValueError:
+                parse_errors += 1
+                continue
+
+            # Filtered records are dropped before being decoded any further
+            if self._filter is not None and not self._filter.accept(system.channel, system.provider,
+                                                                    system.event_id):
+                filtered += 1
+                continue
+
+            # Must convert the timestamp in epoch format... seconds.milliseconds
+            # examples evtx time "2020-06-16T12:54:38.766579Z"
+            # But sometimes, milliseconds are not present
+            try:
+                epoch = self._time_parser.to_epoch(system.system_time)
+
+            except (ValueError, TypeError) as e:
+                log.warning("Timestamp warning. {error}".format(error=e))
+                log.warning("Falling back to default")
+                dt_obj = datetime.now()
+                dt_obj = dt_obj.replace(tzinfo=timezone.utc)
+                epoch = dt_obj.timestamp()
+
+            if self._dedup is None:
+                if not self._add_record(batch, record_line, system, epoch, offset, source, sourcetype):
+                    parse_errors += 1
+                continue
+
+            # Duplicates are checked by blocks, so the shared store is locked once per block
+            pending.append((record_line, system, epoch, offset))
+            if len(pending) >= DEDUP_BLOCK:
+                parse_errors += self._add_unique_records(batch, pending, source, sourcetype)
+                pending = []
+
+        if pending:
+            parse_errors += self._add_unique_records(batch, pending, source, sourcetype)
+
+        return offset, parse_errors, filtered
+
+    def _add_record(self, batch: HECBatchBuilder, record_line: bytes, system: json_codec.SystemFields,
+                    epoch: float, offset: int, source: str, sourcetype: str):
         """
+        Add a decoded record to a batch builder, with its module and resolved message
+        :param batch: HECBatchBuilder receiving the event
+        :param record_line: Bytes of the JSON record
+        :param system: System fields of the record
+        :param epoch: Timestamp of the record
+        :param offset: Offset following the record in its file
+        :param source: Str representing the source indexed as in the Splunk sense
+        :param sourcetype: Str representing the source type to index - always JSON here
+        :return: True if added, False if the record is not valid
+        """
+        if batch.count == 0:
+            batch.set_metadata(host=system.computer,
+                               source=source,
+                               sourcetype=sourcetype,
+                               index=self._index)
+
+        extra = self._encode_module(system.channel)
+
+        if self._resolve:
+            message = self.format_resolve(system, record_line)
+            if message:
+                extra += HECBatchBuilder.encode_field("message", message)
+
+        try:
+            raw = record_line if isinstance(record_line, bytes) else record_line.encode()
+            if self._filter is not None and self._filter.projects:
+                raw = self._filter.project_line(raw)
+            batch.add(raw, epoch, extra, offset=offset)
+        except ValueError:
+            return False
+
+        return True
+
+    def _add_unique_records(self, batch: HECBatchBuilder, pending: list, source: str, sourcetype: str):
+        """
+        Add the records of a block which were not already sent from another file
+        :param batch: HECBatchBuilder receiving the events
+        :param pending: List of tuples (record line, System fields, epoch, offset)
+        :param source: Str representing the source indexed as in the Splunk sense
+        :param sourcetype: Str representing the source type to index - always JSON here
+        :return: Number of records not valid
+        """
+        keys = [record_key(system.computer, system.channel, system.record_id, epoch)
+                for _, system, epoch, _ in pending]
+        errors = 0
+        for record, duplicate in zip(pending, self._check_duplicates(keys, source)):
+            if not duplicate and not self._add_record(batch, *record, source=source, sourcetype=sourcetype):
+                errors += 1
+
+        return errors
+
+    def _check_duplicates(self, keys: list, source: str):
+        """
+        Check a block of records against the records already sent and count the duplicates
+        :param keys: Keys of the records, as returned by record_key
+        :param source: Source of the records
+        :return: List of bool, True if the record is a duplicate
+        """
+        duplicates = self._dedup.check(keys, source)
+        self.metrics.inc("duplicates", sum(duplicates), file=source)
+
+        return duplicates
+
+    def encode_block(self, block: bytes, offset: int, source: str, sourcetype: str, max_bytes: int = None):
+        """
+        Build the HEC batches of a block of records, without sending them. CPU stage of the async engine
+        :param block: Bytes of JSONL records, ending on a line boundary
+        :param offset: Offset of the block in its file
+        :param source: Str representing the source indexed as in the Splunk sense
+        :param sourcetype: Str representing the source type to index - always JSON here
+        :param max_bytes: Size of the batches, default to batch_bytes
+        :return: Tuple (list of (payload, offset following its last record), counters of the metrics)
+        """
+        payloads = []
+        batch = HECBatchBuilder(sink=lambda payload: payloads.append((payload, batch.offset)) or True,
+                                max_bytes=max_bytes or self._batch_bytes)
+        start = time.perf_counter()
+
+        end, parse_errors, filtered = self.add_records(io.BytesIO(block), batch, source, sourcetype, offset=offset)
+        batch.flush()
+
+        if self._hec_compress:
+            payloads = [(gzip.compress(payload, compresslevel=1), payload_offset)
+                        for payload, payload_offset in payloads]
+
+        self._record_metrics(source, batch, bytes_read=end - offset, parse_errors=parse_errors,
+                             filtered=filtered, duration=time.perf_counter() - start)
+
+        return payloads, self.metrics.drain()
+
+    def send_columnar_file_to_splunk(self, parquet_file: Path, source: str, sourcetype: str,
+                                     checkpoint: FileCheckpoint = None):
+        """
+        Push the records of a Parquet cache to splunk. The System fields are already typed
+        columns, so neither the records nor their timestamps are parsed
+        :param parquet_file: Path of the Parquet file
+        :param source: Str representing the source indexed as in the Splunk sense
+        :param sourcetype: Str representing the source type to index - always JSON here
+        :param checkpoint: If set, the progress is saved in the checkpoint. Offsets are record indexes
+        :return: True if the indexing was successfully else False
+        """
+        from evtxdump import columnar
+
         try:
-            provider = record["Event"]["System"]["Provider"]["#attributes"]["Name"]
-            event_id = record["Event"]["System"]["EventID"]
+            is_host_set = False
+
+            batch = HECBatchBuilder(sink=self._send_batch, max_bytes=self._next_batch_bytes,
+                                    checkpoint=checkpoint)
+            offset = checkpoint.offset if checkpoint else 0
+            bytes_read = 0
+            parse_errors = 0
+            filtered = 0
+            start = time.perf_counter()
+
+            rows = columnar.iter_rows(parquet_file, start=offset)
+            if self._dedup is not None:
+                rows = self._flag_duplicate_rows(rows, source)
+            else:
+                rows = ((row, False) for row in rows)
+
+            for (raw, epoch, computer, channel, provider, event_id, _, insertions), duplicate in rows:
+                offset += 1
+                bytes_read += len(raw)
+
+                if self._filter is not None and not self._filter.accept(channel, provider, event_id):
+                    filtered += 1
+                    continue
 
-            if type(event_id) == dict:
-                event_id = record["Event"]["System"]["EventID"]["#text"]
+                if duplicate:
+                    continue
 
-            if provider in self._resolver:
+                if is_host_set is False:
+                    batch.set_metadata(host=computer,
+                                       source=source,
+                                       sourcetype=sourcetype,
+                                       index=self._index)
+                    is_host_set = True
 
-                if self._resolver[provider].get(str(event_id)):
-                    message = self._resolver[provider].get(str(event_id))
-                    return message
+                if epoch is None:
+                    dt_obj = datetime.now()
+                    dt_obj = dt_obj.replace(tzinfo=timezone.utc)
+                    epoch = dt_obj.timestamp()
+
+                extra = self._encode_module(channel)
+
+                if self._resolve and provider is not None and event_id is not None:
+                    message = self._renderer.render_strings(provider, event_id, insertions)
+                    if message:
+                        extra += HECBatchBuilder.encode_field("message", message)
+
+                try:
+                    if self._filter is not None and self._filter.projects:
+                        raw = self._filter.project_line(raw)
+                    batch.add(raw, epoch, extra, offset=offset)
+                except ValueError:
+                    parse_errors += 1
+                    continue
+
+            batch.flush()
+            success = batch.wait()
+            self._record_metrics(source, batch, bytes_read=bytes_read, parse_errors=parse_errors,
+                                 filtered=filtered, duration=time.perf_counter() - start)
+
+            if checkpoint:
+                checkpoint.complete(success, offset)
+
+            return success
+
+        except Exception as e:
+            log.warning(e)
+            return False
+
+    def _flag_duplicate_rows(self, rows: Iterable, source: str):
+        """
+        Flag the rows of a Parquet cache already sent from another file. Rows are checked by blocks,
+        so the shared store is locked once per block. Rows dropped by the filter are never duplicates
+        :param rows: Generator returned by columnar.iter_rows
+        :param source: Str representing the source indexed as in the Splunk sense
+        :return: Generator of tuples (row, True if the row is a duplicate)
+        """
+        for block in iter(lambda: list(islice(rows, DEDUP_BLOCK)), []):
+            keys = [record_key(computer, channel, record_id, epoch)
+                    if self._filter is None or self._filter.accept(channel, provider, event_id) else None
+                    for _, epoch, computer, channel, provider, event_id, record_id, _ in block]
+
+            yield from zip(block, self._check_duplicates(keys, source))
+
+    def _record_metrics(self, source: str, batch: HECBatchBuilder, bytes_read: int, parse_errors: int,
+                        filtered: int, duration: float):
+        """
+        Add the counters of a sent work item to the metrics. The time not spent sending
+        the batches is the time spent reading and decoding the records
+        :param source: Source of the records, labels the counters
+        :param batch: HECBatchBuilder which sent the records
+        :param bytes_read: Size of the records read
+        :param parse_errors: Number of records which could not be decoded
+        :param filtered: Number of records dropped by the filter
+        :param duration: Time spent reading and sending the records
+        :return: Nothing
+        """
+        self.metrics.add({"events": batch.count,
+                          "bytes_read": bytes_read,
+                          "parse_errors": parse_errors,
+                          "filtered": filtered,
+                          "batches": batch.batches,
+                          "batch_bytes": batch.batch_bytes,
+                          "process_seconds": duration - batch.send_seconds,
+                          "send_seconds": batch.send_seconds}, file=source)
+
+    def _record_conversions(self):
+        """
+        Add the conversions done by the EVTX parser to the metrics
+        :return: Nothing
+        """
+        for result in self._evtxdump.results:
+            self.metrics.add({"convert_files": 1 if result.success else 0,
+                              "convert_errors": 0 if result.success else 1,
+                              "convert_seconds": result.duration,
+                              "convert_bytes": result.bytes_in}, file=result.evtx_file.name)
+        self._evtxdump.results = []
+
+    def _encode_module(self, channel: str):
+        """
+        Return the encoded module field of a channel, ready to be spliced in the events
+        :param channel: Channel of the record
+        :return: Bytes of the module field
+        """
+        module = self._modules.get(channel)
+        if module is None:
+            module = HECBatchBuilder.encode_field("module", channel)
+            self._modules[channel] = module
+
+        return module
+
+    def _next_batch_bytes(self):
+        """
+        Return the size of the next batch, as advised by the HEC sender
+        :return: Size in bytes
+        """
+        return self._hec_server.batch_bytes
+
+    def _send_batch(self, payload: bytes):
+        """
+        Queue a batch of events to the HEC endpoint
+        :param payload: Bytes of the batch as built by HECBatchBuilder
+        :return: Future of the batch, True in test mode
+        """
+        if self._is_test:
+            log.debug("Test mode. Would have injected : {payload}".format(payload=payload))
+            return True
+
+        return self._hec_server.send(payload)
+
+    def format_resolve(self, system: json_codec.SystemFields, record_line: bytes):
+        """
+        Return a formatted string of the record if formatting is available.
+        The insertion strings of the message are filled with the EventData of the record,
+        which is only decoded if the message has insertion strings
+        :param system: System fields of the record
+        :param record_line: Bytes of the JSON record
+        :return: Formatted string of the record
+        """
+        if system.provider is None or system.event_id is None:
+            return ""
+
+        try:
+            return self._renderer.render_record(system.provider, system.event_id,
+                                                lambda: json_codec.loads(record_line)["Event"])
 
         except Exception as e:
             log.error(e)
 
         return ""
 
-    def ingest(self, input_files: str, keep_cache: bool, use_cache: bool):
+    def ingest(self, input_files: str, keep_cache: bool, use_cache: bool, stream: bool = False,
+               resume: bool = False, incremental: bool = False):
         """
         Main function of the class. List the files, call the converter
         and then multiprocess the input.
         :param input_files: Path to a file or a folder to ingest
         :param keep_cache: Set to true to keep json temporary folder at the end of the process
+        :param use_cache: Set to true to index the cached files instead of converting the EVTX
+        :param stream: Set to true to index the records while they are converted
+        :param resume: Set to true to resume a previous ingest of the cached files
+        :param incremental: Set to true to only convert and index the EVTX files not indexed by a previous run
         :return: Nothing
         """
         # Get the folder to index
@@ -269,74 +832,346 @@ class Evtx2Splunk(object):
             log.error("Input is neither a file or a directory")
             return
 
-        if not use_cache:
-            log.info("Starting EVTX conversion. Nothing will be output until the end of conversion")
-            if sys.platform == "win32":
-                evtxdump = EvtxDump(output_folder, Path("evtxdump/windows/x64/evtx_dump.exe"),
-                                    fdfind="evtxdump/windows/x64/fd.exe")
+        self._evtxdump = self._get_evtxdump(output_folder, self._convert_jobs, self._parser,
+                                            self._cache_compression, self._cache_format,
+                                            input_root=input_folder if input_folder.is_dir() else input_folder.parent)
+
+        if resume:
+            # Resuming only makes sense from the cached files of the previous ingest
+            use_cache = True
+
+        if incremental:
+            # The cache of the previous runs is reused, so it must be kept
+            keep_cache = True
+            output_folder.mkdir(exist_ok=True)
+            self._journal = CheckpointJournal(output_folder / JOURNAL_FILE)
+            evtx_files = self._prepare_incremental(input_folder, output_folder, resume)
+
+        elif stream and not use_cache:
+            # Conversion and indexing overlap, the evtx are directly handed to the workers
+            # and nothing is written on disk except if the cache is kept
+            log.info("Starting EVTX streaming conversion")
+            self._stream = True
+            if keep_cache:
+                output_folder.mkdir(exist_ok=True)
+                self._cache_folder = output_folder
+
+            evtx_files = [Path(file) for file in self.list_files(file=input_folder if input_folder.is_file() else None,
+                                                                 folder=input_folder if input_folder.is_dir() else None,
+                                                                 extension="*.evtx*")]
+
+            # Files streamed to the same cached file would overwrite each other
+            collisions = find_collisions(evtx_files, self._evtxdump.output_name)
+            for evtx_file, other in collisions.items():
+                log.error("{evtx} not indexed, same destination file as {other}".format(evtx=evtx_file, other=other))
+            evtx_files = [evtx_file for evtx_file in evtx_files if evtx_file not in collisions]
+
+        else:
+            if not use_cache:
+                log.info("Starting EVTX conversion. Nothing will be output until the end of conversion")
+                if not self._evtxdump.run(input_folder):
+                    log.warning("Some EVTX files could not be converted, they won't be indexed")
+
             else:
-                evtxdump = EvtxDump(output_folder, Path("evtxdump/linux/x64/evtx_dump"),
-                                    fdfind="evtxdump/linux/x64/fd")
+                log.warning("Using cached files")
+
+            # Files are converted, now build a list of the files to index
+            evtx_files = [files for files in output_folder.rglob('*') if cache.is_cache_file(files)]
+
+            # Keep track of what is sent so the ingest can be resumed
+            if not self._is_test:
+                output_folder.mkdir(exist_ok=True)
+                self._journal = CheckpointJournal(output_folder / JOURNAL_FILE)
+                if resume:
+                    log.info("Resuming previous ingest")
+                else:
+                    self._journal.reset()
+
+        if self._dedup_capacity:
+            # Keys of the previous runs are kept when resuming or indexing incrementally,
+            # so new copies of the logs already sent are dropped too
+            output_folder.mkdir(exist_ok=True)
+            self._dedup = Deduplicator(output_folder / DEDUP_FILE, capacity=self._dedup_capacity,
+                                       reset=not resume and not incremental)
+
+        self._record_conversions()
+
+        # Build the work items, largest first, and let the workers pull them
+        # from a shared queue so none of them stays idle while work remains
+        items = plan_work(evtx_files, chunk_size=0 if self._stream else self._chunk_size,
+                          journal=self._journal if resume else None)
+
+        if self._engine == "process":
+            # Real processes, each one with its own HEC client and resolver
+            # so the parsing is not bound to a single GIL
+            results = []
+            with ProcessPool(self._nb_ingestors, initializer=_init_process_worker,
+                             initargs=(self.worker_settings(),)) as master_pool:
+                with tqdm.tqdm(total=len(items), unit="items") as progress:
+                    for ret_t, counters in master_pool.imap_unordered(_process_ingest_item, items, chunksize=1):
+                        results.append((1 if ret_t else 0, 1))
+                        self.metrics.merge(counters)
+                        progress.update(1)
+
+        elif self._engine == "async":
+            # Reading and posting run on an event loop of this process, the records
+            # are encoded into batches by worker processes
+            from async_engine import AsyncEngine
+
+            if any(cache.is_columnar(item.path) for item in items):
+                log.error("The async engine can't index the Parquet cache")
+                return
+
+            with ProcessPoolExecutor(self._nb_ingestors, initializer=_init_process_worker,
+                                     initargs=(self.worker_settings(),)) as executor:
+                with tqdm.tqdm(total=len(items), unit="items") as progress:
+                    engine = AsyncEngine(executor=executor,
+                                         encode=_process_encode_block,
+                                         open_records=self._open_records,
+                                         checkpoint=self._item_checkpoint,
+                                         urls=self.hec_endpoints(),
+                                         token=self._hec_token,
+                                         metrics=self.metrics,
+                                         readers=self._nb_ingestors,
+                                         senders=self._hec_in_flight * self._nb_ingestors,
+                                         ssl_verify=os.getenv("SPLUNK_SSL") == "True",
+                                         compress=self._hec_compress,
+                                         dry_run=self._is_test,
+                                         progress=progress,
+                                         batch_bytes=self._batch_bytes,
+                                         max_batch_bytes=self._batch_bytes_max,
+                                         adaptive=self._hec_adaptive,
+                                         max_retries=self._hec_retries,
+                                         balancing=self._hec_balancing)
+                    results = engine.run(items)
+
+        else:
+            # Create pool of threads sharing the work queue
+            queue = work_queue(items)
+            self._progress = tqdm.tqdm(total=len(items), position=self._nb_ingestors, unit="items")
+            master_pool = Pool(self._nb_ingestors)
+            master_partial = partial(self.ingest_worker, queue)
+
+            results = master_pool.map(master_partial, range(self._nb_ingestors))
+            master_pool.close()
+            self._progress.close()
 
-            evtxdump.run(input_folder)
+        # Assure all the batches are sent and acknowledged before we end the function
+        if self._hec_server.close():
+            log.warning("Some batches could not be indexed")
+
+        count = sum(result[0] for result in results)
+        total = sum(result[1] for result in results)
+        log.info("{count}/{total} work items successfully indexed".format(count=count, total=total))
+
+        for line in self.metrics.summary():
+            log.info(line)
+
+        self._evtxdump.close()
+
+        if self._dedup:
+            # Streaming without cache, the keys are the only file written
+            self._dedup.close(remove=self._stream and not keep_cache)
+            if self._stream and not keep_cache:
+                try:
+                    output_folder.rmdir()
+                except OSError:
+                    pass
+
+        if self._journal:
+            if incremental:
+                self._journal.mark_indexed()
+            self._journal.close()
+
+        # Clean the temporary folder if not indicated not to do so. In streaming
+        # mode nothing was written so there is nothing to clean
+        if not keep_cache and not self._stream:
+            if count < total and self._journal:
+                log.warning("Keeping {folder} so the ingest can be resumed with --resume".format(folder=output_folder))
+            else:
+                shutil.rmtree(output_folder, ignore_errors=True)
 
+    def _prepare_incremental(self, input_folder: Path, output_folder: Path, resume: bool):
+        """
+        Convert the EVTX files that are new or changed since the previous runs and return
+        the JSON files to index. A file is considered unchanged if its size and mtime did not
+        change or, if they did, if the hash of its content is the same
+        :param input_folder: Path to a file or a folder to ingest
+        :param output_folder: Cache folder
+        :param resume: Set to true to resume the files partially sent by the previous run
+        :return: List of the JSON files to index
+        """
+        if input_folder.is_file():
+            input_root = input_folder.parent
+            evtx_files = [input_folder]
         else:
-            log.warning("Using cached files")
+            input_root = input_folder
+            evtx_files = [Path(file) for file in self.list_files(file=None, folder=input_folder, extension="*.evtx*")]
+
+        to_convert = []
+        to_index = []
+        for evtx_file in evtx_files:
+            relative_path = str(evtx_file.relative_to(input_root))
+            stat = evtx_file.stat()
+            known = self._journal.get_evtx(relative_path)
+            # Path of the cached file relative to the cache folder, its key in the journal
+            json_name = self._evtxdump.output_name(evtx_file)
+            json_file = output_folder / json_name
+
+            # Files cached under another name by a previous version are converted again
+            if known and known[3] == json_name and json_file.exists():
+                size, mtime, sha256, _, indexed = known
+
+                if (size, mtime) != (stat.st_size, stat.st_mtime):
+                    if hash_file(evtx_file) != sha256:
+                        to_convert.append((evtx_file, relative_path, stat))
+                        continue
+                    self._journal.touch_evtx(relative_path, stat.st_size, stat.st_mtime)
 
-        # Files are converted, now build a list of the files to index
-        # dispatch by size
-        evtx_files = [files for files in output_folder.rglob('*.json')]
+                if not indexed:
+                    # Converted but not completely sent by a previous run
+                    if not resume:
+                        self._journal.forget(json_name)
+                    to_index.append(json_file)
 
-        sublists = self.dispatch_files_bysize(self._nb_ingestors, evtx_files)
-        self.desc = ""
+            else:
+                to_convert.append((evtx_file, relative_path, stat))
+
+        log.info("Incremental mode. {new} new or changed files, {pending} files pending, {skip} files already "
+                 "indexed".format(new=len(to_convert), pending=len(to_index),
+                                  skip=len(evtx_files) - len(to_convert) - len(to_index)))
 
-        # Create pool of processes and partial the input
-        master_pool = Pool(self._nb_ingestors)
-        master_partial = partial(self.ingest_worker, sublists)
+        if to_convert:
+            converted = self._evtxdump.convert([evtx_file for evtx_file, _, _ in to_convert], overwrite=True)
 
-        master_pool.map(master_partial, range(self._nb_ingestors))
-        master_pool.close()
+            for evtx_file, relative_path, stat in to_convert:
+                if evtx_file not in converted:
+                    continue
 
-        # Assure to flush all the threads before we end the function
-        self._hec_server.flushBatch()
+                json_name = self._evtxdump.output_name(evtx_file)
+                self._journal.set_evtx(relative_path, stat.st_size, stat.st_mtime, hash_file(evtx_file), json_name)
+                self._journal.forget(json_name)
+                to_index.append(output_folder / json_name)
 
-        # Clean the temporary folder if not indicated not to do so
-        if not keep_cache:
-            shutil.rmtree(output_folder, ignore_errors=True)
+        return to_index
 
-    def ingest_worker(self, sublist: list, index: int):
+    @staticmethod
+    def _get_evtxdump(output_folder: Path, convert_jobs: int = None, parser: str = "evtx_dump",
+                      compression: str = "none", cache_format: str = "jsonl", input_root: Path = None):
+        """
+        Return an EvtxDump instance using the evtx_dump binaries of the current platform,
+        or a PyEvtxDump instance parsing in-process
+        :param output_folder: Path - Folder where the converted files are written
+        :param convert_jobs: Number of evtx_dump processes running at the same time
+        :param parser: evtx_dump or pyevtx
+        :param compression: Compression of the converted files, none, gzip or zstd
+        :param cache_format: Format of the converted files, jsonl or parquet
+        :param input_root: Folder of the EVTX files, their sub-folders are kept in the output folder
+        :return: EvtxDump or PyEvtxDump instance
+        """
+        if parser == "pyevtx":
+            return pyevtx.PyEvtxDump(output_folder, jobs=convert_jobs, compression=compression,
+                                     cache_format=cache_format, input_root=input_root)
+
+        if sys.platform == "win32":
+            return EvtxDump(output_folder, Path("evtxdump/windows/x64/evtx_dump.exe"), jobs=convert_jobs,
+                            compression=compression, cache_format=cache_format, input_root=input_root)
+
+        return EvtxDump(output_folder, Path("evtxdump/linux/x64/evtx_dump"), jobs=convert_jobs,
+                        compression=compression, cache_format=cache_format, input_root=input_root)
+
+    def _open_records(self, item: WorkItem, offset: int = 0):
+        """
+        Return the records stream of a work item. It's either a range of a cached JSON file
+        or an EVTX file converted on the fly in streaming mode
+        :param item: WorkItem - Item to index
+        :param offset: Offset where to start reading a cached JSON file
+        :return: Tuple (records stream, path of the JSON file relative to the cache folder)
         """
-        Ingestor worker that actually index a set of JSON files into Splunk
+        jevtx_file = item.path
+        if self._stream:
+            json_name = self._evtxdump.output_name(jevtx_file)
+            cache_file = None
+            if self._cache_folder:
+                cache_file = self._cache_folder / json_name
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+            return self._evtxdump.stream(jevtx_file, cache_file=cache_file), json_name
+
+        return iter_lines(jevtx_file, start=offset, end=item.end), self._evtxdump.cached_path(jevtx_file)
+
+    def ingest_worker(self, queue: Queue, index: int):
+        """
+        Ingestor worker that actually index JSON files into Splunk. It pulls work
+        items from the shared queue until it is empty.
         Meant to be Pool-ed
-        :param sublist: list - List of sublist of files to index
-        :param index: int - index of the sublist ot index
+        :param queue: Queue - Work items shared by the workers
+        :param index: int - index of the worker
         :return: Tuple CountSuccess,TotalCount
         """
         count = 0
         sum = 0
-        desc = ""
-        file_log = tqdm.tqdm(total=0, position=index*2, bar_format='{desc}')
-        with tqdm.tqdm(total=len(sublist[index]), position=(index*2)+1, desc=desc, unit="files") as progress:
-            for jevtx_file in sublist[index]:
-
-                sum += 1
-                with open(jevtx_file, "r") as jevtx_stream:
-
-                    if not self._is_test:
-                        desc = "[Worker {index}] Processing {evtx}".format(index=index, evtx=jevtx_file.name)
-                    else:
-                        desc = "[Worker {index}] [TEST] Processing {evtx}".format(index=index, evtx=jevtx_file.name)
-
-                    ret_t = self.send_jevtx_file_to_splunk(records_stream=jevtx_stream,
-                                                           source="event_" + jevtx_file.name,
-                                                           sourcetype="json"
-                                                           )
-                    count += 1 if ret_t else 0
-                    file_log.set_description_str(desc)
-                    progress.update(1)
+        file_log = tqdm.tqdm(total=0, position=index, bar_format='{desc}')
+
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                break
+
+            sum += 1
+            if not self._is_test:
+                desc = "[Worker {index}] Processing {evtx}".format(index=index, evtx=item.path.name)
+            else:
+                desc = "[Worker {index}] [TEST] Processing {evtx}".format(index=index, evtx=item.path.name)
+            file_log.set_description_str(desc)
 
+            count += 1 if self.ingest_item(item) else 0
+            if self._progress is not None:
+                self._progress.update(1)
+
+        file_log.close()
         return count, sum
 
+    def _item_checkpoint(self, item: WorkItem):
+        """
+        Return the checkpoint of a work item, if the progress is saved
+        :param item: WorkItem to index
+        :return: Tuple (FileCheckpoint or None, True if the item was already sent)
+        """
+        if not self._journal or self._stream or self._is_test:
+            return None, False
+
+        checkpoint = self._journal.checkpoint(self._journal.key(item.path), item.start, item.end)
+        if checkpoint.done:
+            log.debug("{file} [{start}] already sent, skipping".format(file=checkpoint.source, start=item.start))
+
+        return checkpoint, checkpoint.done
+
+    def ingest_item(self, item: WorkItem):
+        """
+        Index a work item, a whole file or a range of a JSON file
+        :param item: WorkItem to index
+        :return: True if the indexing was successfully else False
+        """
+        checkpoint, done = self._item_checkpoint(item)
+        if done:
+            return True
+
+        if not self._stream and cache.is_columnar(item.path):
+            json_name = Path(self._evtxdump.cached_path(item.path)).with_name(EvtxDump.json_name(item.path))
+            return self.send_columnar_file_to_splunk(parquet_file=item.path,
+                                                     source="event_" + json_name.as_posix(),
+                                                     sourcetype="json",
+                                                     checkpoint=checkpoint)
+
+        jevtx_stream, jevtx_name = self._open_records(item, offset=checkpoint.offset if checkpoint else item.start)
+        with closing(jevtx_stream):
+            return self.send_jevtx_file_to_splunk(records_stream=jevtx_stream,
+                                                  source="event_" + jevtx_name,
+                                                  sourcetype="json",
+                                                  checkpoint=checkpoint
+                                                  )
+
     @staticmethod
     def list_files(file: Path, folder: Path, extension='*.evtx'):
         """
@@ -353,46 +1188,46 @@ class Evtx2Splunk(object):
         else:
             return []
 
-    @staticmethod
-    def dispatch_files_bysize(nb_list: int, files: list):
-        """
-        It creates N list of files based on filesize to average the size between lists.
-        :param nb_list: Number of lists to create
-        :param files: List of files to dispatch
-        :return: List of list
-        """
 
-        log.info('Having {} files to dispatch in {} lists'.format(len(files), nb_list))
+# Ingestor of the current worker process, built once by the pool initializer
+_process_e2s = None
 
-        sublists = {}
-        for list_id in range(0, nb_list):
-            sublists[list_id] = {
-                'files': [],
-                'size': 0
-            }
 
-        def _get_smallest_sublist(sublists):
-            """
-            get the smallest sublist
-            """
-            smallest_list_id = 0
-            for list_id, sublist in sublists.items():
-                if sublist['size'] < sublists[smallest_list_id]['size']:
-                    smallest_list_id = list_id
+def _init_process_worker(settings: dict):
+    """
+    Pool initializer of the process engine. Build the ingestor of the worker process
+    :param settings: Dict of settings returned by Evtx2Splunk.worker_settings
+    :return: Nothing
+    """
+    global _process_e2s
+    _process_e2s = Evtx2Splunk.from_worker_settings(settings)
 
-            return smallest_list_id
 
-        for file in files:
-            log.debug('dispatching {}'.format(file))
-            list_id = _get_smallest_sublist(sublists)
-            sublists[list_id]['files'].append(file)
-            sublists[list_id]['size'] += os.stat(file).st_size
+def _process_ingest_item(item: WorkItem):
+    """
+    Index a work item in a worker process
+    :param item: WorkItem to index
+    :return: Tuple (True if the indexing was successfully else False, counters of the metrics to merge)
+    """
+    ret_t = _process_e2s.ingest_item(item)
+
+    # Acknowledgements are per process, wait for them before reporting the item
+    if _process_e2s._hec_server.wait_acks():
+        ret_t = False
+
+    return ret_t, _process_e2s.metrics.drain()
 
-        for list_id, sublist in sublists.items():
-            log.info(
-                ' List [{}] Having {} files for a size of {}'.format(list_id, len(sublist['files']), sublist['size']))
 
-        return [sublist['files'] for list_id, sublist in sublists.items()]
+def _process_encode_block(block: bytes, offset: int, source: str, max_bytes: int):
+    """
+    Build the HEC batches of a block of records in a worker process of the async engine
+    :param block: Bytes of JSONL records, ending on a line boundary
+    :param offset: Offset of the block in its file
+    :param source: Source of the records
+    :param max_bytes: Size of the batches
+    :return: Tuple (list of (payload, offset following its last record), counters of the metrics)
+    """
+    return _process_e2s.encode_block(block, offset, source, "json", max_bytes)
 
 
 if __name__ == "__main__":
@@ -405,20 +1240,113 @@ if __name__ == "__main__":
     parser.add_argument('--nb_process', type=int, default=cpu_count(),
                         help="Number of ingest processes to spawn, only useful for more than 1 file")
 
+    parser.add_argument('--engine', choices=["thread", "process", "async"], default="thread",
+                        help="Ingestion engine. process spawns real processes so parsing scales with the cores. "
+                             "async reads and posts on an event loop while processes encode the records, "
+                             "needs aiohttp")
+
     parser.add_argument('--index', default="winevt", help="index to use for ingest process")
 
+    parser.add_argument('--batch_bytes', type=int, default=512000,
+                        help="Size in bytes after which a batch of events is sent to HEC")
+
+    parser.add_argument('--batch_bytes_max', type=int, default=None,
+                        help="Max size in bytes the batches grow to while HEC keeps up. Default to 4 times --batch_bytes")
+
+    parser.add_argument('--no_adaptive', action="store_true",
+                        help="Keep --batch_bytes and --hec_in_flight instead of adapting them to the HEC feedback")
+
+    parser.add_argument('--hec_retries', type=int, default=8,
+                        help="Number of retries after a backoff of a batch throttled or failing on every HEC endpoint")
+
+    parser.add_argument('--hec_in_flight', type=int, default=4,
+                        help="Max number of batches posted at the same time by each ingest process")
+
+    parser.add_argument('--no_compress', action="store_true",
+                        help="Do not gzip the batches sent to HEC")
+
+    parser.add_argument('--hec_ack', action="store_true",
+                        help="Wait for the indexer acknowledgement. The evtx2splunk HEC token must have useACK enabled")
+
+    parser.add_argument('--hec_balancing', choices=["round_robin", "least_outstanding"], default="round_robin",
+                        help="Distribution of the batches when several HEC endpoints are set in SPLUNK_HEC_URLS")
+
     parser.add_argument('--keep_cache', action="store_true",
                         help="Keep JSON cache for future use - Might take a lot of space")
 
     parser.add_argument('--use_cache', action="store_true",
                         help="Use the cached files")
 
+    parser.add_argument('--resume', action="store_true",
+                        help="Resume an interrupted ingest from the cached files, skipping what was already sent")
+
+    parser.add_argument('--incremental', action="store_true",
+                        help="Only convert and index the EVTX files that are new or changed since the previous runs. "
+                             "Implies --keep_cache")
+
+    parser.add_argument('--stream', action="store_true",
+                        help="Index the records while the EVTX are converted. No JSON is written unless --keep_cache")
+
     parser.add_argument('--test', action="store_true",
                         help="Testing mode. No data is sent to Splunk but index and HEC token are created.")
 
+    parser.add_argument('--refresh_setup', action="store_true",
+                        help="Get the HEC token and create the index through the management port even if they "
+                             "were saved in the setup cache by a previous run")
+
+    parser.add_argument('--setup_cache', default=SETUP_CACHE,
+                        help="File caching the HEC token and the indexes between runs")
+
     parser.add_argument('--no_resolve', action="store_true",
                         help="Disable the event id resolution. If the data file is not found, will be disabled automatically")
 
+    parser.add_argument('--chunk_size', type=int, default=128,
+                        help="Size in MB above which a JSON file is split so several workers can index it. 0 to disable")
+
+    parser.add_argument('--convert_jobs', type=int, default=cpu_count(),
+                        help="Number of evtx_dump processes converting files at the same time")
+
+    parser.add_argument('--parser', choices=["evtx_dump", "pyevtx"], default="evtx_dump",
+                        help="EVTX parser. pyevtx parses in-process with the evtx python binding, "
+                             "spreading the chunks of each file over --convert_jobs processes")
+
+    parser.add_argument('--cache_compression', choices=list(cache.COMPRESSIONS), default="none",
+                        help="Compression of the JSON cache. zstd needs the zstandard package")
+
+    parser.add_argument('--cache_format', choices=list(cache.FORMATS), default="jsonl",
+                        help="Format of the cache. parquet stores the System fields as typed columns so re-ingesting "
+                             "skips the JSON parsing. Needs pyarrow")
+
+    parser.add_argument('--json_backend', choices=["auto"] + list(json_codec.BACKENDS), default="auto",
+                        help="JSON library decoding the records. auto picks simdjson, then orjson, then the standard "
+                             "library depending on what is installed")
+
+    parser.add_argument('--filter', default=None,
+                        help="JSON file of the rules selecting the events sent by channel, provider and event ID, "
+                             "and of the fields dropped or kept in the events")
+
+    parser.add_argument('--dedup', action="store_true",
+                        help="Drop the records already sent from another file, for instance the same log collected "
+                             "live, from a VSS snapshot and as an archive. Records are identified by computer, "
+                             "channel, EventRecordID and SystemTime")
+
+    parser.add_argument('--dedup_capacity', type=int, default=DEDUP_CAPACITY,
+                        help="Number of records the in-memory filter of --dedup is sized for, about 1.2 MB per "
+                             "million. Larger ingests are still deduplicated but query the disk more often. "
+                             "Default to 10000000")
+
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help="Serve live metrics on this port, /metrics in the Prometheus text format and /stats in JSON")
+
+    parser.add_argument('--stats_file', default=None,
+                        help="Write live metrics in this JSON file every --stats_interval seconds")
+
+    parser.add_argument('--stats_interval', type=float, default=10,
+                        help="Time in seconds between two writes of --stats_file")
+
+    parser.add_argument('--lcid', type=partial(int, base=0), default=0x409,
+                        help="Language of the resolved messages, must be in the resolver database. Default to 0x409")
+
     args = parser.parse_args()
     log.basicConfig(format=LOG_FORMAT, level=LOG_VERBOSITY[args.verbosity], datefmt='%Y-%m-%d %I:%M:%S')
 
@@ -426,8 +1354,27 @@ if __name__ == "__main__":
 
     e2s = Evtx2Splunk()
 
-    if e2s.configure(index=args.index, nb_ingestors=args.nb_process, testing=args.test, no_resolve=args.no_resolve):
-        e2s.ingest(input_files=args.input, keep_cache=args.keep_cache, use_cache=args.use_cache)
+    metrics_server = MetricsServer(e2s.metrics, args.metrics_port) if args.metrics_port else None
+    stats_writer = StatsFileWriter(e2s.metrics, args.stats_file, args.stats_interval) if args.stats_file else None
+
+    if e2s.configure(index=args.index, nb_ingestors=args.nb_process, testing=args.test, no_resolve=args.no_resolve,
+                     engine=args.engine, batch_bytes=args.batch_bytes, hec_in_flight=args.hec_in_flight,
+                     hec_compress=not args.no_compress, hec_ack=args.hec_ack, hec_balancing=args.hec_balancing,
+                     lcid=args.lcid, chunk_size=args.chunk_size * 1024 * 1024,
+                     convert_jobs=args.convert_jobs, parser=args.parser,
+                     cache_compression=args.cache_compression, cache_format=args.cache_format,
+                     json_backend=args.json_backend, filter_file=args.filter,
+                     hec_adaptive=not args.no_adaptive, batch_bytes_max=args.batch_bytes_max,
+                     hec_retries=args.hec_retries, refresh_setup=args.refresh_setup, setup_cache=args.setup_cache,
+                     dedup=args.dedup, dedup_capacity=args.dedup_capacity):
+        e2s.ingest(input_files=args.input, keep_cache=args.keep_cache, use_cache=args.use_cache,
+                   stream=args.stream, resume=args.resume, incremental=args.incremental)
+
+    if stats_writer:
+        stats_writer.close()
+
+    if metrics_server:
+        metrics_server.close()
 
     end_time = time.time()
 
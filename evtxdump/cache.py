@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    JSON cache readers, part of evtx2splunk
+"""
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import gzip
+import io
+import mmap
+import os
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffix appended to the JSON files of the cache for each compression
+COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# Formats of the cache. Parquet files are compressed internally
+FORMATS = ("jsonl", "parquet")
+
+
+def is_compressed(path: Path):
+    """
+    Return whether a cached file is compressed, from its suffix
+    :param path: Path - Path of the cached file
+    :return: True if compressed
+    """
+    return Path(path).suffix in (".gz", ".zst")
+
+
+def is_columnar(path: Path):
+    """
+    Return whether a cached file is a Parquet file, from its suffix
+    :param path: Path - Path of the cached file
+    :return: True if Parquet
+    """
+    return Path(path).suffix == ".parquet"
+
+
+def is_cache_file(path: Path):
+    """
+    Return whether a file of the cache folder holds records
+    :param path: Path - Path of the file
+    :return: True if it's a JSON, compressed JSON or Parquet file
+    """
+    return Path(path).suffix in (".json", ".gz", ".zst", ".parquet")
+
+
+def cache_name(json_name: str, compression: str = "none", cache_format: str = "jsonl"):
+    """
+    Return the name of a cached file
+    :param json_name: str - Name of the JSON file, or its path relative to the cache folder
+    :param compression: str - none, gzip or zstd. Ignored for Parquet
+    :param cache_format: str - jsonl or parquet
+    :return: Name of the cached file
+    """
+    if cache_format == "parquet":
+        return Path(json_name).with_suffix(".parquet").as_posix()
+
+    return json_name + COMPRESSIONS[compression]
+
+
+def open_cache(path: Path, mode: str = "rb"):
+    """
+    Open a cached file in binary mode, compressing or decompressing on the fly depending
+    on its suffix. zstd needs the zstandard package. Parquet files can only be written this way,
+    they are read with columnar.iter_rows
+    :param path: Path - Path of the cached file
+    :param mode: str - rb or wb
+    :return: File object
+    """
+    suffix = Path(path).suffix
+
+    if suffix == ".parquet":
+        if "w" not in mode:
+            raise ValueError("Parquet files are read with columnar.iter_rows")
+
+        from evtxdump.columnar import ParquetCacheWriter
+        return ParquetCacheWriter(path)
+
+    if suffix == ".gz":
+        # Favour speed, the cache is written once per conversion
+        return gzip.open(path, mode, compresslevel=1) if "w" in mode else gzip.open(path, mode)
+
+    if suffix == ".zst":
+        if zstandard is None:
+            raise ImportError("zstd cache needs the zstandard package. Install it with pip install zstandard")
+
+        if "w" in mode:
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=3))
+        return io.BufferedReader(zstandard.open(path, mode))
+
+    return open(path, mode)
+
+
+def iter_lines(path: Path, start: int = 0, end: int = None):
+    """
+    Yield the lines of a cached JSONL file within a byte range. Compressed files are
+    decompressed on the fly, offsets being those of the decompressed content
+    :param path: Path - Path of the JSONL file
+    :param start: int - Offset of the first line, must be on a line boundary
+    :param end: int - Offset where to stop, on a line boundary. None for the end of file
+    :return: Generator of lines as bytes
+    """
+    if not is_compressed(path):
+        yield from iter_mapped_lines(path, start=start, end=end)
+        return
+
+    with open_cache(path, "rb") as fdata:
+        # No random access in a compressed stream, skip the lines before start
+        skipped = 0
+        while skipped < start:
+            line = fdata.readline()
+            if not line:
+                return
+            skipped += len(line)
+
+        if end is None:
+            yield from fdata
+            return
+
+        remaining = end - start
+        for line in fdata:
+            if remaining <= 0:
+                break
+            remaining -= len(line)
+            yield line
+
+
+
+def iter_mapped_lines(path: Path, start: int = 0, end: int = None):
+    """
+    Yield the lines of an uncompressed JSONL file within a byte range, reading them from a
+    memory mapping of the range. Lines are cut by mmap.readline straight from the page cache,
+    without going through a read buffer, and the mapping ends with the range so no bound is
+    checked per line
+    :param path: Path - Path of the JSONL file
+    :param start: int - Offset of the first line, must be on a line boundary
+    :param end: int - Offset where to stop, on a line boundary. None for the end of file
+    :return: Generator of lines as bytes
+    """
+    with open(path, "rb") as fdata:
+        size = os.fstat(fdata.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            # Nothing to read, and empty ranges can't be mapped
+            return
+
+        # The mapping must start on a multiple of the allocation granularity
+        map_start = start - start % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(fdata.fileno(), end - map_start, offset=map_start, access=mmap.ACCESS_READ) as buffer:
+            if hasattr(buffer, "madvise"):
+                buffer.madvise(mmap.MADV_SEQUENTIAL)
+
+            buffer.seek(start - map_start)
+            yield from iter(buffer.readline, b"")
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Columnar cache, part of evtx2splunk
+    Uses pyarrow, an optional dependency (pip install pyarrow)
+"""
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+import json_codec
+from resolver import MessageRenderer
+from systemtime import SystemTimeParser
+
+# System fields are typed columns, so re-ingesting never parses the records nor their timestamps.
+# The record itself is kept as is in raw, it's the event sent to HEC
+SCHEMA = pa.schema([
+    ("epoch", pa.float64()),
+    ("computer", pa.string()),
+    ("channel", pa.string()),
+    ("provider", pa.string()),
+    ("event_id", pa.int32()),
+    ("event_record_id", pa.int64()),
+    ("level", pa.int32()),
+    ("event_data", pa.map_(pa.string(), pa.string())),
+    ("raw", pa.binary()),
+]) if pa is not None else None
+
+
+def is_available():
+    """
+    Return whether pyarrow is installed
+    :return: True if available
+    """
+    return pa is not None
+
+
+def _to_int(value):
+    """
+    Return the integer of a System field, which may hold attributes
+    :param value: Value as output by evtx_dump
+    :return: int or None
+    """
+    if isinstance(value, dict):
+        value = value.get("#text")
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ParquetCacheWriter(object):
+    """
+    Write JSONL records into a Parquet file. Behaves as a binary file, so the output of
+    evtx_dump can be copied into it as is. Records are buffered and written by row groups.
+    """
+
+    def __init__(self, path: Path, row_group_size: int = 65536):
+        """
+        Init method of the ParquetCacheWriter
+        :param path: Path of the Parquet file
+        :param row_group_size: Number of records of each row group
+        """
+        if not is_available():
+            raise ImportError("Parquet cache needs pyarrow. Install it with pip install pyarrow")
+
+        self._writer = pq.ParquetWriter(str(path), SCHEMA, compression="zstd")
+        self._row_group_size = row_group_size
+        self._time_parser = SystemTimeParser()
+        self._remainder = b""
+        self._rows = {name: [] for name in SCHEMA.names}
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, data: bytes):
+        """
+        Write bytes of JSONL. Records may be split across several writes
+        :param data: Bytes of JSONL
+        :return: Number of bytes written
+        """
+        lines = (self._remainder + data).split(b"\n")
+        self._remainder = lines.pop()
+        for line in lines:
+            self.add(line)
+
+        return len(data)
+
+    def add(self, line: bytes):
+        """
+        Add a JSONL record
+        :param line: Bytes of the record
+        :return: Nothing
+        """
+        line = line.rstrip()
+        try:
+            record = json_codec.loads(line)
+            system = record["Event"]["System"]
+        except (ValueError, KeyError, TypeError):
+            return
+
+        try:
+            epoch = self._time_parser.to_epoch(system["TimeCreated"]["#attributes"]["SystemTime"])
+        except (ValueError, KeyError, TypeError):
+            epoch = None
+
+        provider = system.get("Provider")
+        rows = self._rows
+        rows["epoch"].append(epoch)
+        rows["computer"].append(system.get("Computer"))
+        rows["channel"].append(system.get("Channel"))
+        rows["provider"].append(provider.get("#attributes", {}).get("Name") if isinstance(provider, dict) else None)
+        rows["event_id"].append(_to_int(system.get("EventID")))
+        rows["event_record_id"].append(_to_int(system.get("EventRecordID")))
+        rows["level"].append(_to_int(system.get("Level")))
+        rows["event_data"].append(MessageRenderer.insertion_items(record["Event"]))
+        rows["raw"].append(line)
+
+        self._count += 1
+        if self._count >= self._row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records as a row group
+        :return: Nothing
+        """
+        if not self._count:
+            return
+
+        self._writer.write_table(pa.Table.from_pydict(self._rows, schema=SCHEMA))
+        self._rows = {name: [] for name in SCHEMA.names}
+        self._count = 0
+
+    def close(self):
+        """
+        Write the pending records and close the file
+        :return: Nothing
+        """
+        if self._remainder:
+            self.add(self._remainder)
+            self._remainder = b""
+
+        self.flush()
+        self._writer.close()
+
+
+def iter_rows(path: Path, start: int = 0, batch_size: int = 65536):
+    """
+    Read a Parquet cache by batches and yield its records
+    :param path: Path - Path of the Parquet file
+    :param start: int - Index of the first record to read
+    :param batch_size: int - Number of records read at once
+    :return: Generator of tuples (raw, epoch, computer, channel, provider, event_id, event_record_id,
+             insertion strings)
+    """
+    parquet_file = pq.ParquetFile(str(path))
+
+    # Skip the row groups before start without reading them
+    row_groups = []
+    position = 0
+    for index in range(parquet_file.metadata.num_row_groups):
+        num_rows = parquet_file.metadata.row_group(index).num_rows
+        if row_groups or position + num_rows > start:
+            row_groups.append(index)
+        else:
+            position += num_rows
+
+    if not row_groups:
+        return
+
+    columns = ["raw", "epoch", "computer", "channel", "provider", "event_id", "event_record_id", "event_data"]
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns):
+        if position < start:
+            skip = min(start - position, batch.num_rows)
+            position += skip
+            batch = batch.slice(skip)
+            if not batch.num_rows:
+                continue
+
+        values = [batch.column(name).to_pylist() for name in columns]
+        # Only the values of the insertion strings are needed
+        values[-1] = [[value for _, value in items] if items is not None else [] for items in values[-1]]
+
+        yield from zip(*values)
@@ -13,30 +13,83 @@ __version__ = "0.1"
 __author__ = "Ektoplasma"
 
 import logging as log
+import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from pathlib import Path
+from queue import Queue
+from typing import NamedTuple
+
+from evtxdump.cache import cache_name, open_cache
+
+
+class ConversionResult(NamedTuple):
+    """
+    Outcome of the conversion of an evtx file
+    """
+    evtx_file: Path
+    success: bool
+    duration: float
+    bytes_in: int
+    bytes_out: int
+    attempts: int
+    error: str = None
+
+
+def find_collisions(evtx_files: list, output_name):
+    """
+    Return the evtx files that would be converted to the same output file as a previous file of the list
+    :param evtx_files: List of Path to the evtx files
+    :param output_name: Callable returning the name of the output file of an evtx file
+    :return: Dict of the colliding evtx files to the evtx file converted to their output file
+    """
+    outputs = {}
+    collisions = {}
+    for evtx_file in evtx_files:
+        name = output_name(evtx_file)
+        if name in outputs:
+            collisions[evtx_file] = outputs[name]
+        else:
+            outputs[name] = evtx_file
+
+    return collisions
 
 
 class EvtxDump(object):
     """
     Wrapper around evtx_dump, a tool writen in go for speed conversion of evtx
     """
-    def __init__(self, output_path: Path=None, path_evtx_dump: Path=None, fdfind: str ="fdfind"):
+    def __init__(self, output_path: Path=None, path_evtx_dump: Path=None, jobs: int = None, retries: int = 1,
+                 compression: str = "none", cache_format: str = "jsonl", input_root: Path = None):
         """
         Init method of the EvtxDump class. Just saves some input args
         :param output_path: Path - Output path of the files
         :param path_evtx_dump: Path - Path of the evtx path binary
-        :param fdfind: Path - ffind
+        :param jobs: int - Number of evtx_dump processes running at the same time, default to the number of cores
+        :param retries: int - Number of times a failed conversion is retried
+        :param compression: str - Compression of the output files, none, gzip or zstd
+        :param cache_format: str - Format of the output files, jsonl or parquet
+        :param input_root: Path - Folder of the evtx files, their sub-folders are kept in the output path
         """
         self._output_path = output_path
         self._evtx_dump = path_evtx_dump
-        self._fdfind = fdfind
+        self._input_root = input_root
+        self._jobs = jobs or cpu_count()
+        self._retries = retries
+        self._compression = compression
+        self._cache_format = cache_format
+        self.results = []
 
     def run(self, evtxdata: Path):
         """
         Dispatch depending whether it's a file or a directory
         :param evtxdata:
-        :return:
+        :return: True if all the files were successfully converted, else False
         """
         if evtxdata.is_file():
             return self._convert_file(evtxdata)
@@ -48,57 +101,290 @@ class EvtxDump(object):
             log.error("Data is neither a file nor a folder, not supported")
             return False
 
-    def _convert_file(self, evtxdata: Path):
+    @staticmethod
+    def json_name(evtx_file: Path):
         """
-        Convert a file to json thanks to evtx_dump
-        :param evtxdata: Path - Path to the evtx file
-        :return: True if successful, else False
+        Return the name of the JSON file converted from an evtx file
+        :param evtx_file: Path - Path to the evtx file
+        :return: Name of the JSON file
         """
+        return evtx_file.stem + ".json"
 
-        completed = False
-        filename = evtxdata.name + ".json"
+    def json_path(self, evtx_file: Path):
+        """
+        Return the path of the JSON file converted from an evtx file, relative to the output path.
+        The sub-folders of the evtx file are kept, so files of the same name in different folders,
+        for instance a live log and its VSS copy, are not converted to the same file
+        :param evtx_file: Path - Path to the evtx file
+        :return: Relative path of the JSON file, with / separators
+        """
+        try:
+            relative = Path(evtx_file).relative_to(self._input_root)
+        except (TypeError, ValueError):
+            relative = Path(Path(evtx_file).name)
 
-        out_file = Path(self._output_path, filename)
+        return relative.with_name(self.json_name(evtx_file)).as_posix()
 
-        if out_file.exists():
-            log.error("Destination file already exists")
-            return completed
+    def output_name(self, evtx_file: Path):
+        """
+        Return the path of the file converted from an evtx file relative to the output path,
+        with the suffix of the format and compression
+        :param evtx_file: Path - Path to the evtx file
+        :return: Relative path of the output file
+        """
+        return cache_name(self.json_path(evtx_file), self._compression, self._cache_format)
 
+    def cached_path(self, cache_file: Path):
+        """
+        Return the path of a converted file relative to the output path, which identifies
+        it even when files of the same name were converted from different folders
+        :param cache_file: Path - Path to the converted file
+        :return: Relative path with / separators, the file name if it's not in the output path
+        """
         try:
-            command = (self._evtx_dump, evtxdata, "-o", "jsonl", "-f", out_file, "--no-confirm-overwrite")
-            completed = subprocess.check_call(command)
-        except Exception as e:
-            log.error(e)
+            return Path(cache_file).relative_to(self._output_path).as_posix()
+        except (TypeError, ValueError):
+            return Path(cache_file).name
+
+    def convert(self, evtx_files: list, overwrite: bool = False):
+        """
+        Convert a list of files to json thanks to a pool of evtx_dump processes.
+        Largest files are started first so they don't end up running alone at the end
+        :param evtx_files: List of Path to the evtx files
+        :param overwrite: Set to true to overwrite existing destination files
+        :return: List of the evtx files successfully converted
+        """
+        Path(self._output_path).mkdir(parents=True, exist_ok=True)
+
+        evtx_files = sorted(evtx_files, key=lambda evtx_file: os.stat(evtx_file).st_size, reverse=True)
+
+        # A file converted to the output file of another one would overwrite it
+        collisions = find_collisions(evtx_files, self.output_name)
+        evtx_files = [evtx_file for evtx_file in evtx_files if evtx_file not in collisions]
+
+        # evtx_dump is multi-threaded, share the cores between the processes
+        threads = max(1, cpu_count() // min(self._jobs, max(1, len(evtx_files))))
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            results = list(executor.map(lambda evtx_file: self._convert_one(evtx_file, overwrite, threads),
+                                        evtx_files))
+
+        results.extend(self._collision_results(collisions))
+        self.results.extend(results)
+        self._log_results(results)
+
+        return [result.evtx_file for result in results if result.success]
+
+    @staticmethod
+    def _collision_results(collisions: dict):
+        """
+        Return the failed conversions of the files colliding with another one
+        :param collisions: Dict returned by find_collisions
+        :return: List of ConversionResult
+        """
+        return [ConversionResult(evtx_file, False, 0, os.stat(evtx_file).st_size, 0, 0,
+                                 "Same destination file as {other}".format(other=other))
+                for evtx_file, other in collisions.items()]
+
+    def _convert_one(self, evtx_file: Path, overwrite: bool, threads: int):
+        """
+        Convert a file with evtx_dump, retrying on failure
+        :param evtx_file: Path - Path to the evtx file
+        :param overwrite: Set to true to overwrite an existing destination file
+        :param threads: Number of threads of evtx_dump
+        :return: ConversionResult
+        """
+        start = time.time()
+        out_file = Path(self._output_path, self.output_name(evtx_file))
+        bytes_in = os.stat(evtx_file).st_size
 
-        return completed
+        if out_file.exists() and not overwrite:
+            log.error("Destination file {file} already exists".format(file=out_file))
+            return ConversionResult(evtx_file, False, 0, bytes_in, 0, 0, "Destination file already exists")
+
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        error = None
+        attempts = 0
+        while attempts <= self._retries:
+            attempts += 1
+            try:
+                returncode, stderr = self._run_evtx_dump(evtx_file, out_file, threads)
+                if returncode == 0:
+                    return ConversionResult(evtx_file, True, time.time() - start, bytes_in,
+                                            os.stat(out_file).st_size, attempts)
+
+                error = stderr.decode(errors="replace").strip() or \
+                    "evtx_dump exited with code {code}".format(code=returncode)
+
+            except Exception as e:
+                error = str(e)
+
+            log.warning("Conversion of {evtx} failed, attempt {attempt}. {error}".format(evtx=evtx_file,
+                                                                                         attempt=attempts,
+                                                                                         error=error))
+            if out_file.exists():
+                out_file.unlink()
+
+        return ConversionResult(evtx_file, False, time.time() - start, bytes_in, 0, attempts, error)
+
+    def _run_evtx_dump(self, evtx_file: Path, out_file: Path, threads: int):
+        """
+        Run evtx_dump on a file. Without compression evtx_dump writes the output file itself,
+        otherwise its output is piped through the compressor or the Parquet writer
+        :param evtx_file: Path - Path to the evtx file
+        :param out_file: Path - Path of the output file
+        :param threads: Number of threads of evtx_dump
+        :return: Tuple (return code, stderr as bytes)
+        """
+        if self._compression == "none" and self._cache_format == "jsonl":
+            command = (self._evtx_dump, evtx_file, "-o", "jsonl", "-f", out_file, "-t", str(threads),
+                       "--no-confirm-overwrite")
+            completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            return completed.returncode, completed.stderr
+
+        command = (self._evtx_dump, evtx_file, "-o", "jsonl", "-t", str(threads), "--no-confirm-overwrite")
+        # stderr goes to a file so a verbose evtx_dump can't block on a full pipe
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                with open_cache(out_file, "wb") as fout:
+                    shutil.copyfileobj(process.stdout, fout, 1024 * 1024)
+            except Exception:
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+                process.wait()
+
+            stderr.seek(0)
+            return process.returncode, stderr.read()
+
+    @staticmethod
+    def _log_results(results: list):
+        """
+        Log a summary of the conversions
+        :param results: List of ConversionResult
+        :return: Nothing
+        """
+        for result in results:
+            if result.success:
+                log.debug("{evtx} converted in {duration:.2f}s, {bytes_in} -> {bytes_out} bytes".format(
+                    evtx=result.evtx_file, duration=result.duration, bytes_in=result.bytes_in,
+                    bytes_out=result.bytes_out))
+            else:
+                log.error("{evtx} not converted after {attempts} attempts. {error}".format(
+                    evtx=result.evtx_file, attempts=result.attempts, error=result.error))
+
+        converted = [result for result in results if result.success]
+        log.info("{count}/{total} files converted, {bytes_in} bytes of evtx to {bytes_out} bytes of JSON".format(
+            count=len(converted), total=len(results), bytes_in=sum(result.bytes_in for result in converted),
+            bytes_out=sum(result.bytes_out for result in converted)))
+
+    def close(self):
+        """
+        Release the resources of the converter. evtx_dump processes are always waited for,
+        so there is nothing to release
+        :return: Nothing
+        """
+        pass
+
+    def _convert_file(self, evtxdata: Path):
+        """
+        Convert a file to json thanks to evtx_dump
+        :param evtxdata: Path - Path to the evtx file
+        :return: True if successful, else False
+        """
+        return len(self.convert([evtxdata])) == 1
 
     def _convert_files(self, evtxdata: Path):
         """
-        Convert a set of files to json thanks to evtx_dump and ffind
+        Convert a set of files to json thanks to a pool of evtx_dump processes
         :param evtxdata: Path - Path to a folder containing EVTX
         :return: True if successful, else False
         """
-
-        completed = False
-        list_evtx = evtxdata.rglob("*.evtx*")
+        list_evtx = [evtx for evtx in evtxdata.rglob("*.evtx*") if evtx.is_file()]
 
         for evtx in list_evtx:
 
-            filename = evtx.name + ".json"
-
-            out_file = Path(self._output_path, filename)
+            out_file = Path(self._output_path, self.output_name(evtx))
 
             if out_file.exists():
                 log.error("Destination file already exists")
-                return 1
+                return False
+
+        return len(self.convert(list_evtx)) == len(list_evtx)
+
+    def stream(self, evtx_file: Path, cache_file: Path = None, queue_size: int = 4096):
+        """
+        Convert a file with evtx_dump and yield the JSONL records as soon as they are produced.
+        Records go through a bounded queue, so a slow consumer pauses the conversion
+        instead of buffering the whole file in memory.
+        If the conversion fails, an exception is raised once the records produced are consumed
+        and the cache file is removed, so a partial file is never taken for a complete one
+        :param evtx_file: Path - Path to the evtx file
+        :param cache_file: Path - If set, records are also written to this file for future use
+        :param queue_size: int - Maximum number of records waiting to be consumed
+        :return: Generator of records as bytes, one JSON document per record
+        :raise RuntimeError: If evtx_dump failed or the cache file could not be written
+        """
+        command = (self._evtx_dump, evtx_file, "-o", "jsonl", "--no-confirm-overwrite")
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+        records = Queue(maxsize=queue_size)
+        stop = threading.Event()
+        end_of_stream = object()
+        errors = []
+
+        def _reader():
+            """
+            Read evtx_dump output and feed the queue. Blocks while the queue is full
+            """
+            cache = None
+            try:
+                cache = open_cache(cache_file, "wb") if cache_file else None
+                for line in process.stdout:
+                    if cache:
+                        cache.write(line)
+                    if stop.is_set():
+                        break
+                    records.put(line)
+            except Exception as e:
+                errors.append(e)
+                process.kill()
+            finally:
+                if cache:
+                    cache.close()
+                records.put(end_of_stream)
+
+        reader = threading.Thread(target=_reader, daemon=True)
+        reader.start()
 
         try:
-            command = (self._fdfind, r".*\.evtx\w*", evtxdata, "-x",
-                       self._evtx_dump, "-o", "jsonl", "{}", "--no-confirm-overwrite",
-                       "-f", Path(self._output_path, "{/.}.json"))
-            completed = subprocess.check_call(command)
-        except Exception as e:
-            log.error(e)
+            while True:
+                record = records.get()
+                if record is end_of_stream:
+                    break
+                yield record
+
+        finally:
+            # The consumer stopped early, kill the conversion and unblock the reader
+            if reader.is_alive():
+                stop.set()
+                process.kill()
+                while reader.is_alive():
+                    while not records.empty():
+                        records.get_nowait()
+                    reader.join(timeout=0.1)
+
+            process.stdout.close()
+            returncode = process.wait()
+
+            if (returncode != 0 or errors or stop.is_set()) and cache_file and Path(cache_file).exists():
+                Path(cache_file).unlink()
 
-        return completed
+        if errors:
+            raise RuntimeError("Caching of {evtx} failed. {error}".format(evtx=evtx_file, error=errors[0]))
 
+        if returncode != 0:
+            raise RuntimeError("evtx_dump failed on {evtx} with code {code}".format(evtx=evtx_file,
+                                                                                    code=returncode))
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    In-process EVTX parser, part of evtx2splunk
+    Uses the evtx Python binding, an optional dependency (pip install evtx)
+"""
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import io
+import logging as log
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+from pathlib import Path
+
+try:
+    from evtx import PyEvtxParser
+except ImportError:
+    PyEvtxParser = None
+
+from evtxdump.cache import cache_name, open_cache
+from evtxdump.evtxdump import ConversionResult, EvtxDump, find_collisions
+
+# Layout of an EVTX file : a 4KB file header followed by 64KB chunks. Each chunk holds
+# its own string and template tables, so it can be parsed without the others
+FILE_HEADER_SIZE = 4096
+CHUNK_SIZE = 65536
+FILE_MAGIC = b"ElfFile\x00"
+CHUNK_MAGIC = b"ElfChnk\x00"
+
+# Offsets of the header fields patched in the synthetic files
+HEADER_FIRST_CHUNK = 8
+HEADER_LAST_CHUNK = 16
+HEADER_CHUNK_COUNT = 42
+HEADER_FLAGS = 120
+HEADER_CHECKSUM = 124
+
+
+def is_available():
+    """
+    Return whether the evtx Python binding is installed
+    :return: True if available
+    """
+    return PyEvtxParser is not None
+
+
+def compact_record(data: str):
+    """
+    Turn the indented JSON of a record into a single line, as output by evtx_dump -o jsonl.
+    Strings never span several lines, so the leading whitespaces of each line are only indentation
+    :param data: JSON of the record as returned by the binding
+    :return: JSONL record as bytes
+    """
+    return "".join(line.lstrip() for line in data.split("\n")).encode() + b"\n"
+
+
+def synthetic_evtx(header: bytes, chunks: bytes):
+    """
+    Build an EVTX file holding a subset of the chunks of another one
+    :param header: File header of the original file
+    :param chunks: Bytes of the chunks to keep
+    :return: Bytes of the EVTX file
+    """
+    count = len(chunks) // CHUNK_SIZE
+    header = bytearray(header)
+    struct.pack_into("<Q", header, HEADER_FIRST_CHUNK, 0)
+    struct.pack_into("<Q", header, HEADER_LAST_CHUNK, max(count - 1, 0))
+    struct.pack_into("<H", header, HEADER_CHUNK_COUNT, count)
+    # Clear the dirty and full flags, the chunks are complete
+    struct.pack_into("<I", header, HEADER_FLAGS, 0)
+    struct.pack_into("<I", header, HEADER_CHECKSUM, zlib.crc32(bytes(header[:HEADER_FLAGS])) & 0xFFFFFFFF)
+
+    return bytes(header) + chunks
+
+
+def parse_chunks(evtx_file: Path, first_chunk: int, nb_chunks: int, ansi_codec: str = "windows-1252"):
+    """
+    Parse a range of chunks of an EVTX file. Meant to run in a worker process
+    :param evtx_file: Path of the EVTX file
+    :param first_chunk: Index of the first chunk to parse
+    :param nb_chunks: Number of chunks to parse
+    :param ansi_codec: Encoding of the ANSI strings of the records
+    :return: List of JSONL records as bytes
+    """
+    with open(evtx_file, "rb") as fdata:
+        header = fdata.read(FILE_HEADER_SIZE)
+        fdata.seek(FILE_HEADER_SIZE + first_chunk * CHUNK_SIZE)
+        chunks = fdata.read(nb_chunks * CHUNK_SIZE)
+
+    # Keep the chunks in use, a truncated last chunk or unallocated chunks can't be parsed
+    chunks = b"".join(chunks[position:position + CHUNK_SIZE]
+                      for position in range(0, len(chunks) - CHUNK_SIZE + 1, CHUNK_SIZE)
+                      if chunks[position:position + len(CHUNK_MAGIC)] == CHUNK_MAGIC)
+    if not chunks:
+        return []
+
+    parser = PyEvtxParser(io.BytesIO(synthetic_evtx(header, chunks)), number_of_threads=1, ansi_codec=ansi_codec)
+
+    records = []
+    for record in parser.records_json():
+        records.append(compact_record(record["data"]))
+
+    return records
+
+
+class PyEvtxDump(object):
+    """
+    Drop-in replacement of EvtxDump parsing the EVTX in-process with the evtx binding.
+    The chunks of a file are split in groups parsed by a pool of processes, so a single
+    large file uses all the cores, and the records are yielded in the order of the file
+    without going through a temporary file.
+    """
+
+    def __init__(self, output_path: Path = None, jobs: int = None, chunks_per_job: int = 16,
+                 ansi_codec: str = "windows-1252", compression: str = "none", cache_format: str = "jsonl",
+                 input_root: Path = None):
+        """
+        Init method of the PyEvtxDump class
+        :param output_path: Path - Output path of the converted files
+        :param jobs: int - Number of parsing processes, default to the number of cores. 1 parses
+                     in the current process, needed when already running in a daemon process
+        :param chunks_per_job: int - Number of 64KB chunks parsed at once by a process
+        :param ansi_codec: str - Encoding of the ANSI strings of the records
+        :param compression: str - Compression of the output files, none, gzip or zstd
+        :param cache_format: str - Format of the output files, jsonl or parquet
+        :param input_root: Path - Folder of the evtx files, their sub-folders are kept in the output path
+        """
+        if not is_available():
+            raise ImportError("The evtx python binding is not installed. Install it with pip install evtx")
+
+        self._output_path = output_path
+        self._jobs = jobs or cpu_count()
+        self._chunks_per_job = chunks_per_job
+        self._ansi_codec = ansi_codec
+        self._compression = compression
+        self._cache_format = cache_format
+        self._input_root = input_root
+        self._executor = None
+        self.results = []
+
+    json_name = staticmethod(EvtxDump.json_name)
+
+    json_path = EvtxDump.json_path
+
+    cached_path = EvtxDump.cached_path
+
+    def output_name(self, evtx_file: Path):
+        """
+        Return the path of the file converted from an evtx file relative to the output path,
+        with the suffix of the format and compression
+        :param evtx_file: Path - Path to the evtx file
+        :return: Relative path of the output file
+        """
+        return cache_name(self.json_path(evtx_file), self._compression, self._cache_format)
+
+    def __getstate__(self):
+        """
+        A copy sent to a worker process parses in that process, daemon processes
+        of the ingest pool can't start their own pool
+        """
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_jobs"] = 1
+        return state
+
+    def _get_executor(self):
+        """
+        Return the pool of parsing processes, started on first use
+        :return: ProcessPoolExecutor
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._jobs)
+        return self._executor
+
+    def close(self):
+        """
+        Stop the parsing processes
+        :return: Nothing
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def iter_records(self, evtx_file: Path):
+        """
+        Parse an EVTX file and yield its records
+        :param evtx_file: Path - Path to the evtx file
+        :return: Generator of JSONL records as bytes
+        """
+        with open(evtx_file, "rb") as fdata:
+            magic = fdata.read(len(FILE_MAGIC))
+        if magic != FILE_MAGIC:
+            raise ValueError("{evtx} is not an EVTX file".format(evtx=evtx_file))
+
+        nb_chunks = (os.stat(evtx_file).st_size - FILE_HEADER_SIZE) // CHUNK_SIZE
+        groups = [(first, min(self._chunks_per_job, nb_chunks - first))
+                  for first in range(0, nb_chunks, self._chunks_per_job)]
+
+        if self._jobs == 1 or len(groups) <= 1:
+            for first, count in groups:
+                yield from parse_chunks(evtx_file, first, count, self._ansi_codec)
+            return
+
+        # Keep a window of groups in flight, so memory stays bounded with large files
+        executor = self._get_executor()
+        pending = deque()
+        try:
+            for first, count in groups:
+                pending.append(executor.submit(parse_chunks, evtx_file, first, count, self._ansi_codec))
+                if len(pending) >= self._jobs * 2:
+                    yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def stream(self, evtx_file: Path, cache_file: Path = None):
+        """
+        Parse a file and yield the JSONL records, same interface as EvtxDump.stream
+        :param evtx_file: Path - Path to the evtx file
+        :param cache_file: Path - If set, records are also written to this file for future use
+        :return: Generator of records as bytes, one JSON document per record
+        :raise RuntimeError: If the parsing failed, once the records parsed are consumed
+        """
+        cache = open_cache(cache_file, "wb") if cache_file else None
+        complete = False
+        try:
+            for record in self.iter_records(evtx_file):
+                if cache:
+                    cache.write(record)
+                yield record
+            complete = True
+
+        except Exception as e:
+            raise RuntimeError("Parsing of {evtx} failed. {error}".format(evtx=evtx_file, error=e))
+
+        finally:
+            if cache:
+                cache.close()
+                # A partial file would be taken for a complete one by a later run
+                if not complete:
+                    Path(cache_file).unlink()
+
+    def convert(self, evtx_files: list, overwrite: bool = False):
+        """
+        Convert a list of files to JSONL, largest first
+        :param evtx_files: List of Path to the evtx files
+        :param overwrite: Set to true to overwrite existing destination files
+        :return: List of the evtx files successfully converted
+        """
+        Path(self._output_path).mkdir(parents=True, exist_ok=True)
+
+        evtx_files = sorted(evtx_files, key=lambda evtx_file: os.stat(evtx_file).st_size, reverse=True)
+
+        # A file converted to the output file of another one would overwrite it
+        collisions = find_collisions(evtx_files, self.output_name)
+        results = EvtxDump._collision_results(collisions)
+
+        for evtx_file in evtx_files:
+            if evtx_file in collisions:
+                continue
+
+            start = time.time()
+            out_file = Path(self._output_path, self.output_name(evtx_file))
+            bytes_in = os.stat(evtx_file).st_size
+
+            if out_file.exists() and not overwrite:
+                log.error("Destination file {file} already exists".format(file=out_file))
+                results.append(ConversionResult(evtx_file, False, 0, bytes_in, 0, 0,
+                                                "Destination file already exists"))
+                continue
+
+            try:
+                out_file.parent.mkdir(parents=True, exist_ok=True)
+                with open_cache(out_file, "wb") as fout:
+                    for record in self.iter_records(evtx_file):
+                        fout.write(record)
+
+                results.append(ConversionResult(evtx_file, True, time.time() - start, bytes_in,
+                                                os.stat(out_file).st_size, 1))
+
+            except Exception as e:
+                if out_file.exists():
+                    out_file.unlink()
+                results.append(ConversionResult(evtx_file, False, time.time() - start, bytes_in, 0, 1, str(e)))
+
+        self.results.extend(results)
+        EvtxDump._log_results(results)
+
+        return [result.evtx_file for result in results if result.success]
+
+    def run(self, evtxdata: Path):
+        """
+        Convert a file or the files of a directory, same interface as EvtxDump.run
+        :param evtxdata: Path - File or folder to convert
+        :return: True if all the files were successfully converted, else False
+        """
+        if evtxdata.is_file():
+            list_evtx = [evtxdata]
+
+        elif evtxdata.is_dir():
+            list_evtx = [evtx for evtx in evtxdata.rglob("*.evtx*") if evtx.is_file()]
+
+        else:
+            log.error("Data is neither a file nor a folder, not supported")
+            return False
+
+        return len(self.convert(list_evtx)) == len(list_evtx)
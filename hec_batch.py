@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    HEC batch builder, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import time
+from concurrent.futures import Future, wait
+from typing import Callable, Union
+
+import json_codec
+from journal import FileCheckpoint
+
+
+class HECBatchBuilder(object):
+    """
+    Build HEC batches directly from the JSONL records of evtx_dump.
+    The envelope {"time":..,"host":..,"source":..,"sourcetype":..,"index":..,"event":..}
+    is written around the raw bytes of the record, so the event is never re-encoded.
+    Extra fields of the event are spliced before the closing brace of the record.
+    """
+
+    def __init__(self, sink: Callable[[bytes], Union[bool, Future]],
+                 max_bytes: Union[int, Callable[[], int]] = 512000, checkpoint: FileCheckpoint = None):
+        """
+        Init method of the HECBatchBuilder
+        :param sink: Callable receiving the bytes of a full batch, returns True if sent successfully
+                     or a Future of it if the batch is sent asynchronously
+        :param max_bytes: Size of the batch after which it is flushed to the sink, or a callable returning it,
+                          called again after each flush so the size can follow the sender
+        :param checkpoint: If set, the progress is saved in the checkpoint once the batches are sent
+        """
+        self._sink = sink
+        self._size_hint = max_bytes if callable(max_bytes) else None
+        self._max_bytes = max_bytes() if callable(max_bytes) else max_bytes
+        self._checkpoint = checkpoint
+        self._buffer = bytearray()
+        self._metadata = b""
+        self._offset = None
+        self._pending = []
+        self.count = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_bytes = 0
+        # Time blocked in the sink and waiting for the asynchronous batches
+        self.send_seconds = 0
+
+    @property
+    def offset(self):
+        """
+        Return the offset following the last record added
+        :return: Offset given to add, None if no record was added
+        """
+        return self._offset
+
+    def set_metadata(self, host: str, source: str, sourcetype: str, index: str = None):
+        """
+        Set the envelope fields shared by the next events
+        :param host: Host of the events
+        :param source: Source of the events
+        :param sourcetype: Source type of the events
+        :param index: Index of the events, if None the default index of the HEC token is used
+        :return: Nothing
+        """
+        metadata = {"host": host, "source": source, "sourcetype": sourcetype}
+        if index:
+            metadata["index"] = index
+
+        self._metadata = b"".join(b',"' + key.encode() + b'":' + json_codec.dumps(value)
+                                  for key, value in metadata.items())
+
+    @staticmethod
+    def encode_field(name: str, value: str):
+        """
+        Encode an extra field of the event, ready to be given to add
+        :param name: Name of the field
+        :param value: Value of the field
+        :return: Encoded field as bytes
+        """
+        return b',' + json_codec.dumps(name) + b':' + json_codec.dumps(value)
+
+    def add(self, raw: bytes, epoch: float, extra: bytes = b"", offset: int = None):
+        """
+        Add a record to the batch, flush the batch before if it would get too large
+        :param raw: Bytes of the JSON record, as output by evtx_dump
+        :param epoch: Timestamp of the event
+        :param extra: Extra fields of the event, as returned by encode_field
+        :param offset: Offset following the record in its file, saved in the checkpoint
+        :return: Nothing
+        :raise ValueError: If the record is not a JSON object
+        """
+        raw = raw.rstrip()
+        if raw[-1:] != b"}":
+            raise ValueError("Record is not a JSON object")
+
+        body = raw[:-1]
+        if extra and body[-1:] == b"{":
+            # Empty object, no separator needed before the extra fields
+            extra = extra[1:]
+
+        event = b'{"time":%r%b,"event":%b%b}}' % (epoch, self._metadata, body, extra)
+
+        if self._buffer and len(self._buffer) + len(event) > self._max_bytes:
+            self.flush()
+
+        self._buffer += event
+        self._buffer += b"\n"
+        self._offset = offset
+        self.count += 1
+
+    def flush(self):
+        """
+        Send the pending batch to the sink
+        :return: Result of the sink, True if the batch is empty
+        """
+        if not self._buffer:
+            return True
+
+        start = time.perf_counter()
+        ret = self._sink(bytes(self._buffer))
+        self.send_seconds += time.perf_counter() - start
+        self.batches += 1
+        self.batch_bytes += len(self._buffer)
+        self._buffer.clear()
+        if self._size_hint is not None:
+            self._max_bytes = self._size_hint()
+
+        if isinstance(ret, Future):
+            seq = None
+            if self._checkpoint is not None and self._offset is not None:
+                seq = self._checkpoint.register(self._offset)
+                ret.add_done_callback(lambda future: self._checkpoint.ack(seq, future.result()))
+            self._pending.append((seq, ret))
+
+        elif not ret:
+            self.errors += 1
+
+        return ret
+
+    def wait(self):
+        """
+        Wait for the batches sent asynchronously
+        :return: True if all the batches were successfully sent, else False
+        """
+        start = time.perf_counter()
+        wait([future for _, future in self._pending])
+        self.send_seconds += time.perf_counter() - start
+        for seq, future in self._pending:
+            if not future.result():
+                self.errors += 1
+
+            # Done callbacks may still be running, the checkpoint ignores double acks
+            if seq is not None:
+                self._checkpoint.ack(seq, future.result())
+
+        self._pending = []
+
+        return self.errors == 0
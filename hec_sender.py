@@ -0,0 +1,650 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Splunk HEC sender, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import gzip
+import logging as log
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import List
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+# Status of the HEC when it can't keep up, the batch is retried after a backoff
+THROTTLING_STATUS = (429, 503)
+
+# Smallest batch the adaptive controller shrinks to
+MIN_BATCH_BYTES = 64 * 1024
+
+
+def backoff_delay(attempt: int, retry_after: float = None, base: float = 0.5, cap: float = 30):
+    """
+    Return the time to wait before retrying a batch. The delay grows exponentially with
+    the attempts and is drawn at random below it, so the senders don't retry all at once
+    :param attempt: Number of the attempt, from 1
+    :param retry_after: Delay requested by the server in its Retry-After header, if any
+    :param base: Delay of the first attempt in seconds
+    :param cap: Max delay in seconds
+    :return: Delay in seconds
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+
+    return delay
+
+
+def parse_retry_after(value: str):
+    """
+    Return the delay of a Retry-After header
+    :param value: Value of the header, None if not set
+    :return: Delay in seconds, None if not set or not a number of seconds
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveController(object):
+    """
+    Size the batches and the number of concurrent requests from the feedback of the HEC.
+    While the requests succeed and their latency per byte stays close to the best seen, the
+    window of concurrent requests grows by one and the batches by a quarter every window of
+    successful requests. When the HEC is throttling (429, 503) or the latency per byte doubles,
+    which is the indexers queueing, both are halved, at most once per second.
+    Not thread safe, callers hold their own lock.
+    """
+
+    def __init__(self, max_in_flight: int, batch_bytes: int, max_batch_bytes: int = None, adaptive: bool = True,
+                 latency_factor: float = 2, cooldown: float = 1):
+        """
+        Init method of the AdaptiveController
+        :param max_in_flight: Max number of concurrent requests
+        :param batch_bytes: Initial size of the batches
+        :param max_batch_bytes: Max size of the batches, default to batch_bytes
+        :param adaptive: False to keep max_in_flight and batch_bytes
+        :param latency_factor: Increase of the latency per byte, relative to the best seen, seen as congestion
+        :param cooldown: Min time in seconds between two decreases
+        """
+        self.max_in_flight = max_in_flight
+        self.adaptive = adaptive
+        self.limit = min(2, max_in_flight) if adaptive else max_in_flight
+        self.batch_bytes = batch_bytes
+        self._min_batch_bytes = min(batch_bytes, MIN_BATCH_BYTES)
+        self._max_batch_bytes = max(batch_bytes, max_batch_bytes or batch_bytes)
+        self._latency_factor = latency_factor
+        self._cooldown = cooldown
+        self._successes = 0
+        self._best = None
+        self._average = None
+        self._decreased_at = 0
+
+    def on_success(self, latency: float, size: int):
+        """
+        Account a successful request
+        :param latency: Time of the request in seconds
+        :param size: Size of the posted data
+        :return: Nothing
+        """
+        if not self.adaptive:
+            return
+
+        per_byte = latency / max(size, 1)
+        self._best = per_byte if self._best is None else min(self._best, per_byte)
+        self._average = per_byte if self._average is None else 0.8 * self._average + 0.2 * per_byte
+
+        if self._average > self._best * self._latency_factor:
+            self.on_congestion()
+            return
+
+        self._successes += 1
+        if self._successes >= self.limit:
+            self._successes = 0
+            self.limit = min(self.max_in_flight, self.limit + 1)
+            self.batch_bytes = min(self._max_batch_bytes, self.batch_bytes + self.batch_bytes // 4)
+
+    def on_congestion(self):
+        """
+        Account a throttled request or a rise of the latency
+        :return: Nothing
+        """
+        if not self.adaptive:
+            return
+
+        now = time.monotonic()
+        if now - self._decreased_at < self._cooldown:
+            return
+
+        self._decreased_at = now
+        self.limit = max(1, self.limit // 2)
+        self.batch_bytes = max(self._min_batch_bytes, self.batch_bytes // 2)
+        self._successes = 0
+        # Latency is measured again from the new window
+        self._best = None
+        self._average = None
+
+
+class HECEndpoint(object):
+    """
+    State of one HEC endpoint of the sender
+    """
+
+    def __init__(self, url: str):
+        """
+        Init method of the HECEndpoint
+        :param url: Base URL of the HEC endpoint, for instance https://splunk:8088
+        """
+        self.url = url.rstrip("/")
+        self.channel = str(uuid.uuid4())
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0
+        # Batches waiting for the indexer acknowledgement, ack id to (Future of the batch, deadline)
+        self.pending_acks = {}
+
+    def is_healthy(self, now: float):
+        """
+        Return whether the endpoint can receive batches
+        :param now: Current time
+        :return: True if not ejected
+        """
+        return self.ejected_until <= now
+
+
+class EndpointBalancer(object):
+    """
+    Pick the HEC endpoint of each request, in round-robin or to the endpoint with the
+    least outstanding requests. An endpoint failing several times in a row is ejected
+    for a while, unless all the endpoints are. Thread safe, and shared by the senders
+    of the thread and async engines
+    """
+
+    def __init__(self, endpoints: List[HECEndpoint], balancing: str = "round_robin", max_failures: int = 3,
+                 eject_time: int = 30):
+        """
+        Init method of the EndpointBalancer
+        :param endpoints: HEC endpoints
+        :param balancing: round_robin or least_outstanding
+        :param max_failures: Number of consecutive failures after which an endpoint is ejected
+        :param eject_time: Time in seconds an endpoint stays ejected
+        """
+        self.endpoints = endpoints
+        self._balancing = balancing
+        self._max_failures = max_failures
+        self._eject_time = eject_time
+        self._next_endpoint = 0
+        self._lock = threading.Lock()
+
+    def pick(self, excluded: list):
+        """
+        Pick the endpoint of the next request and count it as outstanding
+        :param excluded: Endpoints already tried for the batch
+        :return: HECEndpoint or None if all the endpoints were tried
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in excluded]
+            if not candidates:
+                return None
+
+            healthy = [endpoint for endpoint in candidates if endpoint.is_healthy(now)]
+            if not healthy:
+                # Everything is ejected, try the one coming back the soonest
+                endpoint = min(candidates, key=lambda item: item.ejected_until)
+
+            elif self._balancing == "least_outstanding":
+                endpoint = min(healthy, key=lambda item: item.outstanding)
+
+            else:
+                endpoint = healthy[self._next_endpoint % len(healthy)]
+                self._next_endpoint += 1
+
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint: HECEndpoint, success: bool):
+        """
+        Update the health of an endpoint once a request is done
+        :param endpoint: Endpoint of the request
+        :param success: True if the request succeeded
+        :return: Nothing
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success:
+                endpoint.failures = 0
+                return
+
+            endpoint.failures += 1
+            if endpoint.failures >= self._max_failures and endpoint.is_healthy(time.time()):
+                log.warning("Ejecting HEC endpoint {url} for {time}s".format(url=endpoint.url, time=self._eject_time))
+                endpoint.ejected_until = time.time() + self._eject_time
+
+
+class HECSender(object):
+    """
+    Send batches of events to one or several Splunk HEC endpoints.
+    Batches are posted by a pool of threads sharing a keep-alive session, so several
+    batches can be in flight at the same time. Each batch is tracked with a Future.
+    With the HEC indexer acknowledgement, the Future is only resolved once the indexers
+    acknowledged the batch, the ack ids being polled by a background thread, so the
+    progress saved from the Futures never goes past data Splunk could still lose.
+    With several endpoints, batches are distributed in round-robin or to the endpoint
+    with the least outstanding requests. An endpoint failing several times in a row is
+    ejected for a while and its batches are retried on the other endpoints.
+    The number of concurrent requests and the size of the batches follow an AdaptiveController.
+    Batches failing on every endpoint, or throttled by the HEC, are retried after a backoff.
+    """
+
+    def __init__(self, urls: List[str], token: str, ssl_verify: bool = False, max_in_flight: int = 4,
+                 compress: bool = True, use_ack: bool = False, timeout: int = 60,
+                 balancing: str = "round_robin", max_failures: int = 3, eject_time: int = 30, metrics=None,
+                 batch_bytes: int = 512000, max_batch_bytes: int = None, adaptive: bool = True, max_retries: int = 8,
+                 ack_timeout: int = 300, ack_poll_interval: float = 1):
+        """
+        Init method of the HECSender
+        :param urls: Base URLs of the HEC endpoints, for instance https://splunk:8088
+        :param token: HEC token
+        :param ssl_verify: True to check ssl certificate
+        :param max_in_flight: Max number of batches posted at the same time
+        :param compress: True to gzip the batches
+        :param use_ack: True to wait for the indexer acknowledgement of the batches.
+                        The HEC token needs to have useACK enabled
+        :param timeout: Timeout of the requests in seconds
+        :param balancing: round_robin or least_outstanding
+        :param max_failures: Number of consecutive failures after which an endpoint is ejected
+        :param eject_time: Time in seconds an endpoint stays ejected
+        :param metrics: If set, Metrics counting the requests and their latency
+        :param batch_bytes: Initial size of the batches, see batch_bytes
+        :param max_batch_bytes: Max size of the batches when adaptive
+        :param adaptive: True to adapt the concurrent requests and the size of the batches to the HEC feedback
+        :param max_retries: Number of retries of a batch after it failed on every endpoint
+        :param ack_timeout: Time in seconds after which a batch not acknowledged by the indexers is failed
+        :param ack_poll_interval: Time in seconds between two polls of the ack endpoints
+        """
+        self._endpoints = [HECEndpoint(url) for url in urls]
+        self._balancer = EndpointBalancer(self._endpoints, balancing, max_failures, eject_time)
+        self._ssl_verify = ssl_verify
+        self._compress = compress
+        self._use_ack = use_ack
+        self._timeout = timeout
+        self._metrics = metrics
+        self._max_retries = max_retries
+        self._ack_timeout = ack_timeout
+        self._ack_poll_interval = ack_poll_interval
+
+        # Window of concurrent requests, sized by the controller
+        self._control = AdaptiveController(max_in_flight, batch_bytes, max_batch_bytes, adaptive=adaptive)
+        self._window = threading.Condition()
+        self._in_flight = 0
+
+        if not self._ssl_verify:
+            requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self._endpoints), pool_maxsize=max_in_flight)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._session.headers.update({"Authorization": "Splunk {token}".format(token=token)})
+
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+        # Bound the number of batches waiting to be sent so memory stays flat
+        # when the endpoint is slower than the producers
+        self._slots = threading.BoundedSemaphore(max_in_flight * 2)
+
+        self._lock = threading.Lock()
+        self._outstanding = set()
+        self._unacked = set()
+        self._missed_acks = 0
+
+        self.batches_sent = 0
+        self.batches_failed = 0
+        self.bytes_sent = 0
+
+        self._closing = threading.Event()
+        self._ack_poller = None
+        if self._use_ack:
+            self._ack_poller = threading.Thread(target=self._poll_acks_loop, daemon=True)
+            self._ack_poller.start()
+
+    @property
+    def batch_bytes(self):
+        """
+        Return the size of the next batches advised by the controller
+        :return: Size in bytes
+        """
+        return self._control.batch_bytes
+
+    def send(self, payload: bytes):
+        """
+        Queue a batch to be posted. Blocks if too many batches are already waiting
+        :param payload: Bytes of the batch
+        :return: Future resolved to True if the batch was successfully posted, and acknowledged by
+                 the indexers with the indexer acknowledgement, else False
+        """
+        indexed = Future() if self._use_ack else None
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._post, payload, indexed)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._outstanding.add(future)
+            if indexed is not None:
+                self._unacked.add(indexed)
+        future.add_done_callback(self._release)
+
+        if indexed is None:
+            return future
+
+        indexed.add_done_callback(self._release_ack)
+        future.add_done_callback(lambda posted: self._on_posted(posted, indexed))
+        return indexed
+
+    def _release(self, future: Future):
+        """
+        Release the slot of a finished batch
+        :param future: Future of the batch
+        :return: Nothing
+        """
+        with self._lock:
+            self._outstanding.discard(future)
+        self._slots.release()
+
+    @staticmethod
+    def _on_posted(posted: Future, indexed: Future):
+        """
+        Fail the acknowledgement of a batch which could not be posted. Posted batches are
+        resolved by the ack poller, or right away if the HEC returned no ack id
+        :param posted: Future of the post of the batch
+        :param indexed: Future of the acknowledgement of the batch
+        :return: Nothing
+        """
+        if posted.exception() is not None or not posted.result():
+            indexed.set_result(False)
+
+    def _release_ack(self, indexed: Future):
+        """
+        Forget a batch once its acknowledgement is resolved
+        :param indexed: Future of the acknowledgement of the batch
+        :return: Nothing
+        """
+        with self._lock:
+            self._unacked.discard(indexed)
+
+    def _post(self, payload: bytes, indexed: Future = None):
+        """
+        Post a batch to the HEC endpoints. Connection and server errors are retried
+        on each other endpoint. Once all of them failed, or if the HEC is throttling,
+        the batch is retried after a backoff
+        :param payload: Bytes of the batch
+        :param indexed: With the indexer acknowledgement, Future resolved once the batch is acknowledged
+        :return: True if successfully posted, else False
+        """
+        headers = {}
+        data = payload
+        if self._compress:
+            data = gzip.compress(payload, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+
+        tried = []
+        attempt = 0
+        retry_after = None
+        while True:
+            endpoint = self._balancer.pick(tried) if retry_after is None else None
+            if endpoint is None:
+                attempt += 1
+                if attempt > self._max_retries:
+                    with self._lock:
+                        self.batches_failed += 1
+                    return False
+
+                self._observe_retry()
+                time.sleep(backoff_delay(attempt, retry_after))
+                tried = []
+                retry_after = None
+                continue
+
+            tried.append(endpoint)
+            if self._use_ack:
+                headers["X-Splunk-Request-Channel"] = endpoint.channel
+
+            self._acquire_window()
+            start = time.perf_counter()
+            try:
+                response = self._session.post(url=endpoint.url + "/services/collector/event",
+                                              data=data,
+                                              headers=headers,
+                                              verify=self._ssl_verify,
+                                              timeout=self._timeout)
+            except Exception as e:
+                log.warning("{url} : {error}".format(url=endpoint.url, error=e))
+                self._release_window()
+                self._observe(start, len(data), error=True)
+                self._balancer.release(endpoint, success=False)
+                continue
+
+            latency = time.perf_counter() - start
+            self._release_window(latency, len(data), response.status_code)
+            self._observe(start, len(data), error=response.status_code != 200)
+
+            if response.status_code in THROTTLING_STATUS:
+                # The HEC is busy, not broken, keep the endpoint and retry after a backoff
+                log.debug("HEC throttling on {url}. Status {status}".format(url=endpoint.url,
+                                                                            status=response.status_code))
+                self._balancer.release(endpoint, success=True)
+                retry_after = parse_retry_after(response.headers.get("Retry-After")) or 0
+                continue
+
+            if response.status_code >= 500:
+                log.warning("HEC error on {url}. Status {status} : {message}".format(url=endpoint.url,
+                                                                                     status=response.status_code,
+                                                                                     message=response.text))
+                self._balancer.release(endpoint, success=False)
+                continue
+
+            self._balancer.release(endpoint, success=True)
+            break
+
+        if response.status_code != 200:
+            log.warning("HEC error on {url}. Status {status} : {message}".format(url=endpoint.url,
+                                                                                 status=response.status_code,
+                                                                                 message=response.text))
+            with self._lock:
+                self.batches_failed += 1
+            return False
+
+        ack_id = None
+        if indexed is not None:
+            try:
+                ack_id = response.json().get("ackId")
+            except ValueError:
+                pass
+
+        with self._lock:
+            self.batches_sent += 1
+            self.bytes_sent += len(data)
+
+            if ack_id is not None:
+                endpoint.pending_acks[ack_id] = (indexed, time.time() + self._ack_timeout)
+                return True
+
+        if indexed is not None:
+            # No ack id, the token does not have the indexer acknowledgement enabled
+            indexed.set_result(True)
+
+        return True
+
+    def _acquire_window(self):
+        """
+        Wait for a slot in the window of concurrent requests
+        :return: Nothing
+        """
+        with self._window:
+            while self._in_flight >= self._control.limit:
+                self._window.wait()
+            self._in_flight += 1
+
+    def _release_window(self, latency: float = None, size: int = 0, status: int = None):
+        """
+        Release a slot of the window and give the feedback of the request to the controller
+        :param latency: Time of the request, None if it did not complete
+        :param size: Size of the posted data
+        :param status: HTTP status of the request
+        :return: Nothing
+        """
+        with self._window:
+            self._in_flight -= 1
+            if status in THROTTLING_STATUS:
+                self._control.on_congestion()
+            elif status == 200:
+                self._control.on_success(latency, size)
+            self._window.notify_all()
+
+    def _observe_retry(self):
+        """
+        Count a retry in the metrics
+        :return: Nothing
+        """
+        if self._metrics is not None:
+            self._metrics.inc("hec_retries")
+
+    def _observe(self, start: float, size: int, error: bool):
+        """
+        Count a request in the metrics
+        :param start: perf_counter value when the request was started
+        :param size: Size of the posted data
+        :param error: True if the request failed
+        :return: Nothing
+        """
+        if self._metrics is None:
+            return
+
+        self._metrics.add({"hec_requests": 1,
+                           "hec_request_seconds": time.perf_counter() - start,
+                           "hec_bytes": size,
+                           "hec_errors": 1 if error else 0})
+
+    def flush(self):
+        """
+        Wait for all the queued batches to be posted
+        :return: Nothing
+        """
+        with self._lock:
+            outstanding = list(self._outstanding)
+        wait(outstanding)
+
+    def wait_acks(self, timeout: int = None):
+        """
+        Wait for the indexer acknowledgement of the posted batches
+        :param timeout: Max time to wait in seconds, None to wait until each batch is acknowledged
+                        or reaches the ack timeout
+        :return: Number of batches not acknowledged since the previous call
+        """
+        if not self._use_ack:
+            return 0
+
+        self.flush()
+        with self._lock:
+            unacked = list(self._unacked)
+        not_done = wait(unacked, timeout=timeout).not_done
+
+        with self._lock:
+            missing = self._missed_acks + len(not_done)
+            self._missed_acks = 0
+
+        if missing:
+            log.warning("{count} batches were not acknowledged by the indexers".format(count=missing))
+
+        return missing
+
+    def _poll_acks_loop(self):
+        """
+        Poll the acknowledgement of the posted batches until the sender is closed,
+        and fail the batches not acknowledged in time
+        :return: Nothing
+        """
+        while not self._closing.wait(self._ack_poll_interval):
+            for endpoint in self._endpoints:
+                with self._lock:
+                    ack_ids = list(endpoint.pending_acks)
+                if ack_ids:
+                    self._poll_acks(endpoint, ack_ids)
+
+            now = time.time()
+            expired = []
+            with self._lock:
+                for endpoint in self._endpoints:
+                    for ack_id, (indexed, deadline) in list(endpoint.pending_acks.items()):
+                        if deadline < now:
+                            expired.append(endpoint.pending_acks.pop(ack_id)[0])
+                self._missed_acks += len(expired)
+
+            for indexed in expired:
+                indexed.set_result(False)
+
+    def _poll_acks(self, endpoint: HECEndpoint, ack_ids: list):
+        """
+        Query the acknowledgement status of batches sent to an endpoint and resolve
+        the batches acknowledged
+        :param endpoint: Endpoint the batches were sent to
+        :param ack_ids: Ack ids to query
+        :return: Nothing
+        """
+        try:
+            response = self._session.post(url=endpoint.url + "/services/collector/ack",
+                                          json={"acks": ack_ids},
+                                          headers={"X-Splunk-Request-Channel": endpoint.channel},
+                                          verify=self._ssl_verify,
+                                          timeout=self._timeout)
+            acks = response.json().get("acks", {}) if response.status_code == 200 else {}
+        except Exception as e:
+            log.warning("{url} : {error}".format(url=endpoint.url, error=e))
+            acks = {}
+
+        acknowledged = []
+        with self._lock:
+            for ack_id, acked in acks.items():
+                if acked and int(ack_id) in endpoint.pending_acks:
+                    acknowledged.append(endpoint.pending_acks.pop(int(ack_id))[0])
+
+        # Callbacks of the batches save the progress, they run outside of the lock
+        for indexed in acknowledged:
+            indexed.set_result(True)
+
+    def close(self):
+        """
+        Wait for the pending batches and their acknowledgement, then release the connections
+        :return: Number of batches failed or not acknowledged
+        """
+        self.flush()
+        missing = self.wait_acks()
+        self._closing.set()
+        if self._ack_poller is not None:
+            self._ack_poller.join()
+        self._executor.shutdown()
+        self._session.close()
+
+        if self._control.adaptive and self.batches_sent:
+            log.debug("HEC window settled at {limit} requests and {size} bytes per batch".format(
+                limit=self._control.limit, size=self._control.batch_bytes))
+
+        return self.batches_failed + missing
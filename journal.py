@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Checkpoint journal, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+class CheckpointJournal(object):
+    """
+    Keep track of what was sent from each cached JSON file, so an interrupted
+    ingest can be resumed without sending the same events twice.
+    For each file, the journal records the offset of the first byte not yet acknowledged
+    by Splunk and whether the file is completely sent. Batches are acknowledged by the
+    Futures of HECSender, resolved on the HTTP answer or, with the indexer acknowledgement,
+    once the indexers acknowledged them. Files are identified by their path relative to
+    the folder of the journal, see key. The journal is a SQLite database, so it can be
+    shared by several ingest processes.
+    """
+
+    def __init__(self, path: Path):
+        """
+        Init method of the CheckpointJournal
+        :param path: Path of the journal database
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                source TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                done INTEGER NOT NULL,
+                PRIMARY KEY (source, start)
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS evtx_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sha256 TEXT NOT NULL,
+                json_file TEXT NOT NULL,
+                indexed INTEGER NOT NULL
+            )""")
+        self._conn.commit()
+
+    @property
+    def path(self):
+        """
+        Path of the journal database
+        """
+        return self._path
+
+    def key(self, path: Path):
+        """
+        Return the name of a cached file in the journal, its path relative to the folder of the journal,
+        so files of the same name in different sub-folders have their own checkpoints
+        :param path: Path of the cached file
+        :return: Relative path with / separators, the file name if it's not in the folder of the journal
+        """
+        try:
+            return Path(path).relative_to(Path(self._path).parent).as_posix()
+        except ValueError:
+            return Path(path).name
+
+    def reset(self):
+        """
+        Forget all the checkpoints
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints")
+            self._conn.commit()
+
+    def forget(self, source: str):
+        """
+        Forget the checkpoints of a file, so it is sent again from the start
+        :param source: Name of the file, as returned by key
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE source = ?", (source,))
+            self._conn.commit()
+
+    def checkpoint(self, source: str, start: int = 0, end: int = None):
+        """
+        Return the checkpoint of a file, created if the file is not known yet
+        :param source: Name of the file, as returned by key
+        :param start: Offset of the first byte of the file to send
+        :param end: Offset of the end of the file to send, None for the end of file
+        :return: FileCheckpoint
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT end, offset, done FROM checkpoints WHERE source = ? AND start = ?",
+                                     (source, start)).fetchone()
+            if row is None:
+                row = (end, start, 0)
+                self._conn.execute("INSERT INTO checkpoints (source, start, end, offset, done) VALUES (?, ?, ?, ?, ?)",
+                                   (source, start, -1 if end is None else end, start, 0))
+                self._conn.commit()
+
+        end, offset, done = row
+        return FileCheckpoint(self, source, start, None if end == -1 else end, offset, bool(done))
+
+    def ranges(self, source: str):
+        """
+        Return the ranges of a file known by the journal
+        :param source: Name of the file, as returned by key
+        :return: List of (start, end), end being None for the end of file
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT start, end FROM checkpoints WHERE source = ? ORDER BY start",
+                                      (source,)).fetchall()
+
+        return [(start, None if end == -1 else end) for start, end in rows]
+
+    def _update(self, source: str, start: int, offset: int, done: bool):
+        """
+        Save the progress of a file
+        :param source: Name of the file, as returned by key
+        :param start: Offset of the first byte of the file to send
+        :param offset: Offset of the first byte not acknowledged
+        :param done: True if the file is completely sent
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute("UPDATE checkpoints SET offset = ?, done = ? WHERE source = ? AND start = ?",
+                               (offset, int(done), source, start))
+            self._conn.commit()
+
+    def get_evtx(self, path: str):
+        """
+        Return what is known of an EVTX file converted in a previous run
+        :param path: Path of the EVTX file, relative to the input folder
+        :return: Tuple (size, mtime, sha256, json_file, indexed) or None if unknown
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime, sha256, json_file, indexed FROM evtx_files WHERE path = ?",
+                                     (path,)).fetchone()
+
+        return None if row is None else (row[0], row[1], row[2], row[3], bool(row[4]))
+
+    def set_evtx(self, path: str, size: int, mtime: float, sha256: str, json_file: str):
+        """
+        Record a converted EVTX file, not indexed yet
+        :param path: Path of the EVTX file, relative to the input folder
+        :param size: Size of the EVTX file
+        :param mtime: Modification time of the EVTX file
+        :param sha256: Hash of the content of the EVTX file
+        :param json_file: Path of the converted file relative to the cache folder, as returned by key
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO evtx_files (path, size, mtime, sha256, json_file, indexed) "
+                               "VALUES (?, ?, ?, ?, ?, 0)", (path, size, mtime, sha256, json_file))
+            self._conn.commit()
+
+    def touch_evtx(self, path: str, size: int, mtime: float):
+        """
+        Update the size and modification time of an EVTX file whose content did not change
+        :param path: Path of the EVTX file, relative to the input folder
+        :param size: Size of the EVTX file
+        :param mtime: Modification time of the EVTX file
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute("UPDATE evtx_files SET size = ?, mtime = ? WHERE path = ?", (size, mtime, path))
+            self._conn.commit()
+
+    def mark_indexed(self):
+        """
+        Mark as indexed the EVTX files whose JSON file is completely sent
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute("UPDATE evtx_files SET indexed = 1 WHERE json_file IN "
+                               "(SELECT source FROM checkpoints GROUP BY source HAVING MIN(done) = 1)")
+            self._conn.commit()
+
+    def close(self):
+        """
+        Close the journal database
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.close()
+
+
+class FileCheckpoint(object):
+    """
+    Progress of one file. Batches are registered with the offset following their
+    last record and acknowledged once sent, or once indexed with the indexer acknowledgement. As batches can complete out of order,
+    the saved offset only moves forward to the end of the last batch for which all
+    the previous batches were successfully sent.
+    """
+
+    def __init__(self, journal: CheckpointJournal, source: str, start: int, end: int, offset: int, done: bool):
+        """
+        Init method of the FileCheckpoint
+        :param journal: Journal holding the checkpoint
+        :param source: Name of the file, as returned by CheckpointJournal.key
+        :param start: Offset of the first byte of the file to send
+        :param end: Offset of the end of the file to send, None for the end of file
+        :param offset: Offset of the first byte not acknowledged
+        :param done: True if the file is completely sent
+        """
+        self._journal = journal
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._next_seq = 0
+        self._failed = False
+        self.source = source
+        self.start = start
+        self.end = end
+        self.offset = offset
+        self.done = done
+
+    def register(self, offset: int):
+        """
+        Register a batch about to be sent
+        :param offset: Offset following the last record of the batch
+        :return: Sequence number of the batch, to give to ack
+        """
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._pending[seq] = [offset, None]
+
+        return seq
+
+    def ack(self, seq: int, success: bool):
+        """
+        Acknowledge a batch and save the progress if possible. Acknowledging
+        the same batch twice has no effect
+        :param seq: Sequence number of the batch
+        :param success: True if the batch was successfully sent
+        :return: Nothing
+        """
+        with self._lock:
+            entry = self._pending.get(seq)
+            if entry is None or entry[1] is not None:
+                # Already acknowledged
+                return
+
+            entry[1] = success
+            if not success:
+                self._failed = True
+
+            offset = None
+            while self._pending and not self._failed:
+                first_offset, first_success = next(iter(self._pending.values()))
+                if first_success is None:
+                    break
+                offset = first_offset
+                self._pending.popitem(last=False)
+
+            if offset is not None:
+                self.offset = offset
+                self._journal._update(self.source, self.start, offset, False)
+
+    def complete(self, success: bool, offset: int):
+        """
+        Mark the file as completely sent if all its batches were acknowledged
+        :param success: True if all the batches were successfully sent
+        :param offset: Offset of the end of the data read
+        :return: Nothing
+        """
+        with self._lock:
+            if not success or self._failed or self._pending:
+                return
+            self.offset = offset
+            self.done = True
+            self._journal._update(self.source, self.start, offset, True)
+
+
+def hash_file(path: Path, block_size: int = 1024 * 1024):
+    """
+    Return the SHA256 of the content of a file
+    :param path: Path of the file
+    :param block_size: Size of the blocks read
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fdata:
+        for block in iter(lambda: fdata.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    JSON codecs, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import json
+import threading
+from typing import NamedTuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# Backends by order of preference
+BACKENDS = ("simdjson", "orjson", "json")
+
+
+class SystemFields(NamedTuple):
+    """
+    Fields of the System part of a record needed to build its HEC event
+    """
+    computer: str = None
+    system_time: str = None
+    channel: str = None
+    provider: str = None
+    event_id: int = None
+    record_id: int = None
+
+
+def _to_int(value):
+    """
+    Return the integer of a System field, which may hold attributes
+    :param value: Value as output by evtx_dump
+    :return: int or None
+    """
+    if isinstance(value, dict):
+        value = value.get("#text")
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _system_fields(system: dict):
+    """
+    Pick the fields of the System part of a record
+    :param system: System part of the record
+    :return: SystemFields
+    :raise ValueError: If the System part is not an object
+    """
+    if not isinstance(system, dict):
+        raise ValueError("Record without System")
+
+    provider = system.get("Provider")
+    time_created = system.get("TimeCreated")
+
+    return SystemFields(computer=system.get("Computer"),
+                        system_time=time_created.get("#attributes", {}).get("SystemTime")
+                        if isinstance(time_created, dict) else None,
+                        channel=system.get("Channel"),
+                        provider=provider.get("#attributes", {}).get("Name") if isinstance(provider, dict) else None,
+                        event_id=_to_int(system.get("EventID")),
+                        record_id=_to_int(system.get("EventRecordID")))
+
+
+class StdlibCodec(object):
+    """
+    Codec based on the json module of the standard library. Records are fully decoded to get
+    their System fields. Scanning only the System object saves little, and would let a corrupt
+    record through, its whole batch being then rejected by the HEC
+    """
+    name = "json"
+
+    @staticmethod
+    def loads(data):
+        """
+        Decode a JSON document
+        :param data: Bytes or str of the document
+        :return: Decoded object
+        :raise ValueError: If the document is not valid
+        """
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        """
+        Encode an object to JSON
+        :param obj: Object to encode
+        :return: Bytes of the document
+        """
+        return json.dumps(obj).encode()
+
+    @staticmethod
+    def system_fields(line: bytes):
+        """
+        Return the System fields of a record
+        :param line: Bytes of the JSON record
+        :return: SystemFields
+        :raise ValueError: If the record is not valid
+        """
+        record = json.loads(line)
+        try:
+            return _system_fields(record["Event"]["System"])
+        except (KeyError, TypeError):
+            raise ValueError("Record without System")
+
+
+class OrjsonCodec(object):
+    """
+    Codec based on orjson. Decoding a whole record with orjson is faster than
+    scanning its System object with the standard library, so records are fully decoded
+    """
+    name = "orjson"
+
+    @staticmethod
+    def loads(data):
+        """
+        Decode a JSON document
+        :param data: Bytes or str of the document
+        :return: Decoded object
+        :raise ValueError: If the document is not valid
+        """
+        return orjson.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        """
+        Encode an object to JSON
+        :param obj: Object to encode
+        :return: Bytes of the document
+        """
+        return orjson.dumps(obj)
+
+    @staticmethod
+    def system_fields(line: bytes):
+        """
+        Return the System fields of a record
+        :param line: Bytes of the JSON record
+        :return: SystemFields
+        :raise ValueError: If the record is not valid
+        """
+        record = orjson.loads(line)
+        try:
+            return _system_fields(record["Event"]["System"])
+        except (KeyError, TypeError):
+            raise ValueError("Record without System")
+
+
+class SimdjsonCodec(object):
+    """
+    Codec based on pysimdjson. Records are parsed into a lazy document and only the System
+    fields are converted to Python objects. Parsers are reused and not thread safe, so each
+    thread has its own
+    """
+    name = "simdjson"
+
+    # Fields of SystemFields, relative to the System object
+    _POINTERS = ("/Computer",
+                 "/TimeCreated/#attributes/SystemTime",
+                 "/Channel",
+                 "/Provider/#attributes/Name")
+
+    def __init__(self):
+        """
+        Init method of the SimdjsonCodec
+        """
+        self._local = threading.local()
+
+    def _parser(self):
+        """
+        Return the parser of the current thread
+        :return: simdjson.Parser
+        """
+        parser = getattr(self._local, "parser", None)
+        if parser is None:
+            parser = simdjson.Parser()
+            self._local.parser = parser
+
+        return parser
+
+    def loads(self, data):
+        """
+        Decode a JSON document
+        :param data: Bytes or str of the document
+        :return: Decoded object
+        :raise ValueError: If the document is not valid
+        """
+        return self._parser().parse(data, recursive=True)
+
+    @staticmethod
+    def dumps(obj):
+        """
+        Encode an object to JSON
+        :param obj: Object to encode
+        :return: Bytes of the document
+        """
+        return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode()
+
+    def system_fields(self, line: bytes):
+        """
+        Return the System fields of a record, converting only these fields
+        :param line: Bytes of the JSON record
+        :return: SystemFields
+        :raise ValueError: If the record is not valid
+        """
+        document = self._parser().parse(line)
+        try:
+            system = document.at_pointer("/Event/System")
+        except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+            system = None
+
+        if not isinstance(system, simdjson.Object):
+            raise ValueError("Record without System")
+
+        values = []
+        for pointer in self._POINTERS:
+            try:
+                value = system.at_pointer(pointer)
+            except (KeyError, IndexError, TypeError, ValueError):
+                value = None
+            values.append(value if isinstance(value, str) else None)
+
+        try:
+            event_id = system.at_pointer("/EventID")
+            if isinstance(event_id, simdjson.Object):
+                event_id = event_id.get("#text")
+        except (KeyError, IndexError, TypeError, ValueError):
+            event_id = None
+
+        try:
+            record_id = system.at_pointer("/EventRecordID")
+        except (KeyError, IndexError, TypeError, ValueError):
+            record_id = None
+
+        return SystemFields(*values, event_id=_to_int(event_id), record_id=_to_int(record_id))
+
+
+def is_available(name: str):
+    """
+    Return whether a backend can be used
+    :param name: Name of the backend
+    :return: True if its module is installed
+    """
+    return {"orjson": orjson, "simdjson": simdjson, "json": json}.get(name) is not None
+
+
+def get_codec(name: str = "auto"):
+    """
+    Return a codec
+    :param name: Name of the backend, auto for the fastest one installed
+    :return: Codec
+    :raise ValueError: If the backend is unknown or not installed
+    """
+    if name == "auto":
+        name = next(backend for backend in BACKENDS if is_available(backend))
+
+    if name not in BACKENDS:
+        raise ValueError("Unknown JSON backend {name}".format(name=name))
+
+    if not is_available(name):
+        raise ValueError("JSON backend {name} is not installed".format(name=name))
+
+    return {"orjson": OrjsonCodec, "simdjson": SimdjsonCodec, "json": StdlibCodec}[name]()
+
+
+# Codec of the process, changed with use
+codec = get_codec()
+loads = codec.loads
+dumps = codec.dumps
+system_fields = codec.system_fields
+
+
+def use(name: str = "auto"):
+    """
+    Select the codec used by the module functions loads, dumps and system_fields.
+    Callers must access them through the module to see the change
+    :param name: Name of the backend, auto for the fastest one installed
+    :return: Codec
+    :raise ValueError: If the backend is unknown or not installed
+    """
+    global codec, loads, dumps, system_fields
+
+    codec = get_codec(name)
+    loads = codec.loads
+    dumps = codec.dumps
+    system_fields = codec.system_fields
+
+    return codec
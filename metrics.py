@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Ingest metrics, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import json
+import logging as log
+import multiprocessing
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Counters reported in the summary, with their description
+SUMMARY = (
+    ("events", "events sent"),
+    ("bytes_read", "bytes of records read"),
+    ("parse_errors", "records not decoded"),
+    ("filtered", "events filtered out"),
+    ("duplicates", "duplicate events dropped"),
+    ("batches", "batches"),
+    ("batch_bytes", "bytes of batches"),
+    ("hec_requests", "HEC requests"),
+    ("hec_errors", "HEC errors"),
+    ("hec_retries", "HEC retries after a backoff"),
+    ("hec_bytes", "bytes posted to HEC"),
+    ("convert_files", "files converted"),
+    ("convert_errors", "files not converted"),
+    ("convert_seconds", "seconds converting"),
+    ("process_seconds", "seconds reading and decoding"),
+    ("send_seconds", "seconds sending"),
+    ("hec_request_seconds", "seconds of HEC requests"),
+)
+
+
+def worker_name():
+    """
+    Return the name of the current worker, process and thread
+    :return: Name of the worker
+    """
+    return "{process}/{thread}".format(process=multiprocessing.current_process().name,
+                                      thread=threading.current_thread().name)
+
+
+class Metrics(object):
+    """
+    Counters of an ingest. Each counter is labelled with the worker updating it and,
+    for the ingest stages, with the file being processed. Counters of the worker
+    processes are drained after each work item and merged into the parent ones.
+    """
+
+    def __init__(self):
+        """
+        Init method of the Metrics
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self.started = time.time()
+
+    def add(self, values: dict, file: str = None):
+        """
+        Add values to counters of the current worker
+        :param values: Dict of counter name to value to add
+        :param file: File the values relate to, if any
+        :return: Nothing
+        """
+        labels = (worker_name(), file)
+        with self._lock:
+            for name, value in values.items():
+                key = (name, labels)
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def inc(self, name: str, value: float = 1, file: str = None):
+        """
+        Add a value to a counter of the current worker
+        :param name: Name of the counter
+        :param value: Value to add
+        :param file: File the value relates to, if any
+        :return: Nothing
+        """
+        self.add({name: value}, file=file)
+
+    def drain(self):
+        """
+        Return the counters and reset them, to send them to the parent process
+        :return: List of ((name, labels), value)
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            self._counters.clear()
+
+        return counters
+
+    def merge(self, counters: list):
+        """
+        Add counters drained from another process
+        :param counters: List of ((name, labels), value) as returned by drain
+        :return: Nothing
+        """
+        with self._lock:
+            for key, value in counters:
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def totals(self, by: str = None):
+        """
+        Sum the counters, overall or by worker or file
+        :param by: None, worker or file
+        :return: Dict of name to value, or dict of worker or file to dict of name to value
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+
+        if by is None:
+            totals = {}
+            for (name, _), value in counters:
+                totals[name] = totals.get(name, 0) + value
+            return totals
+
+        index = {"worker": 0, "file": 1}[by]
+        grouped = {}
+        for (name, labels), value in counters:
+            if labels[index] is None:
+                continue
+            group = grouped.setdefault(labels[index], {})
+            group[name] = group.get(name, 0) + value
+
+        return grouped
+
+    def to_dict(self):
+        """
+        Return the counters as a JSON serializable dict, with the rates of the run
+        :return: Dict
+        """
+        elapsed = time.time() - self.started
+        totals = self.totals()
+
+        return {
+            "elapsed": elapsed,
+            "events_per_second": totals.get("events", 0) / elapsed if elapsed else 0,
+            "bytes_per_second": totals.get("bytes_read", 0) / elapsed if elapsed else 0,
+            "totals": totals,
+            "workers": self.totals(by="worker"),
+            "files": self.totals(by="file"),
+        }
+
+    def prometheus(self):
+        """
+        Return the counters in the Prometheus text format
+        :return: str
+        """
+        with self._lock:
+            # Counters without file label sort first
+            counters = sorted(self._counters.items(), key=lambda item: (item[0][0], item[0][1][0], item[0][1][1] or ""))
+
+        lines = []
+        declared = set()
+        for (name, (worker, file)), value in counters:
+            metric = "evtx2splunk_{name}_total".format(name=name)
+            if metric not in declared:
+                lines.append("# TYPE {metric} counter".format(metric=metric))
+                declared.add(metric)
+
+            labels = 'worker="{worker}"'.format(worker=_escape(worker))
+            if file is not None:
+                labels += ',file="{file}"'.format(file=_escape(file))
+            lines.append("{metric}{{{labels}}} {value}".format(metric=metric, labels=labels, value=value))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Return the summary of the run, one line per counter
+        :return: List of str
+        """
+        elapsed = time.time() - self.started
+        totals = self.totals()
+
+        lines = []
+        for name, description in SUMMARY:
+            if name in totals:
+                value = totals[name]
+                lines.append("{value} {description}".format(
+                    value="{:.2f}".format(value) if isinstance(value, float) else value, description=description))
+
+        if elapsed:
+            lines.append("{rate:.0f} events/s, {bytes:.2f} MB/s".format(
+                rate=totals.get("events", 0) / elapsed, bytes=totals.get("bytes_read", 0) / elapsed / 1024 / 1024))
+
+        if totals.get("batches"):
+            lines.append("{size:.0f} bytes per batch".format(size=totals.get("batch_bytes", 0) / totals["batches"]))
+
+        if totals.get("hec_requests"):
+            lines.append("{latency:.1f} ms per HEC request".format(
+                latency=totals.get("hec_request_seconds", 0) / totals["hec_requests"] * 1000))
+
+        return lines
+
+
+def _escape(value: str):
+    """
+    Escape a label value of the Prometheus text format
+    :param value: Value of the label
+    :return: Escaped value
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsServer(object):
+    """
+    Serve the metrics on /metrics in the Prometheus text format and on /stats in JSON
+    """
+
+    def __init__(self, metrics: Metrics, port: int, host: str = ""):
+        """
+        Init method of the MetricsServer. The server starts immediately in a daemon thread
+        :param metrics: Metrics to serve
+        :param port: Port to listen on
+        :param host: Address to listen on, all by default
+        """
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.startswith("/metrics"):
+                    body = metrics.prometheus().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path.startswith("/stats"):
+                    body = json.dumps(metrics.to_dict()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        log.info("Metrics served on port {port}".format(port=port))
+
+    def close(self):
+        """
+        Stop the server
+        :return: Nothing
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class StatsFileWriter(object):
+    """
+    Write the metrics in a JSON file at regular intervals
+    """
+
+    def __init__(self, metrics: Metrics, path: Path, interval: float = 10):
+        """
+        Init method of the StatsFileWriter. Writing starts immediately in a daemon thread
+        :param metrics: Metrics to write
+        :param path: Path of the JSON file
+        :param interval: Time between two writes in seconds
+        """
+        self._metrics = metrics
+        self._path = Path(path)
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """
+        Write the file until stopped
+        :return: Nothing
+        """
+        while not self._stop.wait(self._interval):
+            self.write()
+
+    def write(self):
+        """
+        Write the current metrics. The file is replaced atomically so readers never see it partially written
+        :return: Nothing
+        """
+        temp_path = self._path.with_name(self._path.name + ".tmp")
+        try:
+            with open(temp_path, "w") as fstats:
+                json.dump(self._metrics.to_dict(), fstats, indent=2)
+            os.replace(temp_path, self._path)
+        except OSError as e:
+            log.warning("Unable to write the stats file. {error}".format(error=e))
+
+    def close(self):
+        """
+        Stop writing and write the final metrics
+        :return: Nothing
+        """
+        self._stop.set()
+        self._thread.join()
+        self.write()
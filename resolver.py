@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Event messages resolver, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import json
+import re
+import sqlite3
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable
+
+# Files produced by build_resolver
+RESOLVER_DB = "evtx_data.db"
+RESOLVER_JSON = "evtx_data.json"
+
+
+class SQLiteResolver(object):
+    """
+    Resolve the message of an event from the database produced by build_resolver.
+    Nothing is loaded at startup, messages are looked up on demand and the hot
+    (provider, event id) pairs are kept in a LRU cache. Each thread uses its own
+    read-only connection.
+    """
+
+    def __init__(self, path: Path, lcid: int = 0x409, cache_size: int = 8192):
+        """
+        Init method of the SQLiteResolver
+        :param path: Path of the database
+        :param lcid: Language of the messages, 0x409 for en-US
+        :param cache_size: Number of (provider, event id) pairs kept in cache
+        """
+        self._lcid = lcid
+        self._uri = "file:{path}?mode=ro".format(path=Path(path).resolve().as_posix())
+        self._local = threading.local()
+        self.resolve = lru_cache(maxsize=cache_size)(self._query)
+
+        # Fail now if the database can't be read
+        self._connection().execute("SELECT 1 FROM messages LIMIT 1")
+
+    def _connection(self):
+        """
+        Return the connection of the current thread
+        :return: sqlite3 connection
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._uri, uri=True)
+            self._local.conn = conn
+
+        return conn
+
+    def _query(self, provider: str, event_id: int):
+        """
+        Look up the message of an event in the database
+        :param provider: Name of the provider
+        :param event_id: Event ID
+        :return: Message or empty string if unknown
+        """
+        row = self._connection().execute("SELECT message FROM messages "
+                                         "WHERE provider = ? AND event_id = ? AND lcid = ?",
+                                         (provider, event_id, self._lcid)).fetchone()
+
+        return row[0] if row else ""
+
+
+class JSONResolver(object):
+    """
+    Resolve the message of an event from the JSON file produced by former versions
+    of build_resolver. The whole file is loaded in memory
+    """
+
+    def __init__(self, path: Path):
+        """
+        Init method of the JSONResolver
+        :param path: Path of the JSON file
+        """
+        with open(path, "r") as fdata:
+            self._messages = json.load(fdata)
+
+    def resolve(self, provider: str, event_id: int):
+        """
+        Return the message of an event
+        :param provider: Name of the provider
+        :param event_id: Event ID
+        :return: Message or empty string if unknown
+        """
+        return self._messages.get(provider, {}).get(str(event_id), "")
+
+
+def open_resolver(folder: Path = Path("."), lcid: int = 0x409):
+    """
+    Return the resolver of the messages built by build_resolver, preferring the database
+    :param folder: Folder holding the files of build_resolver
+    :param lcid: Language of the messages, only available with the database
+    :return: Resolver, or None if no file is available
+    """
+    if (folder / RESOLVER_DB).exists():
+        return SQLiteResolver(folder / RESOLVER_DB, lcid=lcid)
+
+    if (folder / RESOLVER_JSON).exists():
+        return JSONResolver(folder / RESOLVER_JSON)
+
+    return None
+
+
+class MessageTemplate(object):
+    """
+    Message template compiled once into literals and insertion indexes.
+    build_resolver rewrites the insertion strings %1, %2, ... of the messages into {1}, {2}, ...
+    and %%1234, references to parameter messages, end up as %{1234} which are kept as is.
+    """
+
+    # {n} with an optional printf-like format such as {1}!S!
+    _INSERTION = re.compile(r'(%?)\{(\d+)\}(![^!]*!)?')
+
+    def __init__(self, template: str):
+        """
+        Init method of the MessageTemplate
+        :param template: Message as output by build_resolver
+        """
+        self._head = ""
+        self._parts = []
+
+        position = 0
+        literal = []
+        for match in self._INSERTION.finditer(template):
+            literal.append(template[position:match.start()])
+            position = match.end()
+
+            if match.group(1):
+                # Parameter message reference, not an insertion string
+                literal.append("%%{index}".format(index=match.group(2)))
+                continue
+
+            self._push("".join(literal))
+            literal = []
+            self._parts.append([int(match.group(2)) - 1, ""])
+
+        literal.append(template[position:])
+        self._push("".join(literal))
+
+    def _push(self, literal: str):
+        """
+        Append a literal after the last insertion
+        :param literal: Literal text
+        :return: Nothing
+        """
+        if self._parts:
+            self._parts[-1][1] += literal
+        else:
+            self._head += literal
+
+    @property
+    def has_insertions(self):
+        """
+        True if the template needs the EventData of the events
+        """
+        return bool(self._parts)
+
+    def render(self, insertions: list):
+        """
+        Render the message of an event
+        :param insertions: Insertion strings of the event, %1 being the first one
+        :return: Message
+        """
+        out = [self._head]
+        count = len(insertions)
+        for index, literal in self._parts:
+            out.append(insertions[index] if index < count else "{{{index}}}".format(index=index + 1))
+            out.append(literal)
+
+        return "".join(out)
+
+
+class MessageRenderer(object):
+    """
+    Render the message of the events, substituting the insertion strings of the
+    templates with the EventData or UserData of each record. Templates are compiled
+    once per (provider, event id) and kept in a LRU cache.
+    """
+
+    def __init__(self, resolver, cache_size: int = 8192):
+        """
+        Init method of the MessageRenderer
+        :param resolver: SQLiteResolver or JSONResolver
+        :param cache_size: Number of compiled templates kept in cache
+        """
+        self._resolver = resolver
+        self.template = lru_cache(maxsize=cache_size)(self._compile)
+
+    def _compile(self, provider: str, event_id: int):
+        """
+        Compile the template of an event
+        :param provider: Name of the provider
+        :param event_id: Event ID
+        :return: MessageTemplate or None if no message is known
+        """
+        message = self._resolver.resolve(provider, event_id)
+        return MessageTemplate(message) if message else None
+
+    def render(self, provider: str, event_id: int, event: dict):
+        """
+        Return the message of an event
+        :param provider: Name of the provider
+        :param event_id: Event ID
+        :param event: Event part of the record
+        :return: Message or empty string if unknown
+        """
+        template = self.template(provider, event_id)
+        if template is None:
+            return ""
+
+        if not template.has_insertions:
+            return template.render([])
+
+        return template.render(self.insertion_strings(event))
+
+    def render_record(self, provider: str, event_id: int, load_event: Callable[[], dict]):
+        """
+        Return the message of an event, decoding the event only if its message has insertion strings
+        :param provider: Name of the provider
+        :param event_id: Event ID
+        :param load_event: Callable returning the Event part of the record
+        :return: Message or empty string if unknown
+        """
+        template = self.template(provider, event_id)
+        if template is None:
+            return ""
+
+        if not template.has_insertions:
+            return template.render([])
+
+        return template.render(self.insertion_strings(load_event()))
+
+    def render_strings(self, provider: str, event_id: int, insertions: list):
+        """
+        Return the message of an event whose insertion strings are already extracted
+        :param provider: Name of the provider
+        :param event_id: Event ID
+        :param insertions: Insertion strings of the event, as returned by insertion_strings
+        :return: Message or empty string if unknown
+        """
+        template = self.template(provider, event_id)
+        if template is None:
+            return ""
+
+        return template.render(insertions)
+
+    @staticmethod
+    def insertion_strings(event: dict):
+        """
+        Return the insertion strings of an event, in the order of the template
+        :param event: Event part of the record
+        :return: List of strings
+        """
+        return [value for _, value in MessageRenderer.insertion_items(event)]
+
+    @staticmethod
+    def insertion_items(event: dict):
+        """
+        Return the insertion strings of an event with their names, in the order of the template.
+        Unnamed values are named after their position, starting at 1
+        :param event: Event part of the record
+        :return: List of (name, string)
+        """
+        data = event.get("EventData")
+        if data is None:
+            # UserData holds a single element whose children are the values
+            data = event.get("UserData")
+            if isinstance(data, dict):
+                data = next((value for key, value in data.items() if key != "#attributes"), None)
+
+        if not isinstance(data, dict):
+            return []
+
+        if "Data" in data:
+            # Unnamed values, Data is a value, a list or a #text holding them
+            values = data["Data"]
+            if isinstance(values, dict):
+                values = values.get("#text")
+            if not isinstance(values, list):
+                values = [values]
+            items = [(str(position), value) for position, value in enumerate(values, 1)]
+        else:
+            items = [(key, value) for key, value in data.items() if key != "#attributes"]
+
+        return [(key, _to_insertion_string(value)) for key, value in items]
+
+
+def _to_insertion_string(value):
+    """
+    Convert a value of the EventData into an insertion string
+    :param value: Value as output by evtx_dump
+    :return: String
+    """
+    if value is None:
+        return ""
+
+    if isinstance(value, str):
+        return value
+
+    if isinstance(value, dict):
+        return _to_insertion_string(value.get("#text"))
+
+    if isinstance(value, list):
+        return ", ".join(_to_insertion_string(item) for item in value)
+
+    return str(value)
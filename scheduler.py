@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Ingest work scheduler, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+import logging as log
+import os
+from pathlib import Path
+from queue import Queue
+from typing import NamedTuple
+
+from journal import CheckpointJournal
+
+
+class WorkItem(NamedTuple):
+    """
+    Unit of work of the ingest workers, a whole file or a range of lines of a JSONL file
+    """
+    path: Path
+    start: int = 0
+    end: int = None
+    size: int = 0
+
+
+def split_lines(path: Path, chunk_size: int):
+    """
+    Split a JSONL file in byte ranges of about chunk_size, cut on line boundaries
+    :param path: Path of the file
+    :param chunk_size: Approximate size of the ranges
+    :return: List of (start, end)
+    """
+    size = os.stat(path).st_size
+    ranges = []
+    start = 0
+    with open(path, "rb") as fdata:
+        while start < size:
+            if size - start <= chunk_size:
+                ranges.append((start, size))
+                break
+
+            # Move the cut to the end of the line it falls in
+            fdata.seek(start + chunk_size)
+            fdata.readline()
+            end = fdata.tell()
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def plan_work(files: list, chunk_size: int = 0, journal: CheckpointJournal = None):
+    """
+    Build the list of work items of an ingest, largest first so the long items
+    start early and the small ones fill the gaps at the end.
+    JSONL files larger than chunk_size are split so several workers can ingest them.
+    If the journal already knows ranges of a file, they are reused so a resumed
+    ingest matches its checkpoints.
+    :param files: List of files to ingest
+    :param chunk_size: Split the JSONL files larger than this size, 0 to never split
+    :param journal: Checkpoint journal of the ingest
+    :return: List of WorkItem
+    """
+    items = []
+    for file in files:
+        file = Path(file)
+        size = os.stat(file).st_size
+
+        ranges = journal.ranges(journal.key(file)) if journal else []
+        if not ranges and chunk_size and file.suffix == ".json" and size > chunk_size:
+            ranges = split_lines(file, chunk_size)
+
+        if not ranges:
+            items.append(WorkItem(path=file, size=size))
+            continue
+
+        for start, end in ranges:
+            items.append(WorkItem(path=file, start=start, end=end, size=(end if end is not None else size) - start))
+
+    items.sort(key=lambda item: item.size, reverse=True)
+
+    log.info("{count} work items for {files} files, {size} bytes".format(count=len(items), files=len(files),
+                                                                         size=sum(item.size for item in items)))
+    return items
+
+
+def work_queue(items: list):
+    """
+    Return a queue holding the work items, shared by the ingest workers
+    :param items: List of WorkItem in order of processing
+    :return: Queue
+    """
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+
+    return queue
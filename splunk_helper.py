@@ -10,18 +10,169 @@ __date__ = "2020-01-10"
 __version__ = "0.1"
 __author__ = "whitekernel - PAM"
 
+import json
+import os
+import time
 from typing import Any
 
 import requests
 from requests.auth import HTTPBasicAuth
 import logging as log
-from xml.dom.minidom import parse, parseString
+from xml.dom.minidom import parseString
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+# Management entity of the evtx2splunk HEC token
+HEC_INPUT_URI = "services/data/inputs/http/evtx2splunk"
+
+# HEC token and indexes of the previous runs, saved in the cache folder of the user so they
+# are neither shared between users nor left in the folder the tool is run from
+SETUP_CACHE = os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                           "evtx2splunk", "setup.json")
+
+# Seconds after which the setup is made again through the management port
+SETUP_CACHE_TTL = 24 * 3600
+
+
+class SetupCache(object):
+    """
+    HEC token and indexes registered by the previous runs, for each Splunk instance and user.
+    The management calls take longer than a small ingest, so they are skipped while the cached
+    token is accepted by the HEC and the setup is more recent than the TTL.
+    """
+
+    def __init__(self, path: str = SETUP_CACHE, ttl: int = SETUP_CACHE_TTL):
+        """
+        Init method of the SetupCache
+        :param path: Path of the JSON file, in the cache folder of the user by default
+        :param ttl: Seconds after which a setup is ignored
+        """
+        self._path = path
+        self._ttl = ttl
+
+    @staticmethod
+    def key(splunk_url: str, splunk_port: int, username: str, scheme: str = "https"):
+        """
+        Return the key of the setup of a Splunk instance
+        :param splunk_url: URL of the Splunk instance
+        :param splunk_port: Management port of the Splunk instance
+        :param username: Administrative account
+        :param scheme: Scheme of the management port
+        :return: str
+        """
+        return "{user}@{scheme}://{url}:{port}".format(user=username, scheme=scheme, url=splunk_url, port=splunk_port)
+
+    def _load(self):
+        """
+        Read the setups saved in the file
+        :return: Dict of the setups by key, empty if the file is missing or invalid
+        """
+        try:
+            with open(self._path, "r") as fcache:
+                setups = json.load(fcache)
+        except (OSError, ValueError):
+            return {}
+
+        return setups if isinstance(setups, dict) else {}
+
+    def _is_valid(self, setup: Any):
+        """
+        Return whether a setup read from the file can be used
+        :param setup: Value read from the file
+        :return: True if it's a setup more recent than the TTL
+        """
+        return (isinstance(setup, dict) and "token" in setup and isinstance(setup.get("indexes"), list) and
+                time.time() - setup.get("time", 0) <= self._ttl)
+
+    def get(self, key: str):
+        """
+        Return the setup of a Splunk instance
+        :param key: Key returned by key
+        :return: Dict with the token and the indexes, None if there is none or if it expired
+        """
+        setup = self._load().get(key)
+        return setup if self._is_valid(setup) else None
+
+    def save(self, key: str, token: str, indexes: list):
+        """
+        Save the setup of a Splunk instance. The file holds tokens so it's only readable by its owner
+        :param key: Key returned by key
+        :param token: HEC token
+        :param indexes: Indexes registered to the token
+        :return: Nothing
+        """
+        setups = {other: setup for other, setup in self._load().items() if self._is_valid(setup)}
+        setups[key] = {"token": token, "indexes": indexes, "time": time.time()}
+
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), mode=0o700, exist_ok=True)
+            with open(os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fcache:
+                json.dump(setups, fcache)
+        except OSError as e:
+            log.warning("Unable to save the setup cache. {error}".format(error=e))
+
+    def forget(self, key: str):
+        """
+        Remove the setup of a Splunk instance, once its token or its index is no longer usable
+        :param key: Key returned by key
+        :return: Nothing
+        """
+        setups = self._load()
+        if setups.pop(key, None) is None:
+            return
+
+        try:
+            with open(os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fcache:
+                json.dump(setups, fcache)
+        except OSError as e:
+            log.warning("Unable to save the setup cache. {error}".format(error=e))
+
+
+def check_hec_token(url: str, token: str, ssl_verify: bool, timeout: int = 2):
+    """
+    Check that the HEC accepts a token by posting no event. Splunk answers 400 No data to a
+    valid token, and 401 or 403 to an unknown or disabled one
+    :param url: Base URL of the HEC, for instance https://splunk:8088
+    :param token: HEC token
+    :param ssl_verify: True to check ssl certificate
+    :param timeout: Timeout of the request in seconds
+    :return: True if the token is accepted, else False
+    """
+    try:
+        response = requests.post(url.rstrip("/") + "/services/collector/event", data=b"",
+                                 headers={"Authorization": "Splunk {token}".format(token=token)},
+                                 verify=ssl_verify, timeout=timeout)
+    except requests.RequestException as e:
+        log.debug(e)
+        return False
+
+    return response.status_code in (200, 400)
+
+
+def check_index(url: str, index: str, username: str, password: str, ssl_verify: bool, timeout: int = 2):
+    """
+    Check that an index still exists on the Splunk instance, with a single request of the management port
+    :param url: Base URL of the management port, for instance https://splunk:8089
+    :param index: Name of the index
+    :param username: Administrative account
+    :param password: Password account
+    :param ssl_verify: True to check ssl certificate
+    :param timeout: Timeout of the request in seconds
+    :return: True if the index exists, else False
+    """
+    try:
+        response = requests.get(url.rstrip("/") + "/services/data/indexes/{index}".format(index=index),
+                                auth=HTTPBasicAuth(username, password), verify=ssl_verify, timeout=timeout)
+    except requests.RequestException as e:
+        log.debug(e)
+        return False
+
+    return response.status_code == 200
+
 
 class SplunkHelper(object):
-    def __init__(self, splunk_url: str, splunk_port: int, splunk_ssl_verify: bool, username: str, password: str):
+    def __init__(self, splunk_url: str, splunk_port: int, splunk_ssl_verify: bool, username: str, password: str,
+                 scheme: str = "https"):
         """
         Init class of the helper.
         :param splunk_url: URL of the Splunk instance
@@ -29,17 +180,23 @@ class SplunkHelper(object):
         :param splunk_ssl_verify: True to check ssl certificate
         :param username: Administrative account
         :param password: Password account
+        :param scheme: https, or http for a management port without SSL
         """
-        self._surl = "https://{url}:{port}/".format(url=splunk_url,
-                                                    port=splunk_port)
-        self._suser = username
-        self._spwd = password
+        self._surl = "{scheme}://{url}:{port}/".format(scheme=scheme,
+                                                       url=splunk_url,
+                                                       port=splunk_port)
         self._ssl_verify = splunk_ssl_verify
         if not self._ssl_verify:
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-        self.link_up = self.test_connection()
+        # A single session keeps the connection, and the TLS handshake, between the calls
+        self._session = requests.Session()
+        self._session.auth = HTTPBasicAuth(username, password)
+        self._session.verify = splunk_ssl_verify
+
         self._hec_token = None
+        self.hec_indexes = []
+        self.link_up = self.test_connection()
 
     def _uri(self, uri: str):
         """
@@ -62,17 +219,7 @@ class SplunkHelper(object):
 
         try:
 
-            if method == "GET":
-                response = requests.get(url=self._uri(uri=uri),
-                                        verify=self._ssl_verify,
-                                        auth=HTTPBasicAuth(self._suser, self._spwd),
-                                        timeout=2)
-            elif method == "POST":
-                response = requests.post(url=self._uri(uri=uri),
-                                         data=data,
-                                         verify=self._ssl_verify,
-                                         auth=HTTPBasicAuth(self._suser, self._spwd),
-                                         timeout=2)
+            response = self._session.request(method, url=self._uri(uri=uri), data=data, timeout=2)
         except Exception as e:
             log.error(e)
             log.error("Unable to connect to Splunk. Please check URL and ports")
@@ -84,6 +231,10 @@ class SplunkHelper(object):
         elif response.status_code == 200 or response.status_code == 201:
             ret = True
 
+        elif response.status_code == 404:
+            # Lookup of an entity not created yet
+            log.debug("{uri} not found".format(uri=uri))
+
         else:
             log.error("Server error. See message below. Status {status}".format(status=response.status_code))
 
@@ -91,11 +242,33 @@ class SplunkHelper(object):
 
     def test_connection(self):
         """
-        Test connection to the Splunk instance
+        Test connection to the Splunk instance. The evtx2splunk HEC input is requested, so
+        its token and indexes are known without other requests
         :return: True if successful, else False
         """
-        ret, _ = self._request(uri='services/data/inputs/http')
-        return ret
+        ret, response = self._request(uri=HEC_INPUT_URI)
+        if ret:
+            self._parse_hec_input(response.text)
+            return True
+
+        # The HEC input is not created yet
+        return response is not None and response.status_code == 404
+
+    def _parse_hec_input(self, text: str):
+        """
+        Read the token and the indexes of the evtx2splunk HEC input
+        :param text: XML of the HEC input, as returned by the management port
+        :return: Nothing
+        """
+        dom = parseString(text)
+
+        for e in dom.getElementsByTagName("s:key"):
+
+            if e.getAttribute("name") == "token":
+                self._hec_token = e.firstChild.nodeValue
+
+            elif e.getAttribute("name") == "indexes":
+                self.hec_indexes = [item.firstChild.nodeValue for item in e.getElementsByTagName("s:item")]
 
     def create_index(self, index: str):
         """
@@ -130,31 +303,16 @@ class SplunkHelper(object):
     def get_or_create_hect(self):
         """
         Look for an HEC token or create one if none is available
-        :return:
+        :return: HEC token, None if it can't be created
         """
-        hect = None
         if not self.link_up:
-            return hect
+            return None
 
+        # The token already registered under the same name was read by test_connection
         if self._hec_token:
+            log.info("HEC token found")
             return self._hec_token
 
-        # Check if a token is already registered under the same name
-        ret, response = self._request(uri='services/data/inputs/http/evtx2splunk')
-        if ret:
-
-            dom = parseString(response.text)
-
-            for e in dom.getElementsByTagName("s:key"):
-
-                if e.getAttribute("name") == "token":
-
-                    # We have a key, return the node value which
-                    # is the HEC token
-                    log.info("HEC token found")
-                    self._hec_token = e.firstChild.nodeValue
-                    return self._hec_token
-
         # If we are here, we don't have a token yet, so create it
         data = {
             "name": "evtx2splunk"
@@ -164,22 +322,16 @@ class SplunkHelper(object):
                                       method="POST",
                                       data=data)
         if ret:
-
-            dom = parseString(response.text)
-
-            for e in dom.getElementsByTagName("s:key"):
-
-                if e.getAttribute("name") == "token":
-                    # We have a key, return the node value which
-                    # is the HEC token
-                    log.info("HEC token created successfully")
-                    self._hec_token = e.firstChild.nodeValue
-                    return self._hec_token
+            self._parse_hec_input(response.text)
+            if self._hec_token:
+                log.info("HEC token created successfully")
+                return self._hec_token
 
         log.error("Unable to create HEC token")
-        log.error("{message}".format(message=response.text))
+        if response is not None:
+            log.error("{message}".format(message=response.text))
 
-        return hect
+        return None
 
     def register_index_to_hec(self, index: str):
         """
@@ -191,34 +343,24 @@ class SplunkHelper(object):
         if not self._hec_token:
             self._hec_token = self.get_or_create_hect()
 
-        # Retrieve the list of indexes allowed to be pushed with the HEC token
-        ret, response = self._request(uri='services/data/inputs/http/evtx2splunk')
-        indexes = []
-        if ret:
-
-            dom = parseString(response.text)
-
-            for e in dom.getElementsByTagName("s:key"):
-
-                if e.getAttribute("name") == "indexes":
-                    indexes = [item.firstChild.nodeValue for item in e.getElementsByTagName("s:item")]
-
-        # Check if the index is already associated
-        if index in indexes:
+        # Check if the index is already associated. The indexes allowed to be pushed
+        # with the HEC token were read with the token
+        if index in self.hec_indexes:
             log.info("Index already registered, continuing")
             return True
 
         # Add the index and push
-        indexes.append(index)
+        indexes = self.hec_indexes + [index]
         data = {
             "indexes": ",".join(indexes),
             "index": indexes[0]
         }
-        ret, response = self._request(uri='services/data/inputs/http/evtx2splunk',
+        ret, response = self._request(uri=HEC_INPUT_URI,
                                       method="POST",
                                       data=data)
 
         if ret:
+            self.hec_indexes = indexes
             log.info("Index associated successfully")
             return True
 
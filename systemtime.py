@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+
+"""
+    Fast SystemTime parser, part of evtx2splunk
+"""
+
+__progname__ = "evtx2splunk"
+__date__ = "2020-01-10"
+__version__ = "0.1"
+__author__ = "whitekernel - PAM"
+
+from datetime import date
+
+# Ordinal of the epoch, used to compute the number of days since the epoch
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class SystemTimeParser(object):
+    """
+    Convert the SystemTime attribute of the records into epoch.
+    evtx_dump always outputs the same ISO-8601 format, "2020-06-16T12:54:38.766579Z",
+    sometimes without the fractional part. Instead of going through strptime, the
+    fields are sliced at fixed positions and the epoch of the date/second prefix is
+    cached, as consecutive events of a log mostly share it.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        """
+        Init method of the SystemTimeParser
+        :param cache_size: Max number of date/second prefixes to keep in cache
+        """
+        self._cache = {}
+        self._cache_size = cache_size
+
+    def to_epoch(self, system_time: str):
+        """
+        Return the epoch of a SystemTime, same value as datetime.timestamp() would give
+        :param system_time: SystemTime as output by evtx_dump
+        :return: Float epoch in seconds, with microseconds precision
+        :raise ValueError: If the SystemTime does not follow the expected format
+        """
+        prefix = system_time[:19]
+        seconds = self._cache.get(prefix)
+        if seconds is None:
+            seconds = self._prefix_to_epoch(prefix)
+
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[prefix] = seconds
+
+        tail = system_time[19:]
+        if tail == "Z":
+            return float(seconds)
+
+        # Microseconds are the best precision datetime gives, extra digits are dropped
+        fraction = tail[1:-1][:6]
+        if tail[:1] != "." or tail[-1:] != "Z" or not fraction.isdigit():
+            raise ValueError("Unsupported SystemTime {time}".format(time=system_time))
+
+        return (seconds * 1000000 + int(fraction.ljust(6, "0"))) / 1000000
+
+    @staticmethod
+    def _prefix_to_epoch(prefix: str):
+        """
+        Return the epoch of the date/second prefix of a SystemTime
+        :param prefix: Str - "YYYY-MM-DDTHH:MM:SS"
+        :return: Int epoch in seconds
+        :raise ValueError: If the prefix is not a valid date
+        """
+        if (len(prefix) != 19 or prefix[4] != "-" or prefix[7] != "-" or prefix[10] != "T"
+                or prefix[13] != ":" or prefix[16] != ":"):
+            raise ValueError("Unsupported SystemTime {time}".format(time=prefix))
+
+        hour = int(prefix[11:13])
+        minute = int(prefix[14:16])
+        second = int(prefix[17:19])
+        if hour > 23 or minute > 59 or second > 59:
+            raise ValueError("Unsupported SystemTime {time}".format(time=prefix))
+
+        # date() checks the validity of the day
+        days = date(int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10])).toordinal() - _EPOCH_ORDINAL
+
+        return days * 86400 + hour * 3600 + minute * 60 + second